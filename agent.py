@@ -1,4 +1,5 @@
 import asyncio
+import multiprocessing
 
 from agent.config import Config
 from agent.cli import cli
@@ -13,19 +14,23 @@ def post_config_load():
     Config.LLAMA.EMBEDDING.SIZE = n_embd
     Config.LLAMA.EMBEDDING.CONTEXT = n_ctx
 
-Config.load_from_toml(post_config_load)
+# guard needed as worker processes (spawned) re-import this module
+if __name__ == "__main__":
+    multiprocessing.freeze_support() # pyinstaller executable spawning workers
 
-Completion.init() # log llama init now
+    Config.load_from_toml(post_config_load)
 
-with Sql():
-    loop = asyncio.new_event_loop()
-    t1 = create_task(cli, loop)
-    t2 = create_task(server, loop)
+    Completion.init() # log llama init now
 
-    try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        t1()
-        t2()
-    finally:
-        loop.close()
+    with Sql():
+        loop = asyncio.new_event_loop()
+        t1 = create_task(cli, loop)
+        t2 = create_task(server, loop)
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            t1()
+            t2()
+        finally:
+            loop.close()
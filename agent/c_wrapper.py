@@ -5,6 +5,10 @@ class Hnsw:
     def __init__(self, space: str, dim: int):
         self._hnsw = hnswlib.Index(space, dim)
 
+    @property
+    def dim(self) -> int:
+        return self._hnsw.dim
+
     @property
     def max_elements(self) -> int:
         return self._hnsw.max_elements
@@ -43,22 +47,37 @@ class Hnsw:
     def resize(self, val: int):
         self._hnsw.resize_index(val)
 
-    def add(self, data: list[float], ids: list[int], num_threads=-1, replace_deleted=False):
+    def add(self, data: list[list[float]] | np.ndarray, ids: list[int] | np.ndarray, num_threads=-1, replace_deleted=False):
+        # hnswlib stores float32; convert once here instead of going through float64
         self._hnsw.add_items(
-            np.array(data),
-            np.array(ids),
+            np.asarray(data, dtype=np.float32),
+            np.asarray(ids),
             num_threads=num_threads,
             replace_deleted=replace_deleted
         )
 
+    def ids(self) -> list[int]:
+        """
+        all labels in index, including those marked deleted
+        """
+        return self._hnsw.get_ids_list()
+
+    def items(self, ids: list[int]) -> np.ndarray:
+        """
+        stored vectors of ids; normalized if space is cosine
+        """
+        return self._hnsw.get_items(ids)
+
     def delete(self, id: int):
         self._hnsw.mark_deleted(id)
 
-    def query(self, data: list[float], k=1, num_threads=-1, filter=None) -> tuple[list[int], list[float]]:
-        lbls, dists = self._hnsw.knn_query(
-            np.array(data),
+    def query(self, data: list[float] | np.ndarray, k=1, num_threads=-1, filter=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        returns: (labels, distances), each shaped (queries, k)
+        """
+        return self._hnsw.knn_query(
+            np.asarray(data, dtype=np.float32),
             k=k,
             num_threads=num_threads,
             filter=filter
         )
-        return (lbls.tolist(), dists.tolist())
@@ -1,14 +1,23 @@
-from typing import Iterable
+from typing import Iterable, Callable
 from io import StringIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from itertools import accumulate
+from bisect import bisect_right
+import multiprocessing
+import os
+import re
 
 from agent.config import Config, DocumentScript
-from common.string import MutableString
 
 class Chunker:
-    def __init__(self, input: str):
-        self._splitted = []
+    def __init__(self, input: str | Iterable[str]):
+        self._splitted: deque[str] = deque()
 
-        if input.startswith("./"):
+        if not isinstance(input, str):
+            # already split into sections i.e. FileStream read on another thread
+            self._iterable: Iterable[str] = iter(input)
+        elif input.startswith("./") or os.path.isfile(input):
             self._iterable: Iterable[str] = FileStream(input)
         elif input.startswith("<!DOCTYPE html>"):
             # TODO should be handling http stream here
@@ -29,88 +38,183 @@ class Chunker:
                     _sliding_window(next(self._iterable))
                 )
 
-        return self._splitted.pop(0)
+        return self._splitted.popleft()
 
-def _split_to_sentence_weight(input: str) -> list[tuple[str, int]]:
+class ChunkerPool:
+    """
+    Chunker over multiple files, each file chunked whole in a worker process\n
+    chunks are returned file by file in input order
+    """
+    def __init__(self, files: list[str], workers: int=None, progress: Callable[[int], None]=None):
+        """
+        progress: called with file size as each file's chunks are handed out\n
+        files that are not text in the default encoding are skipped and listed in skipped
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(files)))
+
+        # spawned workers start with a fresh Config, carry over the loaded chunk settings
+        self._pool = ProcessPoolExecutor(workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(Config.CHUNK.SEPARATOR, Config.CHUNK.SCRIPT, Config.CHUNK.SIZE, Config.CHUNK.OVERLAP)
+        )
+        self._files = iter(files)
+        self._pending: deque[tuple[str, Future]] = deque()
+        self._splitted: deque[str] = deque()
+        self._progress = progress
+        self.skipped: list[str] = []
+
+        # bound files chunked ahead of the consumer
+        for _ in range(workers * 2):
+            self._submit()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self._splitted) == 0:
+            if len(self._pending) == 0:
+                self._pool.shutdown()
+                raise StopIteration
+
+            path, future = self._pending.popleft()
+            try:
+                chunks = future.result()
+            except UnicodeDecodeError:
+                # e.g. a binary file in a directory; not a reason to drop the whole run
+                chunks = []
+                self.skipped.append(path)
+            except:
+                self._pool.shutdown(cancel_futures=True)
+                raise
+
+            self._submit()
+            self._splitted.extend(chunks)
+
+            if self._progress is not None:
+                self._progress(os.path.getsize(path))
+
+        return self._splitted.popleft()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        stop the worker processes, dropping files not chunked yet; called on exhaustion too
+        """
+        self._pool.shutdown(cancel_futures=True)
+
+    def _submit(self):
+        path = next(self._files, None)
+        if path is not None:
+            self._pending.append((path, self._pool.submit(_chunk_file, path)))
+
+def _init_worker(separator: str, script: DocumentScript, size: int, overlap: float):
+    Config.CHUNK.SEPARATOR = separator
+    Config.CHUNK.SCRIPT = script
+    Config.CHUNK.SIZE = size
+    Config.CHUNK.OVERLAP = overlap
+
+def _chunk_file(path: str) -> list[str]:
+    return list(Chunker(path))
+
+def estimate_chunks(size: int) -> int:
+    """
+    rough number of chunks from text size in bytes
+    """
     if Config.CHUNK.SCRIPT == DocumentScript.LATIN:
-        stop_marks = "!?."
+        chunk_bytes = 6 # avg english word w/ trailing space
     elif Config.CHUNK.SCRIPT == DocumentScript.HANZI:
-        stop_marks = "！？｡。"
+        chunk_bytes = 3 # utf-8 cjk char
+    
+    # each chunk only moves forward by its non-overlapping part
+    chunk_bytes *= Config.CHUNK.SIZE * (1 - Config.CHUNK.OVERLAP)
+    return int(size / chunk_bytes)
 
-    ret = []
-    idx = 0
-    max = len(input)
-    sentence = MutableString()
-
-    for char in input:
-        sentence.add(char)
-        idx += 1
-
-        if char in stop_marks:
-            # if ".", look ahead in case is part of a 'x.x' word
-            if char == "." and idx < max: # idx already points to next elem!
-                if input[idx] != " " and input[idx] != "\n":
-                    continue # skip outputting; is part of 'x.x' word
-
-            sentence.strip()
-            if Config.CHUNK.SCRIPT == DocumentScript.LATIN:
-                # >1 whitespaces will also count as 'words'. +1 for stop mark
-                count = sentence.split_len(" ") + 1
-            elif Config.CHUNK.SCRIPT == DocumentScript.HANZI:
-                count = len(sentence) # whitespaces in between also count as 'word/s'
-
-            ret.append((sentence.value(), count))
-            sentence.clear()
+# sentence ends at a stop mark; for "." only if followed by whitespace or end of input
+# otherwise it is part of a 'x.x' word
+_STOP_MARKS = {
+    DocumentScript.LATIN: re.compile(r"[!?]|\.(?![^ \n])"),
+    DocumentScript.HANZI: re.compile(r"[！？｡。]")
+}
 
-    return ret
+def _split_to_sentence_weight(input: str) -> tuple[list[str], list[int]]:
+    """
+    returns: [sentences, weights]\n
+    text after the last stop mark is not a sentence and is dropped
+    """
+    sentences = []
+    weights = []
+    start = 0
+
+    for m in _STOP_MARKS[Config.CHUNK.SCRIPT].finditer(input):
+        sentence = input[start:m.end()].strip()
+        start = m.end()
+
+        if Config.CHUNK.SCRIPT == DocumentScript.LATIN:
+            # >1 whitespaces will also count as 'words'. +1 for stop mark
+            count = sentence.count(" ") + 2
+        elif Config.CHUNK.SCRIPT == DocumentScript.HANZI:
+            count = len(sentence) # whitespaces in between also count as 'word/s'
+
+        sentences.append(sentence)
+        weights.append(count)
+
+    return (sentences, weights)
 
 def _sliding_window(input: str) -> list[str]:
     ret = []
     overlap_size = Config.CHUNK.SIZE * Config.CHUNK.OVERLAP
+    joiner = " " if Config.CHUNK.SCRIPT == DocumentScript.LATIN else ""
 
-    snt_wgt = _split_to_sentence_weight(input)
-    idx = 0
-    total = 0
-    sentence = MutableString()
-
-    while idx < len(snt_wgt):
-        if Config.CHUNK.SCRIPT == DocumentScript.LATIN and sentence.not_empty():
-            sentence.add(" ")
-        sentence.add(snt_wgt[idx][0])
-        total += snt_wgt[idx][1]
-
-        if total > Config.CHUNK.SIZE:
-            # sentence collected up to this point is enough, output it
-            ret.append(sentence.value())
-
-            # apply sliding window; slide back overlap% reusing previous sentences
-            deduct = 0
-            while True:
-                deduct += snt_wgt[idx][1] # start reusing current idx
-                if deduct >= overlap_size:
-                    break
-                idx = idx - 1
-
-            total = 0
-            sentence.clear()
-        else:
-            idx += 1
+    sentences, weights = _split_to_sentence_weight(input)
+    count = len(sentences)
+
+    # prefix[i] = total weight of sentences[:i]; weights are >= 1 so prefix is strictly increasing
+    prefix = [0]
+    prefix.extend(accumulate(weights))
+
+    start = 0
+    while start < count:
+        # first end (exclusive) where chunk weight goes over chunk size
+        end = bisect_right(prefix, prefix[start] + Config.CHUNK.SIZE, lo=start + 1)
+        if end > count:
+            # looping through all sentences has completed and chunk_size is not yet reached
+            ret.append(joiner.join(sentences[start:]))
+            break
 
-    # sentence outputting happens when chunk_size is reached (handled above) OR
-    # looping through all sentences has completed and chunk_size is not yet reached
-    if sentence.not_empty():
-        ret.append(sentence.value())
+        ret.append(joiner.join(sentences[start:end]))
+
+        # apply sliding window; slide back overlap% reusing previous sentences
+        # i.e. last idx where weight of sentences[idx:end] is still >= overlap_size
+        idx = bisect_right(prefix, prefix[end] - overlap_size, lo=start, hi=end) - 1
+        # always move forward; a single oversized sentence would otherwise repeat forever
+        start = max(idx, start + 1)
 
     return ret
 
 
 class FileStream:
-    def __init__(self, file: str):
+    def __init__(self, file: str, block=True, progress: Callable[[int], None]=None):
+        """
+        block: locate separators with str.find over large read blocks (default)\n
+        otherwise scan char-by-char; kept as reference for benchmarking\n
+        progress: called with the number of bytes read from file as blocks are read
+        """
         # do NOT make file async (aiofiles) as this makes the chain an async-iter all the way:
         # FileStream -> Chunker -> Embedding
         # Embedding is not an async function so it becomes blocking I/O in the end
         self._reader = open(file) # let errors go through
         self._eof = False
+        self._block = block
+        self._progress = progress
+        self._read_bytes = 0
 
         self._read_str = ""
         self._read_idx = -1
@@ -122,6 +226,54 @@ class FileStream:
         if self._eof:
             raise StopIteration
 
+        if self._block:
+            ret = self._next_block()
+        else:
+            ret = self._next_scan()
+
+        # handle edge case where separator is before EOF (w/ whitespaces in between)
+        if ret == "" and self._eof:
+            raise StopIteration
+        
+        return ret
+
+    def _read(self, size: int) -> str:
+        read = self._reader.read(size)
+        if self._progress is not None:
+            # position of the binary buffer underneath; chars decoded are not bytes
+            pos = self._reader.buffer.tell()
+            self._progress(pos - self._read_bytes)
+            self._read_bytes = pos
+        return read
+
+    def _next_block(self) -> str:
+        separator = Config.CHUNK.SEPARATOR
+        search_idx = max(self._read_idx, 0)
+
+        while True:
+            found = self._read_str.find(separator, search_idx)
+            if found != -1:
+                ret = self._read_str[self._read_idx:found]
+                self._read_idx = found + len(separator)
+                break
+
+            read = self._read(Config.CHUNK.READ_SIZE)
+            if read == "":
+                ret = self._read_str[self._read_idx:]
+                self._eof = True
+                self._reader.close()
+                break
+
+            # carry over unconsumed tail; separator can straddle the block boundary
+            # so resume search just before where the new block starts
+            tail = self._read_str[self._read_idx:]
+            self._read_str = tail + read
+            self._read_idx = 0
+            search_idx = max(len(tail) - len(separator) + 1, 0)
+
+        return ret.strip()
+
+    def _next_scan(self) -> str:
         writer = StringIO()
         idx = 0
         separator = Config.CHUNK.SEPARATOR
@@ -148,7 +300,7 @@ class FileStream:
         while True:
             # init condition (idx -1) or finished parsing '4096 char' chunk
             if self._read_idx == -1 or self._read_idx == rslen:
-                self._read_str = self._reader.read(2048) # 11 bit length
+                self._read_str = self._read(2048) # 11 bit length
                 self._read_idx = 0
                 rslen = len(self._read_str) # re-establish read len
 
@@ -170,10 +322,4 @@ class FileStream:
                 self._reader.close()
                 break
             
-        ret = writer.getvalue().strip()
-
-        # handle edge case where separator is before EOF (w/ whitespaces in between)
-        if ret == "" and self._eof:
-            raise StopIteration
-        
-        return ret
+        return writer.getvalue().strip()
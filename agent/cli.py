@@ -4,7 +4,7 @@ import shlex
 import sys
 import time
 
-from agent.chunker import Chunker
+from agent.ingest import ingest
 from agent.storage import Vector
 from agent.llm import Embedding, Completion, Chat
 from agent.config import Config
@@ -15,6 +15,10 @@ _CMD_HELP = Config.CLI_CMD_PREFIX + "help"
 _CMD_LIST = Config.CLI_CMD_PREFIX + "list"
 _CMD_CREATE = Config.CLI_CMD_PREFIX + "create"
 _CMD_DELETE = Config.CLI_CMD_PREFIX + "delete"
+_CMD_REINDEX = Config.CLI_CMD_PREFIX + "reindex"
+_CMD_COMPACT = Config.CLI_CMD_PREFIX + "compact"
+_CMD_SCOPE = Config.CLI_CMD_PREFIX + "scope"
+_CMD_EF = Config.CLI_CMD_PREFIX + "ef"
 
 class _ArgsParserQuery(Exception): ...
 
@@ -44,12 +48,23 @@ async def cli():
         add_help=False,
         usage="""
     {list}                                List all sources
-    {create} FILE -s NAME                 Create data from FILE
+    {create} PATH [PATH ..] -s NAME       Create data from files
+      PATH                               File, directory, glob or @manifest
       -s NAME, --source NAME             Group under this source
-    {delete} SOURCE                       Delete all data with SOURCE group""".format(
+                                         unchanged data is kept, data no longer in PATH is deleted
+      -a, --append                       Keep existing data of source not in PATH
+    {delete} SOURCE                       Delete all data with SOURCE group
+    {reindex}                             Rebuild search index from stored data
+    {compact}                             Free space of deleted data in search index
+    {scope} [SOURCE ..]                   Answer only from these sources, none for all
+    {ef} [N]                              Show or set search breadth; more is more accurate and slower""".format(
         list=_CMD_LIST,
         create=_CMD_CREATE,
-        delete=_CMD_DELETE
+        delete=_CMD_DELETE,
+        reindex=_CMD_REINDEX,
+        compact=_CMD_COMPACT,
+        scope=_CMD_SCOPE,
+        ef=_CMD_EF
     ))
     
     sub = parser.add_subparsers(dest="command")
@@ -60,18 +75,36 @@ async def cli():
     # list
     sub.add_parser(_CMD_LIST)
 
-    # create FILE -s SOURCE
+    # create PATH [PATH ..] -s SOURCE
     create_parser = sub.add_parser(_CMD_CREATE)
-    create_parser.add_argument("file")
+    create_parser.add_argument("path", nargs="+")
     create_parser.add_argument("-s", "--source", type=str, required=True)
+    create_parser.add_argument("-a", "--append", action="store_true")
 
     # delete SOURCE
     delete_parser = sub.add_parser(_CMD_DELETE)
     delete_parser.add_argument("source")
+
+    # reindex
+    sub.add_parser(_CMD_REINDEX)
+
+    # compact
+    sub.add_parser(_CMD_COMPACT)
+
+    # scope [SOURCE ..]
+    scope_parser = sub.add_parser(_CMD_SCOPE)
+    scope_parser.add_argument("source", nargs="*")
+
+    # ef [N]
+    ef_parser = sub.add_parser(_CMD_EF)
+    ef_parser.add_argument("ef", type=int, nargs="?")
     
     # cli chat history is just for this session
     chat = Chat()
 
+    # sources queries are answered from, empty for all; also just for this session
+    sources = []
+
     # cli edit lock
     lock_time = 0.0
 
@@ -100,25 +133,57 @@ async def cli():
                 list = Vector.list()
 
                 print(f"total {len(list)}")
-                print(f"{'source':<20}  {'rows':>5}")
+                print(f"{'source':<20}  {'rows':>5}  {'KB':>8}  created")
                 for li in list:
-                    print(f"{li[0]:<20}  {li[1]:>5}")
+                    print(f"{li[0]:<20}  {li[1]:>5}  {li[2] / 1024:>8.0f}  {li[3]}")
 
             elif arg.command == _CMD_CREATE:
-                chunker = Chunker(arg.file)
-                embed = Embedding(chunker)
-                Vector.create(embed, arg.source)
-                print("done")
+                try:
+                    # in a worker thread so relay queries are answered meanwhile
+                    await asyncio.to_thread(ingest, arg.path, arg.source, arg.append)
+                except (OSError, ValueError) as e:
+                    # bad path/s or a file that cannot be read; ingest rolled back what it stored, keep cli running
+                    print(e)
 
             elif arg.command == _CMD_DELETE:
-                Vector.delete(arg.source)
+                await asyncio.to_thread(Vector.delete, arg.source)
                 print("done")
 
+            elif arg.command == _CMD_REINDEX:
+                count, missing = await asyncio.to_thread(Vector.reindex)
+                print(f"indexed {count} rows")
+                if missing > 0:
+                    # stored before vectors were kept in data
+                    print(f"{missing} rows have no stored vector, {_CMD_CREATE} their source again to index them")
+
+            elif arg.command == _CMD_COMPACT:
+                if Vector.compact():
+                    print("compacting in background")
+                else:
+                    print("index is busy or has nothing to compact")
+
+            elif arg.command == _CMD_SCOPE:
+                sources = arg.source
+                known = {li[0] for li in Vector.list()}
+                for src in sources:
+                    if src not in known:
+                        print(f"no data with source {src}")
+                print(f"answering from {', '.join(sources) if len(sources) > 0 else 'all sources'}")
+
+            elif arg.command == _CMD_EF:
+                limit = Config.STORAGE.HNSW.EF_SEARCH_LIMIT
+                if arg.ef is None:
+                    print(f"ef {Config.STORAGE.HNSW.EF_SEARCH}")
+                elif not limit.MIN <= arg.ef <= limit.MAX:
+                    print(f"ef must be {limit.MIN} to {limit.MAX}")
+                else:
+                    Vector.tune(arg.ef)
+                    print(f"ef {arg.ef} until restart, set [storage.hnsw] ef_search to keep it")
+
             lock_time = time.time()
 
         except _ArgsParserQuery:
-                vec = Embedding.from_string(input)
-                ctx = Vector.read(vec)
+                ctx = await asyncio.to_thread(Vector.search, input, Embedding.from_string, sources)
                 res = Completion.run(input, ctx, chat)
                 
                 for r, end in EndDefIter(res):
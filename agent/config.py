@@ -1,5 +1,6 @@
 import uuid
 import sys
+import os
 from enum import Enum
 from typing import Callable
 #from argparse import ArgumentParser
@@ -7,6 +8,7 @@ from typing import Callable
 from common.toml import Toml
 
 _qdrant_key = uuid.uuid4().hex
+_cpu_count = os.cpu_count() or 1
 
 def in_prod() -> bool:
     return getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS")
@@ -31,6 +33,25 @@ class DocumentScript(Enum):
     # https://en.wikipedia.org/wiki/List_of_writing_systems
     LATIN = 1,
     HANZI = 2
+
+class Retrieval(Enum):
+    VECTOR = 1,
+    HYBRID = 2 # vector + bm25 keyword search
+
+class Backend(Enum):
+    HNSW = 1,
+    FLAT = 2, # exact numpy search
+    QDRANT = 3,
+    SHARDED = 4 # hnsw per source
+
+class Quantization(Enum):
+    NONE = 1,
+    FLOAT16 = 2,
+    INT8 = 3 # per vector scale
+
+class Compression(Enum):
+    NONE = 1,
+    ZLIB = 2 # deflate per chunk with a preset dictionary per source
     
 class Config:
     class _qdrant:
@@ -39,6 +60,10 @@ class Config:
         SHELL = "./qdrant"
         KEY = _qdrant_key
         READ_LIMIT = 1
+        # points per upsert request; larger adds are split so several requests overlap
+        UPSERT_BATCH = 512
+        # upserts sent and not yet acknowledged; add blocks beyond this
+        UPSERTS = 4
         # qdrant recommends multitenancy as opposed to multicollection
         COLLECTION = "my collection"
         # https://qdrant.tech/documentation/guides/configuration/#environment-variables
@@ -53,18 +78,80 @@ class Config:
     class _storage:
         SQL = Toml.Spec("storage.data", "./data")
         INDEX = Toml.Spec("storage.index", "./index")
+        # best matching chunks used as context
+        TOP_K = Toml.Spec("storage.top_k", 1)
+        TOP_K_LIMIT = _min_max(1, 32)
+        # cosine distance; chunks further than this from the query are not used
+        MAX_DISTANCE = Toml.Spec("storage.max_distance", 0.4)
+        MAX_DISTANCE_LIMIT = _min_max(0, 2)
+        RETRIEVAL = Toml.Spec("storage.retrieval", "VECTOR", lambda x: Retrieval[x])
+        BACKEND = Toml.Spec("storage.backend", "HNSW", lambda x: Backend[x])
+        # vectors scanned by the FLAT backend; full precision ones stay on disk for rerank
+        # hnsw graphs hold float32, quantized copies next to them would only add memory
+        QUANTIZATION = Toml.Spec("storage.quantization", "NONE", lambda x: Quantization[x])
+        # quantized search keeps this many candidates per result and reorders them at full precision; 0 to not rerank
+        RERANK = Toml.Spec("storage.rerank", 4)
+        RERANK_LIMIT = _min_max(0, 64)
+        # chunk text stored in data; applies to chunks stored afterwards, either kind is read back
+        COMPRESSION = Toml.Spec("storage.compression", "NONE", lambda x: Compression[x])
+
+        # hardcoded
+        SQL_CACHE_KB = 65536
+        # deflate only looks back 32 KB, a larger preset dictionary is not used
+        DICTIONARY_SIZE = 32768
+        # chunks are compressed once and decompressed on every read; decompression speed does not depend on it
+        COMPRESSION_LEVEL = 9
+        # read-only connections for queries from worker threads; beyond this, readers wait for an idle one
+        SQL_READERS = 4
+        # compiled statements kept per connection, keyed by sql text
+        SQL_STATEMENTS = 256
         
         class _hnsw:
-            # hardcoded
-            RESIZE_STEP = 5
-            MIN_DISTANCE = 0.4
             # https://qdrant.tech/documentation/guides/configuration/
-            M = 16
-            EF_CONSTRUCTION = 100
+            M = Toml.Spec("storage.hnsw.m", 16)
+            M_LIMIT = _min_max(2, 100)
+            EF_CONSTRUCTION = Toml.Spec("storage.hnsw.ef_construction", 100)
+            EF_CONSTRUCTION_LIMIT = _min_max(10, 2000)
             #https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
-            K = 1
-            EF_SEARCH = 3
+            # hnswlib searches with max(ef, k); can be changed at runtime with Vector.tune
+            EF_SEARCH = Toml.Spec("storage.hnsw.ef_search", 3)
+            EF_SEARCH_LIMIT = _min_max(1, 2000)
+            # SHARDED backend; shards kept loaded, least recently used ones not in use are closed past this
+            # once a query over all sources is made all stay loaded; each such query needs every shard
+            SHARDS_OPEN = Toml.Spec("storage.hnsw.shards_open", 16)
+            SHARDS_OPEN_LIMIT = _min_max(1, 1024)
+
+            # hardcoded
+            INIT_SIZE = 1024
+            # max_elements grows by this factor; resize reallocates the whole graph so keep it rare
+            GROWTH = 1.5
+            # vectors per add_items; enough work for hnswlib's parallel insert
+            ADD_BATCH = 4096
+            # delta log size in bytes that triggers a background snapshot rewrite
+            CHECKPOINT_SIZE = 67108864
+            # share of deleted entries in graph that triggers a background compaction
+            COMPACT_RATIO = 0.25
+            # exact search over the ids a filter allows costs ~ their count, a filtered graph walk ~ 1 / their share;
+            # filters with allowed^2 <= FILTER_EXACT * entries skip the graph (see bench/filter.py)
+            FILTER_EXACT = 200
+            # exact search of many queries at once splits them so each queries x entries distance matrix stays under this
+            EXACT_BATCH = 16777216
+            # quantized rows converted to float32 at a time for a matrix product; small enough to stay in cache
+            DECODE_BATCH = 1024
         HNSW = _hnsw
+
+        class _lexical:
+            # skip embedding the query when bm25 alone is decisive
+            FIRST = Toml.Spec("storage.lexical_first", True)
+
+            # hardcoded
+            # best bm25 score must be this many times the runner-up to be decisive
+            MARGIN = 2.0
+            # hits taken from each of bm25 and hnsw before fusing
+            CANDIDATES = 20
+            # https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+            RRF_K = 60
+        LEXICAL = _lexical
     STORAGE = _storage
 
     class _llama:
@@ -80,20 +167,25 @@ class Config:
 
         class _embedding:
             MODEL = Toml.Spec("llm.embedding.model")
+            # each worker needs a few threads to be worthwhile; 1 worker embeds in-process
+            WORKERS = Toml.Spec("llm.embedding.workers", max(1, _cpu_count // 4))
+            WORKERS_LIMIT = _min_max(1, _cpu_count)
 
             # derived from gguf metadata
             CONTEXT = None
             SIZE = None
 
             # hardcoded
-            # https://onnxruntime.ai/_app/immutable/assets/Phi2_Int4_TokenGenerationTP.ab4c4b44.png
-            # optimal speed at batch size 4, llama cpp vs onnxruntime (1.14x)
-            BATCH_SIZE = 4
+            # max tokens per embedding batch; llama-cpp clamps this down to CONTEXT
+            # chunks are then grouped per batch by token count instead of a fixed chunk count
+            BATCH_LIMIT = 32768
         EMBEDDING = _embedding
     LLAMA = _llama
 
     class _chunk:
         SEPARATOR = Toml.Spec("document.separator")
+        # hardcoded
+        READ_SIZE = 1048576 # chars per FileStream block read
         SCRIPT = Toml.Spec("document.script", None, lambda x: DocumentScript[x])
 
         SIZE_LIMIT = _min_max(20, None) # no MAX; computed from EMBEDDING.CONTEXT
@@ -117,6 +209,8 @@ class Config:
         # hardcoded
         ENDPOINT = "/ws"
         HTML_SERVE_SIZE = 20480
+        # seconds a query waits for others right behind it to be retrieved in the same batch
+        BATCH_WAIT = 0.005
 
         class _header:
             # hardcoded
@@ -177,6 +271,14 @@ class Config:
 
             minmax_validate(Config.CHUNK.OVERLAP, Config.CHUNK.OVERLAP_LIMIT, "[document.chunk] overlap")
             minmax_validate(Config.CHUNK.SIZE, Config.CHUNK.SIZE_LIMIT, "[document.chunk] size")
+            minmax_validate(Config.LLAMA.EMBEDDING.WORKERS, Config.LLAMA.EMBEDDING.WORKERS_LIMIT, "[llm.embedding] workers")
+            minmax_validate(Config.STORAGE.TOP_K, Config.STORAGE.TOP_K_LIMIT, "[storage] top_k")
+            minmax_validate(Config.STORAGE.MAX_DISTANCE, Config.STORAGE.MAX_DISTANCE_LIMIT, "[storage] max_distance")
+            minmax_validate(Config.STORAGE.RERANK, Config.STORAGE.RERANK_LIMIT, "[storage] rerank")
+            minmax_validate(Config.STORAGE.HNSW.M, Config.STORAGE.HNSW.M_LIMIT, "[storage.hnsw] m")
+            minmax_validate(Config.STORAGE.HNSW.EF_CONSTRUCTION, Config.STORAGE.HNSW.EF_CONSTRUCTION_LIMIT, "[storage.hnsw] ef_construction")
+            minmax_validate(Config.STORAGE.HNSW.EF_SEARCH, Config.STORAGE.HNSW.EF_SEARCH_LIMIT, "[storage.hnsw] ef_search")
+            minmax_validate(Config.STORAGE.HNSW.SHARDS_OPEN, Config.STORAGE.HNSW.SHARDS_OPEN_LIMIT, "[storage.hnsw] shards_open")
 
             if not str(Config.RELAY.AGENT_NAME).isalnum():
                 raise ValueError("[relay] agent_name must be alphanumeric only.")
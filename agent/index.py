@@ -0,0 +1,1667 @@
+import os
+import copy
+import shutil
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Callable
+import numpy as np
+
+from agent.config import Config, Backend, Quantization
+from agent.c_wrapper import Hnsw
+
+class IdFilter:
+    """
+    ids a query is restricted to\n
+    sorted array for vectorized lookups; called with a label it is also an hnswlib filter callback\n
+    sources: the sources ids are all of, if known; lets ShardedIndex pick shards instead
+    """
+    def __init__(self, ids: np.ndarray, sources: Iterable[str]=None):
+        self.ids = np.unique(np.asarray(ids, dtype=np.uint64))
+        self.sources = None if sources is None else list(sources)
+        self._set: set[int] = None # built on first callback
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __call__(self, id: int) -> bool:
+        if self._set is None:
+            self._set = set(self.ids.tolist())
+        return id in self._set
+
+
+class Index:
+    """
+    vectors keyed by sql row id, searched by cosine distance\n
+    backends: HnswIndex, FlatIndex, ShardedIndex, QdrantIndex; see open_index\n
+    source: name the rows are grouped under in sql; only ShardedIndex uses it
+    """
+    def __init__(self, dim: int):
+        self._dim = dim
+
+    @property
+    def dim(self) -> int:
+        return self._dim
+
+    @property
+    def element_count(self) -> int:
+        """
+        entries held, including deleted ones not yet compacted away
+        """
+        raise NotImplementedError
+
+    @property
+    def busy(self) -> bool:
+        """
+        checkpoint or compaction running in background
+        """
+        return False
+
+    def ids(self) -> list[int]:
+        raise NotImplementedError
+
+    @property
+    def last_id(self) -> int:
+        """
+        largest id held, 0 if none
+        """
+        return max(self.ids(), default=0)
+
+    def fit(self, count: int, source=""):
+        """
+        hint that count more entries are about to be added
+        """
+        pass
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray, source=""):
+        raise NotImplementedError
+
+    def delete(self, ids: list[int], source=""):
+        raise NotImplementedError
+
+    def drop(self, source: str, ids: list[int]):
+        """
+        delete all entries of source; ids are all of them
+        """
+        self.delete(ids, source)
+
+    def query(self, data: list[float], k=1, filter: IdFilter=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        up to k nearest (ids, distances) of a single vector, nearest first\n
+        filter: only ids in it are returned
+        """
+        raise NotImplementedError
+
+    def query_many(self, data: np.ndarray, k=1, filter: IdFilter=None) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        query of each row of data, searched in one call where the backend can\n
+        returns: (ids, distances) per row
+        """
+        return [self.query(row, k, filter) for row in data]
+
+    def tune(self, ef: int):
+        """
+        search breadth of approximate queries from now on; exact backends ignore it\n
+        graphs loaded or built later take Config.STORAGE.HNSW.EF_SEARCH
+        """
+        pass
+
+    def commit(self):
+        """
+        make changes since last commit durable
+        """
+        pass
+
+    def rollback(self):
+        """
+        discard changes since last commit
+        """
+        pass
+
+    def checkpoint(self):
+        pass
+
+    def rebuild(self, batches: Iterable[tuple[np.ndarray, np.ndarray, list[str]]], count: int):
+        """
+        replace all entries with batches of (vectors, ids, source of each)\n
+        count: total number of vectors in batches
+        """
+        raise NotImplementedError
+
+    def compact(self, live: list[int]) -> bool:
+        """
+        drop deleted entries in background, keeping only live ids\n
+        returns: False if nothing was started
+        """
+        return False
+
+    def wait(self):
+        """
+        block until background work is done
+        """
+        pass
+
+    def close(self):
+        """
+        wait for background work and release files
+        """
+        pass
+
+def open_index(dim: int) -> Index:
+    """
+    index of Config.STORAGE.BACKEND
+    """
+    if Config.STORAGE.BACKEND == Backend.FLAT:
+        return FlatIndex(Config.STORAGE.INDEX + ".flat", dim)
+    elif Config.STORAGE.BACKEND == Backend.SHARDED:
+        return ShardedIndex(Config.STORAGE.INDEX + ".shards", dim)
+    elif Config.STORAGE.BACKEND == Backend.QDRANT:
+        # needs httpx and a qdrant binary; only import when used
+        from agent.qdrant import QdrantIndex
+        return QdrantIndex(dim)
+    else:
+        return HnswIndex(Config.STORAGE.INDEX, dim)
+
+
+
+class _Rows:
+    """
+    state of _Vectors; swapped as a whole so a query never sees half of a remap\n
+    readers work on a shallow copy taken under _Vectors._lock; writers only fill rows past len in place,
+    anything a copy can see is replaced by new arrays instead
+    """
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray, dim: int, size: int, codes: np.ndarray=None, scales: np.ndarray=None):
+        # read from file, sorted by id; deletes only clear live
+        self.base_ids = ids
+        self.base_vectors = vectors
+        # quantized base_vectors searched instead of them, None if not quantized; scales of INT8 only
+        self.base_codes = codes
+        self.base_scales = scales
+        self.live = np.ones(len(ids), dtype=bool)
+        self.base_count = len(ids)
+        # added since, in memory; deletes close the gaps in new arrays
+        self.ids = np.empty(size, dtype=np.uint64)
+        self.vectors = np.empty((size, dim), dtype=np.float32)
+        self.len = 0
+        self.rows: dict[int, int] = {} # id: row
+        self.order: np.ndarray = None # argsort of ids[:len], built on demand and dropped on change
+
+
+class _Vectors:
+    """
+    normalized float32 vectors by id\n
+    read from a memory mapped file, plus rows added since kept in memory until the next save;
+    opening costs nothing regardless of size and processes on one machine share the page cache\n
+    quantized, exact search scans a quantized copy of the file's vectors and only reads full precision ones of its
+    best candidates
+    """
+    _MAGIC = b"VEC1"
+    # magic, count, dim, quantization; followed by count uint64 ids sorted, count float32 vectors,
+    # then if quantized count codes (float16 or int8) padded to 8 bytes, and count float32 scales of INT8
+    _HEADER = struct.Struct("<4sQII")
+    _OFFSET = 64 # header padded so the arrays after it stay aligned
+    # in header; files from before quantization have 0 in the padding
+    _QUANTIZATION = {Quantization.NONE: 0, Quantization.FLOAT16: 1, Quantization.INT8: 2}
+    _CODE = {Quantization.FLOAT16: np.float16, Quantization.INT8: np.int8}
+
+    def __init__(self, dim: int, quantization=Quantization.NONE):
+        """
+        quantization: of the vectors exact search scans; Config.STORAGE.QUANTIZATION where exact search is all there is
+        """
+        self._dim = dim
+        self._quantization = quantization
+        # held while publishing a change to _rows and while copying it in _view; writers are serialized by their index
+        self._lock = threading.Lock()
+        self._rows = _Rows(np.empty(0, dtype=np.uint64), np.empty((0, dim), dtype=np.float32), dim, 0)
+
+    def _encode(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray | None]:
+        """
+        codes and INT8 scales of vectors
+        """
+        if self._quantization == Quantization.FLOAT16:
+            return vectors.astype(np.float16), None
+
+        # normalized, so no component is over 1; each vector gets the full int8 range
+        scales = np.maximum(np.abs(vectors).max(axis=1), np.finfo(np.float32).tiny) / 127
+        return np.rint(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def _map(self, path: str, dtype: type, offset: int, shape: tuple) -> np.ndarray:
+        if os.name == "nt":
+            # windows cannot replace a file that is mapped, which the next save does
+            return np.fromfile(path, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+    def _view(self) -> _Rows:
+        """
+        consistent copy of _rows to read from while writers go on
+        """
+        with self._lock:
+            return copy.copy(self._rows)
+
+    def _share(self, view: _Rows):
+        """
+        keep the argsort a reader built on its view if _rows has not changed since
+        """
+        with self._lock:
+            rows = self._rows
+            if rows.order is None and view.order is not None and rows.ids is view.ids and rows.len == view.len:
+                rows.order = view.order
+
+    @property
+    def count(self) -> int:
+        rows = self._view()
+        return rows.base_count + rows.len
+
+    @staticmethod
+    def peek(path: str) -> int:
+        """
+        number of vectors in file without opening it, 0 if there is none
+        """
+        if not os.path.isfile(path):
+            return 0
+        with open(path, "rb") as f:
+            return _Vectors._HEADER.unpack(f.read(_Vectors._HEADER.size))[1]
+
+    @staticmethod
+    def peek_last(path: str) -> int:
+        """
+        largest id in file without opening it, 0 if there is none
+        """
+        if (count := _Vectors.peek(path)) == 0:
+            return 0
+        with open(path, "rb") as f:
+            f.seek(_Vectors._OFFSET + (count - 1) * 8) # ids are sorted
+            return int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+
+    @property
+    def last(self) -> int:
+        """
+        largest id held, 0 if none; may be one deleted since the last save
+        """
+        rows = self._view()
+        last = [int(rows.base_ids[-1])] if len(rows.base_ids) > 0 else []
+        if rows.len > 0:
+            last.append(int(rows.ids[:rows.len].max()))
+        return max(last, default=0)
+
+    def reset(self, size: int):
+        self._rows = _Rows(np.empty(0, dtype=np.uint64), np.empty((0, self._dim), dtype=np.float32), self._dim, size)
+
+    def load(self, path: str) -> bool:
+        """
+        returns: False if there is no usable file
+        """
+        if not os.path.isfile(path):
+            return False
+
+        with open(path, "rb") as f:
+            magic, count, dim, quantization = self._HEADER.unpack(f.read(self._HEADER.size))
+        if magic != self._MAGIC or dim != self._dim:
+            return False
+
+        if count == 0:
+            self._rows = _Rows(np.empty(0, dtype=np.uint64), np.empty((0, dim), dtype=np.float32), dim, Config.STORAGE.HNSW.INIT_SIZE)
+            return True
+
+        offset = self._OFFSET + count * 8
+        ids = self._map(path, np.uint64, self._OFFSET, (count,))
+        vectors = self._map(path, np.float32, offset, (count, dim))
+
+        codes = scales = None
+        if self._quantization == Quantization.NONE:
+            pass
+        elif quantization == self._QUANTIZATION[self._quantization]:
+            offset += count * dim * 4
+            codes = self._map(path, self._CODE[self._quantization], offset, (count, dim))
+            if self._quantization == Quantization.INT8:
+                end = offset + count * dim # int8
+                scales = self._map(path, np.float32, end + -end % 8, (count,))
+        else:
+            # saved before quantization was set or changed; quantized in memory until the next save writes them
+            coded = [self._encode(vectors[i:i + Config.STORAGE.HNSW.DECODE_BATCH]) for i in range(0, count, Config.STORAGE.HNSW.DECODE_BATCH)]
+            codes = np.concatenate([c[0] for c in coded])
+            if self._quantization == Quantization.INT8:
+                scales = np.concatenate([c[1] for c in coded])
+
+        self._rows = _Rows(ids, vectors, dim, Config.STORAGE.HNSW.INIT_SIZE, codes, scales)
+        return True
+
+    def save(self, path: str):
+        rows = self._view()
+        base = np.flatnonzero(rows.live)
+        ids = np.concatenate((rows.base_ids[base], rows.ids[:rows.len]))
+        # sorted for searchsorted on load; new ids are mostly past the file's, so this is mostly sequential
+        order = np.argsort(ids, kind="stable")
+        source = np.concatenate((base, np.arange(rows.len) + len(rows.base_ids)))[order]
+
+        with open(path, "wb") as f:
+            f.write(self._HEADER.pack(self._MAGIC, len(ids), self._dim, self._QUANTIZATION[self._quantization]).ljust(self._OFFSET, b"\0"))
+            f.write(ids[order].tobytes())
+
+            batch = Config.STORAGE.HNSW.ADD_BATCH
+            for i in range(0, len(source), batch):
+                f.write(self._gather(rows, source[i:i + batch]).tobytes())
+
+            if self._quantization != Quantization.NONE:
+                scales = []
+                for i in range(0, len(source), batch):
+                    codes, scale = self._encode(self._gather(rows, source[i:i + batch]))
+                    f.write(codes.tobytes())
+                    scales.append(scale)
+
+                f.write(b"\0" * (-f.tell() % 8))
+                if self._quantization == Quantization.INT8:
+                    f.write(np.concatenate(scales + [np.empty(0, dtype=np.float32)]).tobytes())
+
+    def _gather(self, rows: _Rows, source: np.ndarray) -> np.ndarray:
+        """
+        vectors by position in base followed by new rows
+        """
+        vectors = np.empty((len(source), self._dim), dtype=np.float32)
+        in_base = source < len(rows.base_ids)
+        vectors[in_base] = rows.base_vectors[source[in_base]]
+        vectors[~in_base] = rows.vectors[source[~in_base] - len(rows.base_ids)]
+        return vectors
+
+    def fit(self, count: int):
+        rows = self._rows
+        need = rows.len + count
+        if need <= len(rows.ids):
+            return
+
+        size = max(need, int(len(rows.ids) * Config.STORAGE.HNSW.GROWTH))
+        ids = np.empty(size, dtype=np.uint64)
+        vectors = np.empty((size, self._dim), dtype=np.float32)
+        ids[:rows.len] = rows.ids[:rows.len]
+        vectors[:rows.len] = rows.vectors[:rows.len]
+        # swap in whole arrays; a query running meanwhile keeps reading the old ones
+        with self._lock:
+            rows.ids, rows.vectors = ids, vectors
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        self.fit(len(ids))
+        rows = self._rows
+        end = rows.len + len(ids)
+        # past len, so no view sees them until len is published
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        rows.vectors[rows.len:end] = vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+        rows.ids[rows.len:end] = ids
+        for row, id in enumerate(ids.tolist(), rows.len):
+            rows.rows[id] = row
+        with self._lock:
+            rows.len = end
+            rows.order = None
+
+    def _locate(self, rows: _Rows, ids: np.ndarray) -> np.ndarray:
+        """
+        positions of ids in base followed by new rows, -1 where not held
+        """
+        ids = np.asarray(ids, dtype=np.uint64)
+        source = np.full(len(ids), -1, dtype=np.int64)
+
+        base = len(rows.base_ids)
+        if base > 0:
+            pos = np.minimum(np.searchsorted(rows.base_ids, ids), base - 1)
+            found = (rows.base_ids[pos] == ids) & rows.live[pos]
+            source[found] = pos[found]
+
+        if rows.len > 0:
+            new = rows.ids[:rows.len]
+            if (order := rows.order) is None or len(order) != rows.len:
+                order = rows.order = np.argsort(new)
+            pos = order[np.minimum(np.searchsorted(new, ids, sorter=order), rows.len - 1)]
+            found = new[pos] == ids
+            source[found] = base + pos[found]
+
+        return source
+
+    def _label(self, rows: _Rows, source: np.ndarray) -> np.ndarray:
+        """
+        ids at positions in base followed by new rows
+        """
+        ids = np.empty(len(source), dtype=np.uint64)
+        in_base = source < len(rows.base_ids)
+        ids[in_base] = rows.base_ids[source[in_base]]
+        ids[~in_base] = rows.ids[source[~in_base] - len(rows.base_ids)]
+        return ids
+
+    def delete(self, ids: np.ndarray):
+        """
+        ids not held are skipped
+        """
+        rows = self._rows
+        ids = np.asarray(ids, dtype=np.uint64)
+
+        pos = self._locate(rows, ids)
+        pos = np.unique(pos[(pos >= 0) & (pos < len(rows.base_ids))])
+        if len(pos) > 0:
+            # queries may be scanning the current mask
+            live = rows.live.copy()
+            live[pos] = False
+            with self._lock:
+                rows.live = live
+                rows.base_count -= len(pos)
+
+        if rows.len == 0:
+            return
+        new = [row for id in ids.tolist() if (row := rows.rows.pop(id, None)) is not None]
+        if len(new) == 0:
+            return
+
+        # close the gaps in one pass into new arrays; queries may be scanning the current ones
+        keep = np.ones(rows.len, dtype=bool)
+        keep[new] = False
+        end = rows.len - len(new)
+        vectors = np.empty_like(rows.vectors)
+        vectors[:end] = rows.vectors[:rows.len][keep]
+        kept = np.empty_like(rows.ids)
+        kept[:end] = rows.ids[:rows.len][keep]
+        with self._lock:
+            rows.ids, rows.vectors = kept, vectors
+            rows.len = end
+            rows.rows = dict(zip(kept[:end].tolist(), range(end)))
+            rows.order = None
+
+    def contains(self, ids: np.ndarray) -> np.ndarray:
+        rows = self._view()
+        found = self._locate(rows, ids) >= 0
+        self._share(rows)
+        return found
+
+    def ids(self) -> list[int]:
+        rows = self._view()
+        return rows.base_ids[rows.live].tolist() + rows.ids[:rows.len].tolist()
+
+    def items(self, ids: list[int]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        vectors of ids that are held, with their ids
+        """
+        rows = self._view()
+        ids = np.array(ids, dtype=np.uint64)
+        source = self._locate(rows, ids)
+        self._share(rows)
+        held = source >= 0
+        return self._gather(rows, source[held]), ids[held]
+
+    def search(self, data: list[float], k: int, filter: IdFilter=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        exact k nearest by cosine distance
+        """
+        return self.search_many(np.asarray(data, dtype=np.float32).reshape(1, -1), k, filter)[0]
+
+    def search_many(self, data: np.ndarray, k: int, filter: IdFilter=None) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        exact k nearest by cosine distance of each row of data; one matrix product for many rows\n
+        quantized: candidates by quantized distance, reranked at full precision unless Config.STORAGE.RERANK is 0
+        """
+        rows = self._view()
+        base = len(rows.base_ids)
+        count = base + rows.len
+
+        queries = np.asarray(data, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+
+        allowed = None
+        if filter is not None:
+            allowed = self._locate(rows, filter.ids)
+            allowed = allowed[allowed >= 0]
+            self._share(rows)
+
+        # few allowed; only compute those
+        few = allowed is not None and len(allowed) * 4 < count
+        source = allowed if few else np.arange(count)
+        if few:
+            vectors = self._gather(rows, source)
+
+        # deleted and filtered out are inf; no more than the rest are asked for
+        held = rows.base_count + rows.len if allowed is None else len(allowed)
+        k = min(k, held)
+        if k == 0:
+            return [(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float32)) for _ in range(len(queries))]
+
+        # few allowed are gathered at full precision anyway
+        quantized = rows.base_codes is not None and not few
+        rerank = quantized and Config.STORAGE.RERANK > 0
+        candidates = min(k * Config.STORAGE.RERANK, held) if rerank else k
+
+        results = []
+        step = max(1, Config.STORAGE.HNSW.EXACT_BATCH // max(len(source), 1))
+        for i in range(0, len(queries), step):
+            batch = queries[i:i + step]
+            if few:
+                dists = 1 - batch @ vectors.T
+            else:
+                dists = np.empty((len(batch), count), dtype=np.float32)
+                if quantized:
+                    decode = Config.STORAGE.HNSW.DECODE_BATCH
+                    for j in range(0, base, decode):
+                        end = min(j + decode, base)
+                        similarity = batch @ rows.base_codes[j:end].astype(np.float32).T
+                        if rows.base_scales is not None:
+                            # per vector, so applied to its similarity instead of every component
+                            similarity *= rows.base_scales[j:end]
+                        dists[:, j:end] = 1 - similarity
+                else:
+                    dists[:, :base] = 1 - batch @ rows.base_vectors.T
+                dists[:, :base][:, ~rows.live] = np.inf
+                dists[:, base:] = 1 - batch @ rows.vectors[:rows.len].T
+
+                if allowed is not None:
+                    masked = np.full(dists.shape, np.inf, dtype=np.float32)
+                    masked[:, allowed] = dists[:, allowed]
+                    dists = masked
+
+            # partial sort; only the nearest candidates need ordering
+            if candidates < dists.shape[1]:
+                found = np.argpartition(dists, candidates - 1, axis=1)[:, :candidates]
+            else:
+                found = np.broadcast_to(np.arange(dists.shape[1]), dists.shape)
+
+            if rerank:
+                # candidates are all held; their full precision vectors are a few reads from the file
+                for query, f in zip(batch, found):
+                    exact = 1 - self._gather(rows, source[f]) @ query
+                    order = np.argsort(exact)[:k]
+                    results.append((self._label(rows, source[f[order]]), exact[order]))
+                continue
+
+            nearest = np.take_along_axis(dists, found, axis=1)
+            order = np.argsort(nearest, axis=1)
+            found = np.take_along_axis(found, order, axis=1)
+            nearest = np.take_along_axis(nearest, order, axis=1)
+
+            results += [(self._label(rows, source[f]), d) for f, d in zip(found, nearest)]
+
+        return results
+
+
+class _LoggedIndex(Index):
+    """
+    index persisted as a full snapshot plus an append-only delta log\n
+    add/delete append to the log, commit appends a marker and makes them durable; the snapshot is only rewritten
+    by a background checkpoint once the log outgrows CHECKPOINT_SIZE, and never holds uncommitted changes\n
+    on load the log is replayed over the snapshot up to its last commit marker; rollback cuts the log back to it
+    and reloads\n
+    subclasses hold the entries and implement _load_snapshot, _save_snapshot, _add, _delete, _contains, _reload,
+    _rebuild and, unless they override _open, _reset
+    """
+    _NAME = ""
+    _ADD = b"A"
+    _DELETE = b"D"
+    _COMMIT = b"C" # count 0; logs from before it have none, all their records were committed
+    _HEADER = struct.Struct("<cI") # op, count; followed by count uint64 ids (+ count float32 vectors on add)
+
+    def __init__(self, path: str, dim: int):
+        super().__init__(dim)
+        self._path = path
+        self._log_path = path + ".log"
+        # held by mutations and checkpoint; entries must not change while they are being saved
+        self._lock = threading.Lock()
+        # runs checkpoint or compaction, one at a time
+        self._worker: threading.Thread = None
+        # mutations made while compaction builds the new entries, applied to them before swapping
+        self._pending: list[tuple[bytes, np.ndarray, np.ndarray]] = None
+        # set once the snapshot and log are loaded; mutations wait for it
+        self._ready = threading.Event()
+        # what loading failed with, raised to those waiting instead of the entries
+        self._error: BaseException = None
+
+        # records after the last commit marker were never committed, e.g. a create that failed or crashed
+        end, marked = self._scan()
+        if os.path.isfile(self._log_path) and end < os.path.getsize(self._log_path):
+            os.truncate(self._log_path, end)
+
+        self._open()
+        self._log = open(self._log_path, "ab")
+        if not marked:
+            # new log, or one from before markers
+            self._mark()
+        # log size as of the last commit
+        self._committed = self._log.tell()
+
+    def _open(self):
+        if self._load_snapshot():
+            if Config.DEBUG:
+                print(f"loaded {self._NAME} index")
+        else:
+            # no snapshot yet; everything is in the log, if any
+            if Config.DEBUG:
+                print(f"creating {self._NAME} index")
+            self._reset(Config.STORAGE.HNSW.INIT_SIZE)
+
+        self._replay(self._replay_add, self._delete, self._contains)
+        self._ready.set()
+
+    def _reset(self, size: int):
+        """
+        drop all entries, making room for size
+        """
+        raise NotImplementedError
+
+    def _load_snapshot(self) -> bool:
+        """
+        returns: False if there is no usable snapshot
+        """
+        raise NotImplementedError
+
+    def _save_snapshot(self, path: str):
+        raise NotImplementedError
+
+    def _saved(self):
+        """
+        called once the snapshot is in place
+        """
+        pass
+
+    def _fit(self, count: int):
+        pass
+
+    def _add(self, vectors: np.ndarray, ids: np.ndarray):
+        raise NotImplementedError
+
+    def _delete(self, ids: np.ndarray):
+        """
+        ids not held are skipped
+        """
+        raise NotImplementedError
+
+    def _contains(self, ids: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def _replay_add(self, vectors: np.ndarray, ids: np.ndarray):
+        self._fit(len(ids))
+        self._add(vectors, ids)
+
+    def _size(self, op: bytes, count: int) -> int:
+        """
+        bytes following the header of a record, -1 for an unknown op
+        """
+        if op == self._ADD:
+            return count * (8 + self._dim * 4)
+        elif op == self._DELETE:
+            return count * 8
+        elif op == self._COMMIT:
+            return 0
+        return -1
+
+    def _scan(self) -> tuple[int, bool]:
+        """
+        returns: end of the committed records in log, and whether it has commit markers
+        """
+        if not os.path.isfile(self._log_path):
+            return 0, False
+
+        total = os.path.getsize(self._log_path)
+        end = last = 0
+        marked = False
+        with open(self._log_path, "rb") as f:
+            while len(header := f.read(self._HEADER.size)) == self._HEADER.size:
+                op, count = self._HEADER.unpack(header)
+                if (size := self._size(op, count)) < 0 or f.tell() + size > total:
+                    break # torn write from a crash; nothing after it was committed
+                f.seek(size, os.SEEK_CUR)
+                last = f.tell()
+                if op == self._COMMIT:
+                    marked = True
+                    end = last
+
+        return (end if marked else last), marked
+
+    def _replay(self, add: Callable, delete: Callable, contains: Callable):
+        """
+        apply log on top of snapshot; uncommitted records were cut off on open or rollback\n
+        ids are never reused so replay is idempotent: adds already in the snapshot are skipped,
+        deletes of ids no longer held are ignored
+        """
+        if not os.path.isfile(self._log_path):
+            return
+
+        records = 0
+        with open(self._log_path, "rb") as f:
+            while len(header := f.read(self._HEADER.size)) == self._HEADER.size:
+                op, count = self._HEADER.unpack(header)
+                size = self._size(op, count)
+                body = f.read(max(size, 0))
+                if size < 0 or len(body) < size:
+                    break # marker being appended by open meanwhile
+                if op == self._COMMIT:
+                    continue
+
+                ids = np.frombuffer(body, dtype=np.uint64, count=count)
+                if op == self._ADD:
+                    vectors = np.frombuffer(body, dtype=np.float32, offset=count * 8).reshape(count, self._dim)
+                    new = ~contains(ids)
+                    add(vectors[new], ids[new])
+                else:
+                    delete(ids) # skips those already deleted in snapshot
+                records += 1
+
+        if Config.DEBUG:
+            print(f"replayed {records} {self._NAME} log records")
+
+    def _reload(self):
+        """
+        replace the entries with those in snapshot and log, e.g. after rollback cut the log
+        """
+        raise NotImplementedError
+
+    def _rebuild(self, batches: Iterable[tuple[np.ndarray, np.ndarray, list[str]]], size: int):
+        """
+        replace the entries with those in batches, built aside and swapped in once complete
+        so queries meanwhile see the old entries, not an empty or partial index
+        """
+        raise NotImplementedError
+
+    def _wait_ready(self):
+        """
+        block until loaded; raises what loading failed with
+        """
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _mark(self):
+        """
+        append a commit marker and make the log durable up to it
+        """
+        self._log.write(self._HEADER.pack(self._COMMIT, 0))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def _write(self, op: bytes, ids: np.ndarray, vectors: np.ndarray=None):
+        self._log.write(self._HEADER.pack(op, len(ids)))
+        self._log.write(ids.tobytes())
+        if vectors is not None:
+            self._log.write(vectors.tobytes())
+
+    def fit(self, count: int, source=""):
+        self._wait_ready()
+        with self._lock:
+            self._fit(count)
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray, source=""):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        ids = np.ascontiguousarray(ids, dtype=np.uint64)
+
+        self._wait_ready()
+        with self._lock:
+            self._fit(len(ids))
+            self._add(vectors, ids)
+            self._write(self._ADD, ids, vectors)
+            if self._pending is not None:
+                self._pending.append((self._ADD, ids, vectors))
+
+    def delete(self, ids: list[int], source=""):
+        ids = np.array(ids, dtype=np.uint64)
+
+        self._wait_ready()
+        with self._lock:
+            self._delete(ids)
+            self._write(self._DELETE, ids)
+            if self._pending is not None:
+                self._pending.append((self._DELETE, ids, None))
+
+    def commit(self):
+        """
+        flush log to disk; starts a background checkpoint once the log is large enough
+        """
+        self._wait_ready()
+        with self._lock:
+            if self.dirty:
+                self._mark()
+            self._committed = size = self._log.tell()
+
+        # a running compaction ends with a snapshot anyway
+        if size >= Config.STORAGE.HNSW.CHECKPOINT_SIZE and not self.busy:
+            self._worker = threading.Thread(target=self.checkpoint, name=f"{self._NAME} checkpoint")
+            self._worker.start()
+
+    @property
+    def busy(self) -> bool:
+        return self._worker is not None and self._worker.is_alive()
+
+    def rollback(self):
+        """
+        cut the log back to the last commit and reload the entries from snapshot and log
+        """
+        self.wait() # compaction may hold uncommitted changes in its pending list
+        with self._lock:
+            if not self.dirty:
+                return
+            if Config.DEBUG:
+                print(f"rolling back {self._NAME} index")
+
+            self._log.truncate(self._committed)
+            self._log.seek(self._committed)
+            self._reload()
+
+    @property
+    def dirty(self) -> bool:
+        """
+        changes since the last commit
+        """
+        return self._log.tell() > self._committed
+
+    @property
+    def log_size(self) -> int:
+        """
+        bytes logged since the last snapshot
+        """
+        return self._log.tell() - self._HEADER.size # marker it starts with
+
+    def _snapshot(self):
+        """
+        atomically replace snapshot with the current entries, then empty the log\n
+        a crash before the log is emptied only means it gets replayed over a snapshot that already has it\n
+        caller makes sure there are no uncommitted changes; rollback could not take them out of the snapshot
+        """
+        tmp = self._path + ".tmp"
+        self._save_snapshot(tmp)
+        _replace(tmp, self._path)
+
+        self._log.truncate(0)
+        self._log.seek(0)
+        self._mark()
+        self._committed = self._log.tell()
+        self._saved()
+
+    def checkpoint(self):
+        """
+        skipped while there are uncommitted changes; the next commit starts one again if the log is large
+        """
+        self._wait_ready()
+        with self._lock:
+            if self.dirty:
+                return
+            if Config.DEBUG:
+                print(f"checkpointing {self._NAME} index")
+            self._snapshot()
+
+    def rebuild(self, batches: Iterable[tuple[np.ndarray, np.ndarray, list[str]]], count: int):
+        self.wait() # a compaction finishing afterwards would swap its entries over these
+
+        with self._lock:
+            if Config.DEBUG:
+                print(f"rebuilding {self._NAME} index")
+
+            # not logged; goes straight into the snapshot below
+            self._rebuild(batches, max(count, Config.STORAGE.HNSW.INIT_SIZE))
+            self._snapshot()
+
+    def wait(self):
+        self._wait_ready()
+        if self._worker is not None:
+            self._worker.join()
+
+    def close(self):
+        self._ready.wait() # closes even if loading failed
+        if self._worker is not None:
+            self._worker.join()
+        self._log.close()
+
+
+def _replace(tmp: str, path: str):
+    """
+    durably move fsync'ed tmp over path
+    """
+    with open(tmp, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    # make the rename durable; not supported on windows
+    if os.name != "nt":
+        dir = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir)
+        finally:
+            os.close(dir)
+
+
+class _RwLock:
+    """
+    any number of readers or one writer; a waiting writer holds off new readers so queries cannot starve it\n
+    with lock.read: / with lock.write:
+    """
+    class _Side:
+        def __init__(self, acquire: Callable, release: Callable):
+            self._acquire = acquire
+            self._release = release
+
+        def __enter__(self):
+            self._acquire()
+
+        def __exit__(self, type, value, traceback):
+            self._release()
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting = 0 # writers
+        self.read = _RwLock._Side(self._acquire_read, self._release_read)
+        self.write = _RwLock._Side(self._acquire_write, self._release_write)
+
+    def _acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting > 0:
+                self._cond.wait()
+            self._readers += 1
+
+    def _release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def _acquire_write(self):
+        with self._cond:
+            self._waiting += 1
+            while self._writer or self._readers > 0:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = True
+
+    def _release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class HnswIndex(_LoggedIndex):
+    """
+    approximate search over an hnswlib graph\n
+    deleted entries stay in the graph as tombstones until compact builds a clean one\n
+    vectors are also kept in <path>.vectors, which opens instantly; the graph loads in background
+    and until then queries are answered by exact search over the vectors
+    """
+    _NAME = "hnsw"
+
+    def __init__(self, path: str, dim: int):
+        self._hnsw: Hnsw = None
+        # hnswlib does not guard resize, or a swapped in graph, against queries running on it
+        # queries read; resize, add, mark deleted and swapping write
+        self._graph = _RwLock()
+        # never quantized; the graph holds float32 copies of them all anyway, codes would only add a third
+        self._store = _Vectors(dim)
+        self._vectors_path = path + ".vectors"
+        super().__init__(path, dim)
+
+    def _open(self):
+        if not self._store.load(self._vectors_path) and os.path.isfile(self._path):
+            # graph saved before vectors were kept next to it; load it now and write them out
+            self._load_graph()
+            live = [id for id in self._hnsw.ids() if self._has(id)]
+            batch = Config.STORAGE.HNSW.ADD_BATCH
+            self._store.reset(len(live))
+            for i in range(0, len(live), batch):
+                ids = np.array(live[i:i + batch], dtype=np.uint64)
+                self._store.add(self._hnsw.items(ids.tolist()), ids)
+            self._store.save(self._vectors_path + ".tmp")
+            _replace(self._vectors_path + ".tmp", self._vectors_path)
+            self._store.load(self._vectors_path)
+            return
+
+        # log holds at most CHECKPOINT_SIZE; replaying it over the vectors alone is quick
+        self._replay(self._store.add, self._store.delete, self._store.contains)
+        threading.Thread(target=self._load_graph, name="hnsw load").start()
+
+    def _load_graph(self):
+        try:
+            hnsw = Hnsw("cosine", self._dim)
+            try:
+                hnsw.load(self._path, allow_replace_deleted=True)
+                hnsw.ef = Config.STORAGE.HNSW.EF_SEARCH # not saved with the graph
+                if Config.DEBUG:
+                    print("loaded hnsw index")
+            except RuntimeError:
+                # no snapshot yet; everything is in the log, if any
+                if Config.DEBUG:
+                    print("creating hnsw index")
+                hnsw = self._new(Config.STORAGE.HNSW.INIT_SIZE)
+
+            def add(vectors: np.ndarray, ids: np.ndarray):
+                self._grow(hnsw, len(ids))
+                hnsw.add(vectors, ids, replace_deleted=True)
+
+            existing = set(hnsw.ids())
+            self._replay(add, lambda ids: self._tombstone(hnsw, ids),
+                lambda ids: np.array([id in existing for id in ids.tolist()], dtype=bool)
+            )
+            # built aside; after a rollback, queries keep using the previous graph until here
+            with self._graph.write:
+                self._hnsw = hnsw
+        except BaseException as e:
+            # e.g. out of memory or a corrupt graph; mutations would diverge from the vectors, queries stay exact
+            self._error = e
+            raise
+        finally:
+            # those waiting get the error instead of hanging
+            self._ready.set()
+
+    def _has(self, id: int) -> bool:
+        """
+        id is in graph and not marked deleted
+        """
+        try:
+            with self._graph.read:
+                self._hnsw.items([id])
+            return True
+        except RuntimeError:
+            return False
+
+    @property
+    def element_count(self) -> int:
+        if not self.loaded:
+            return self._store.count # live ones only until the graph is there
+        with self._graph.read:
+            return self._hnsw.element_count
+
+    @property
+    def loaded(self) -> bool:
+        """
+        graph is loaded; queries before, or if loading failed, are exact searches over the vectors
+        """
+        return self._ready.is_set() and self._error is None
+
+    @property
+    def tombstones(self) -> int:
+        """
+        deleted entries still in graph
+        """
+        return self.element_count - self._store.count
+
+    def _new(self, size: int) -> Hnsw:
+        hnsw = Hnsw("cosine", self._dim)
+        hnsw.init_index(size,
+            M=Config.STORAGE.HNSW.M,
+            ef_construction=Config.STORAGE.HNSW.EF_CONSTRUCTION,
+            allow_replace_deleted=True
+        )
+        hnsw.ef = Config.STORAGE.HNSW.EF_SEARCH
+        return hnsw
+
+    def _save_snapshot(self, path: str):
+        # vectors first; replaying the log over vectors that already have it is harmless
+        self._store.save(self._vectors_path + ".tmp")
+        _replace(self._vectors_path + ".tmp", self._vectors_path)
+        self._hnsw.save(path)
+
+    def _saved(self):
+        # map the file just written instead of holding the rows in memory
+        self._store.load(self._vectors_path)
+
+    def _fit(self, count: int):
+        with self._graph.write:
+            self._grow(self._hnsw, count)
+
+    @staticmethod
+    def _grow(hnsw: Hnsw, count: int):
+        """
+        make room for count more elements, growing geometrically; caller holds the write lock of a graph in use
+        """
+        need = hnsw.element_count + count
+        if need <= hnsw.max_elements:
+            return
+
+        size = max(need, int(hnsw.max_elements * Config.STORAGE.HNSW.GROWTH))
+        if Config.DEBUG:
+            print(f"resizing hnsw index to {size}")
+        hnsw.resize(size)
+
+    def _add(self, vectors: np.ndarray, ids: np.ndarray):
+        with self._graph.write:
+            self._hnsw.add(vectors, ids, replace_deleted=True)
+        self._store.add(vectors, ids)
+
+    @staticmethod
+    def _tombstone(hnsw: Hnsw, ids: np.ndarray):
+        """
+        mark ids deleted; caller holds the write lock of a graph in use
+        """
+        # hnswlib only marks one label at a time
+        for id in ids.tolist():
+            try:
+                hnsw.delete(id)
+            except RuntimeError:
+                pass # not in graph, or already marked
+
+    def _delete(self, ids: np.ndarray):
+        with self._graph.write:
+            self._tombstone(self._hnsw, ids)
+        self._store.delete(ids)
+
+    def _reload(self):
+        store = _Vectors(self._dim)
+        if not store.load(self._vectors_path):
+            store.reset(Config.STORAGE.HNSW.INIT_SIZE)
+        self._replay(store.add, store.delete, store.contains)
+
+        # exact search over the reloaded vectors until the graph is rebuilt from snapshot and log
+        self._ready.clear()
+        self._store = store
+        threading.Thread(target=self._load_graph, name="hnsw load").start()
+
+    def _rebuild(self, batches: Iterable[tuple[np.ndarray, np.ndarray, list[str]]], size: int):
+        hnsw = self._new(size)
+        store = _Vectors(self._dim)
+        store.reset(size)
+        for vectors, ids, _ in batches:
+            self._grow(hnsw, len(ids))
+            hnsw.add(vectors, ids, replace_deleted=True)
+            store.add(vectors, ids)
+
+        with self._graph.write:
+            self._hnsw = hnsw
+            self._store = store
+
+    def ids(self) -> list[int]:
+        """
+        all labels in graph, including those marked deleted
+        """
+        self._wait_ready()
+        with self._graph.read:
+            return self._hnsw.ids()
+
+    @property
+    def last_id(self) -> int:
+        return self._store.last # without waiting for the graph
+
+    def query(self, data: list[float], k=1, filter: IdFilter=None) -> tuple[np.ndarray, np.ndarray]:
+        return self.query_many(np.asarray(data, dtype=np.float32).reshape(1, -1), k, filter)[0]
+
+    def query_many(self, data: np.ndarray, k=1, filter: IdFilter=None) -> list[tuple[np.ndarray, np.ndarray]]:
+        if not self.loaded:
+            return self._store.search_many(data, k, filter)
+
+        if filter is not None:
+            if len(filter) ** 2 <= Config.STORAGE.HNSW.FILTER_EXACT * self.element_count:
+                # cheaper than walking a graph that is mostly filtered out
+                return self._store.search_many(data, k, filter)
+            k = min(k, len(filter))
+
+        while k > 0:
+            try:
+                # rows are searched in parallel by hnswlib
+                # python filter callback holds the gil; more threads only contend for it
+                with self._graph.read:
+                    ids, dists = self._hnsw.query(data, k=k, num_threads=1 if filter is not None else -1, filter=filter)
+                return list(zip(ids, dists))
+            except RuntimeError:
+                # hnswlib raises when it finds less than k for any row, i.e. index has fewer live entries
+                k -= 1
+
+        return [(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float32)) for _ in range(len(data))]
+
+    def tune(self, ef: int):
+        if self.loaded:
+            with self._graph.write:
+                self._hnsw.ef = ef
+
+    def compact(self, live: list[int]=None) -> bool:
+        """
+        rebuild graph in background with only the live ids, dropping tombstones\n
+        queries and mutations keep using the current graph until the new one is swapped in\n
+        live: None for the ids in vectors\n
+        returns: False if a checkpoint or compaction is already running
+        """
+        self._wait_ready()
+        if self.busy:
+            return False
+
+        if live is None:
+            live = self._store.ids()
+
+        self._worker = threading.Thread(target=self._compact, args=(live,), name="hnsw compact")
+        self._worker.start()
+        return True
+
+    def _compact(self, live: list[int]):
+        with self._lock:
+            if Config.DEBUG:
+                print(f"compacting hnsw index, {self._hnsw.element_count - len(live)} tombstones")
+            self._pending = []
+
+        try:
+            new = self._new(max(len(live), Config.STORAGE.HNSW.INIT_SIZE))
+            batch = Config.STORAGE.HNSW.ADD_BATCH
+
+            for i in range(0, len(live), batch):
+                # copy under lock as mutations move rows around; build outside so others can go on
+                with self._lock:
+                    vectors, ids = self._store.items(live[i:i + batch])
+                if len(ids) > 0:
+                    new.add(vectors, ids)
+
+            with self._lock:
+                # queries see the new graph only once it has everything
+                with self._graph.write:
+                    self._hnsw = new
+                    # vectors already have these; only the new graph misses them
+                    for op, ids, vectors in self._pending:
+                        if op == self._ADD:
+                            self._grow(self._hnsw, len(ids))
+                            self._hnsw.add(vectors, ids, replace_deleted=True)
+                        else:
+                            self._tombstone(self._hnsw, ids) # some deleted before they were copied over
+                # with uncommitted changes the old snapshot and log stay; the next checkpoint writes the new graph
+                if not self.dirty:
+                    self._snapshot()
+
+                if Config.DEBUG:
+                    print(f"compacted hnsw index, {self._hnsw.element_count} entries")
+
+        finally:
+            with self._lock:
+                self._pending = None
+
+
+class FlatIndex(_LoggedIndex):
+    """
+    exact search over all vectors; one matrix-vector product per query\n
+    the snapshot is memory mapped, and deletes leave nothing behind to compact\n
+    the only backend Config.STORAGE.QUANTIZATION applies to
+    """
+    _NAME = "flat"
+
+    def __init__(self, path: str, dim: int):
+        self._store = _Vectors(dim, Config.STORAGE.QUANTIZATION)
+        super().__init__(path, dim)
+
+    @property
+    def element_count(self) -> int:
+        return self._store.count
+
+    def _reset(self, size: int):
+        self._store.reset(size)
+
+    def _load_snapshot(self) -> bool:
+        return self._store.load(self._path)
+
+    def _save_snapshot(self, path: str):
+        self._store.save(path)
+
+    def _saved(self):
+        self._store.load(self._path)
+
+    def _fit(self, count: int):
+        self._store.fit(count)
+
+    def _add(self, vectors: np.ndarray, ids: np.ndarray):
+        self._store.add(vectors, ids)
+
+    def _delete(self, ids: np.ndarray):
+        self._store.delete(ids)
+
+    def _reload(self):
+        # built aside so queries meanwhile see the old entries, not a partial reload
+        store = _Vectors(self._dim, Config.STORAGE.QUANTIZATION)
+        if not store.load(self._path):
+            store.reset(Config.STORAGE.HNSW.INIT_SIZE)
+        self._replay(store.add, store.delete, store.contains)
+        self._store = store
+
+    def _rebuild(self, batches: Iterable[tuple[np.ndarray, np.ndarray, list[str]]], size: int):
+        store = _Vectors(self._dim, Config.STORAGE.QUANTIZATION)
+        store.reset(size)
+        for vectors, ids, _ in batches:
+            store.add(vectors, ids)
+        self._store = store
+
+    def _contains(self, ids: np.ndarray) -> np.ndarray:
+        return self._store.contains(ids)
+
+    def ids(self) -> list[int]:
+        return self._store.ids()
+
+    @property
+    def last_id(self) -> int:
+        return self._store.last
+
+    def query(self, data: list[float], k=1, filter: IdFilter=None) -> tuple[np.ndarray, np.ndarray]:
+        return self._store.search(data, k, filter)
+
+    def query_many(self, data: np.ndarray, k=1, filter: IdFilter=None) -> list[tuple[np.ndarray, np.ndarray]]:
+        return self._store.search_many(data, k, filter)
+
+
+class ShardedIndex(Index):
+    """
+    one HnswIndex per source, as files under path named by a hash of the source\n
+    shards open on first use; past SHARDS_OPEN the least recently used one no thread is using is checkpointed and closed,
+    until a query over all of them is made: all then stay open, rather than being closed and reopened by each one\n
+    queries go to the shards of the filter's sources, or all, and are merged by distance\n
+    dropping a source removes its shard's files, leaving no tombstones in the others
+    """
+    def __init__(self, path: str, dim: int):
+        super().__init__(dim)
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+        # guards _open, _shards, _pins and _closing; queries may open shards from another thread
+        self._lock = threading.Lock()
+        # notified when a shard is unpinned or done closing
+        self._changed = threading.Condition(self._lock)
+        self._open: OrderedDict[str, HnswIndex] = OrderedDict() # least recently used first
+        self._shards = {f.split(".")[0] for f in os.listdir(path)}
+        # name: calls using the shard; pinned shards are not evicted or dropped under them
+        self._pins: dict[str, int] = {}
+        # evicted and still checkpointing; reopening one waits so two never use the same files
+        self._closing: set[str] = set()
+        # a query searched all shards; SHARDS_OPEN no longer applies
+        self._unfiltered = False
+        # numpy and hnswlib release the gil while searching so shards are searched in parallel
+        self._pool = ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="shard query")
+
+    @staticmethod
+    def _name(source: str) -> str:
+        return hashlib.sha1(source.encode()).hexdigest()
+
+    def _pin(self, names: list[str]) -> list[HnswIndex]:
+        """
+        shards of names, opened if needed; each must be unpinned once done with it
+        """
+        shards = []
+        with self._lock:
+            try:
+                for name in names:
+                    while name in self._closing:
+                        self._changed.wait()
+
+                    if (shard := self._open.get(name)) is None:
+                        shard = self._open[name] = HnswIndex(os.path.join(self._path, name), self._dim)
+                        self._shards.add(name)
+                    self._open.move_to_end(name)
+                    self._pins[name] = self._pins.get(name, 0) + 1
+                    shards.append(shard)
+            except BaseException:
+                self._release(names[:len(shards)])
+                raise
+
+        return shards
+
+    def _release(self, names: list[str]):
+        for name in names:
+            if (pins := self._pins[name] - 1) == 0:
+                del self._pins[name]
+            else:
+                self._pins[name] = pins
+        self._changed.notify_all()
+
+    def _unpin(self, names: list[str]):
+        """
+        done with shards of names; closes least recently used ones past SHARDS_OPEN that are no longer in use
+        """
+        evicted: list[tuple[str, HnswIndex]] = []
+        with self._lock:
+            self._release(names)
+            limit = len(self._shards) if self._unfiltered else Config.STORAGE.HNSW.SHARDS_OPEN
+            for name in list(self._open):
+                if len(self._open) <= limit:
+                    break
+                # uncommitted changes would be lost on close, and rollback could not reach them
+                if name not in self._pins and not self._open[name].dirty:
+                    evicted.append((name, self._open.pop(name)))
+                    self._closing.add(name)
+
+        for name, shard in evicted:
+            try:
+                self._close(shard)
+            finally:
+                with self._lock:
+                    self._closing.discard(name)
+                    self._changed.notify_all()
+
+    def _close(self, shard: HnswIndex):
+        # reopens from the mapped vectors without replaying a log
+        if shard.log_size > 0:
+            shard.checkpoint()
+        shard.close()
+
+    def _opened(self) -> tuple[list[str], list[HnswIndex]]:
+        """
+        names and shards open now, pinned; unpin the names once done
+        """
+        with self._lock:
+            names = list(self._open)
+            for name in names:
+                self._pins[name] = self._pins.get(name, 0) + 1
+            return names, [self._open[name] for name in names]
+
+    def _take(self) -> list[HnswIndex]:
+        """
+        close all shards once no call is using them; must not be called while holding a pin
+        """
+        with self._lock:
+            while len(self._pins) > 0 or len(self._closing) > 0:
+                self._changed.wait()
+            opened = list(self._open.values())
+            self._open.clear()
+        return opened
+
+    @property
+    def element_count(self) -> int:
+        names, opened = self._opened()
+        try:
+            closed = self._shards - set(names)
+            # closed shards were checkpointed, so their vectors file has them all
+            return sum(s.element_count for s in opened) + \
+                sum(_Vectors.peek(os.path.join(self._path, name + ".vectors")) for name in closed)
+        finally:
+            self._unpin(names)
+
+    @property
+    def busy(self) -> bool:
+        names, opened = self._opened()
+        try:
+            return any(s.busy for s in opened)
+        finally:
+            self._unpin(names)
+
+    def ids(self) -> list[int]:
+        ids = []
+        for name in list(self._shards):
+            shard, = self._pin([name])
+            try:
+                ids += shard.ids()
+            finally:
+                self._unpin([name])
+        return ids
+
+    @property
+    def last_id(self) -> int:
+        names, opened = self._opened()
+        try:
+            last = max((s.last_id for s in opened), default=0)
+            for name in self._shards - set(names):
+                path = os.path.join(self._path, name)
+                if os.path.isfile(path + ".log") and os.path.getsize(path + ".log") > _LoggedIndex._HEADER.size:
+                    # not checkpointed, e.g. after a crash; its log has entries the vectors file does not
+                    shard, = self._pin([name])
+                    try:
+                        last = max(last, shard.last_id)
+                    finally:
+                        self._unpin([name])
+                else:
+                    last = max(last, _Vectors.peek_last(path + ".vectors"))
+            return last
+        finally:
+            self._unpin(names)
+
+    def fit(self, count: int, source=""):
+        name = self._name(source)
+        shard, = self._pin([name])
+        try:
+            shard.fit(count)
+        finally:
+            self._unpin([name])
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray, source=""):
+        name = self._name(source)
+        shard, = self._pin([name])
+        try:
+            shard.add(vectors, ids)
+        finally:
+            self._unpin([name])
+
+    def delete(self, ids: list[int], source=""):
+        name = self._name(source)
+        shard, = self._pin([name])
+        try:
+            shard.delete(ids)
+            if shard.tombstones >= shard.element_count * Config.STORAGE.HNSW.COMPACT_RATIO:
+                shard.compact()
+        finally:
+            self._unpin([name])
+
+    def drop(self, source: str, ids: list[int]):
+        name = self._name(source)
+        with self._lock:
+            # queries still searching it would read removed files
+            while name in self._pins or name in self._closing:
+                self._changed.wait()
+            shard = self._open.pop(name, None)
+            self._shards.discard(name)
+
+        if shard is not None:
+            shard.close()
+        for ext in ["", ".log", ".vectors"]:
+            if os.path.isfile(path := os.path.join(self._path, name + ext)):
+                os.remove(path)
+
+    def query(self, data: list[float], k=1, filter: IdFilter=None) -> tuple[np.ndarray, np.ndarray]:
+        return self.query_many(np.asarray(data, dtype=np.float32).reshape(1, -1), k, filter)[0]
+
+    def query_many(self, data: np.ndarray, k=1, filter: IdFilter=None) -> list[tuple[np.ndarray, np.ndarray]]:
+        if filter is not None and filter.sources is not None:
+            # every id of a source is in its shard; no need to filter within
+            names = [n for n in map(self._name, filter.sources) if n in self._shards]
+            filter = None
+        else:
+            names = list(self._shards)
+            # the next one would close and reopen all past SHARDS_OPEN again
+            self._unfiltered = True
+
+        shards = self._pin(names)
+        try:
+            return self._query(shards, data, k, filter)
+        finally:
+            self._unpin(names)
+
+    def _query(self, shards: list[HnswIndex], data: np.ndarray, k: int, filter: IdFilter) -> list[tuple[np.ndarray, np.ndarray]]:
+        if len(shards) == 0:
+            return [(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float32)) for _ in range(len(data))]
+        elif len(shards) == 1:
+            return shards[0].query_many(data, k, filter)
+
+        if all(s.loaded for s in shards):
+            # a graph query takes tens of usec, less than handing it to another thread
+            results = [s.query_many(data, k, filter) for s in shards]
+        else:
+            # exact searches until graphs load take ms each
+            results = list(self._pool.map(lambda s: s.query_many(data, k, filter), shards))
+
+        merged = []
+        for row in zip(*results):
+            ids = np.concatenate([r[0] for r in row])
+            dists = np.concatenate([r[1] for r in row])
+            order = np.argsort(dists, kind="stable")[:k]
+            merged.append((ids[order], dists[order]))
+        return merged
+
+    def commit(self):
+        names, opened = self._opened()
+        try:
+            for shard in opened:
+                shard.commit()
+        finally:
+            self._unpin(names)
+
+    def rollback(self):
+        # shards with uncommitted changes are never evicted, so all are open
+        names, opened = self._opened()
+        try:
+            for shard in opened:
+                shard.rollback()
+        finally:
+            self._unpin(names)
+
+    def checkpoint(self):
+        names, opened = self._opened()
+        try:
+            for shard in opened:
+                shard.checkpoint()
+        finally:
+            self._unpin(names)
+
+    def rebuild(self, batches: Iterable[tuple[np.ndarray, np.ndarray, list[str]]], count: int):
+        """
+        shards are built aside in another directory; queries use the current ones until it replaces them
+        """
+        if Config.DEBUG:
+            print("rebuilding hnsw shards")
+
+        building = self._path + ".rebuild"
+        shutil.rmtree(building, ignore_errors=True) # left by an interrupted rebuild
+        new = ShardedIndex(building, self._dim)
+        try:
+            for vectors, ids, sources in batches:
+                sources = np.array(sources)
+                for source in np.unique(sources):
+                    mask = sources == source
+                    new.add(vectors[mask], ids[mask], str(source))
+            new.commit()
+        finally:
+            new.close() # checkpoints every shard
+        new._pool.shutdown()
+
+        old = self._path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        with self._lock:
+            while len(self._pins) > 0 or len(self._closing) > 0:
+                self._changed.wait()
+            # discarded, no checkpoint; nothing can open a shard until the new ones are in place
+            for shard in self._open.values():
+                shard.close()
+            self._open.clear()
+            # a crash in between leaves no shards; the next open fills them from the stored vectors
+            os.replace(self._path, old)
+            os.replace(building, self._path)
+            self._shards = new._shards
+        shutil.rmtree(old)
+
+    def tune(self, ef: int):
+        # closed shards take it from Config when loaded
+        names, opened = self._opened()
+        try:
+            for shard in opened:
+                shard.tune(ef)
+        finally:
+            self._unpin(names)
+
+    def compact(self, live: list[int]) -> bool:
+        """
+        compact open shards with tombstones, each from its own live vectors
+        """
+        started = False
+        names, opened = self._opened()
+        try:
+            for shard in opened:
+                if shard.tombstones > 0:
+                    started = shard.compact() or started
+        finally:
+            self._unpin(names)
+        return started
+
+    def wait(self):
+        names, opened = self._opened()
+        try:
+            for shard in opened:
+                shard.wait()
+        finally:
+            self._unpin(names)
+
+    def close(self):
+        for shard in self._take():
+            self._close(shard)
@@ -0,0 +1,174 @@
+import os
+import glob
+import time
+from typing import Iterable, Iterator
+
+from agent.config import Config
+from agent.chunker import Chunker, ChunkerPool, FileStream, estimate_chunks
+from agent.llm import Embedding, EmbeddingPool
+from agent.storage import Vector
+from common.pipeline import Pipeline
+
+MANIFEST_PREFIX = "@"
+
+def ingest(paths: list[str], src: str, append=False):
+    """
+    pipelined Vector.create(Embedding(Chunker(file)), src) over all files in paths, under one src\n
+    paths: files, directories (recursive), globs or @manifest (file listing any of these per line)\n
+    append: keep chunks of src not found in paths, otherwise they are deleted\n
+    chunks already in src (same content hash) are not embedded again\n
+    file reading, chunking, embedding and storing run concurrently
+    """
+    files = resolve(paths)
+    progress = _Progress(len(files))
+    existing = Vector.hashes(src)
+    dedup = _Dedup(existing)
+    pipe = Pipeline()
+
+    # size index once up front; skipped on re-create as most chunks are likely unchanged
+    estimate = 0
+    if len(existing) == 0:
+        estimate = estimate_chunks(sum(os.path.getsize(f) for f in files))
+
+    # worker processes of the pools; stopped here too when storing fails or is interrupted before they run out
+    pools: list[ChunkerPool | EmbeddingPool] = []
+    skipped: list[str] = []
+    try:
+        if len(files) == 1:
+            # nothing to chunk in parallel; overlap reading with chunking instead
+            sections = pipe.stage("read", FileStream(files[0], progress=progress.read))
+            chunks = pipe.stage("chunk", dedup.filter(progress.count(Chunker(sections))))
+        else:
+            pools.append(ChunkerPool(files, progress=progress.file))
+            skipped = pools[-1].skipped
+            chunks = pipe.stage("chunk", dedup.filter(progress.count(pools[-1])))
+
+        # llama-cpp releases the GIL while embedding
+        if Config.LLAMA.EMBEDDING.WORKERS > 1:
+            pools.append(EmbeddingPool(chunks))
+            vectors = pipe.stage("embed", pools[-1])
+        else:
+            vectors = pipe.stage("embed", Embedding(chunks))
+
+        # stored on the calling thread; the sql writer is used by one thread at a time
+        pipe.run("store", vectors, lambda input: Vector.create(input, src, estimate))
+
+        removed = 0
+        if not append:
+            # chunks that disappeared from the source's files; those of skipped files too
+            removed = Vector.delete(src, keep=dedup.seen)
+    except BaseException:
+        # e.g. a file that cannot be read; the next command would otherwise commit what is stored of src so far
+        Vector.rollback()
+        raise
+    finally:
+        # pipe.run has joined the stage threads, nothing iterates the pools anymore
+        for pool in pools:
+            pool.close()
+
+    if len(files) == 1:
+        progress.file(0) # bytes were counted as read
+    progress.print(end=True)
+    if len(skipped) > 0:
+        print(f"skipped {len(skipped)} files that are not text: {", ".join(skipped)}")
+    print(f"embedded {dedup.added}, unchanged {dedup.unchanged}, removed {removed} chunks")
+    pipe.print_stats()
+
+def resolve(paths: list[str]) -> list[str]:
+    """
+    expand paths to files, in given order and without duplicates
+    """
+    ret: dict[str, None] = {} # ordered set
+
+    for path in paths:
+        if path.startswith(MANIFEST_PREFIX):
+            with open(path[len(MANIFEST_PREFIX):]) as f:
+                lines = [line.strip() for line in f]
+            listed = [line for line in lines if line != "" and not line.startswith("#")]
+            if len(listed) > 0:
+                ret.update(dict.fromkeys(resolve(listed)))
+
+        elif any(c in path for c in "*?["):
+            for file in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(file):
+                    ret[file] = None
+
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                # skip hidden entries i.e. .git, .DS_Store
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                for file in sorted(files):
+                    if not file.startswith("."):
+                        ret[os.path.join(root, file)] = None
+
+        elif os.path.isfile(path):
+            ret[path] = None
+
+        else:
+            raise FileNotFoundError(f"No such file or directory: '{path}'")
+
+    if len(ret) == 0:
+        raise ValueError(f"No files found in {", ".join(paths)}.")
+
+    return list(ret)
+
+class _Dedup:
+    def __init__(self, existing: set[bytes]):
+        self._existing = existing
+        self.seen: set[bytes] = set()
+        self.added = 0
+        self.unchanged = 0
+
+    def filter(self, chunks: Iterable[str]) -> Iterator[str]:
+        """
+        only pass through chunks not yet stored (nor repeated within this run)
+        """
+        for chunk in chunks:
+            digest = Vector.digest(chunk)
+            if digest in self.seen:
+                continue
+            self.seen.add(digest)
+
+            if digest in self._existing:
+                self.unchanged += 1
+            else:
+                self.added += 1
+                yield chunk
+
+class _Progress:
+    # minimum seconds between progress line updates
+    INTERVAL = 0.25
+
+    def __init__(self, files: int):
+        self._files = files
+        self._done = 0
+        self._bytes = 0
+        self._chunks = 0
+        self._time = time.time()
+        self._printed = 0.0
+
+    def file(self, size: int):
+        self._done += 1
+        self.read(size)
+
+    def read(self, size: int):
+        self._bytes += size
+        self.print()
+
+    def count(self, chunks: Iterable[str]) -> Iterator[str]:
+        for chunk in chunks:
+            self._chunks += 1
+            self.print()
+            yield chunk
+
+    def print(self, end=False):
+        now = time.time()
+        if not end and now - self._printed < _Progress.INTERVAL:
+            return
+
+        self._printed = now
+        rate = self._bytes / 1048576 / max(now - self._time, 0.001)
+        print(f"\rfiles {self._done}/{self._files}, chunks {self._chunks}, {rate:.1f} MB/s",
+            end="\n" if end else "",
+            flush=True
+        )
@@ -1,9 +1,14 @@
 from typing import Iterable, Iterator
 import time
+import os
+import queue
+import multiprocessing
+import threading
 from collections import deque
 
 from agent.config import Config, PromptFormat
 from common.string import MutableString
+from common.helper import PrintColor
 from agent.llm_base import Llm
 
 class Chat:
@@ -112,6 +117,8 @@ Extract the output only, do not add anything. If no output can be found, summari
         
 class Embedding:
     _llm: Llm = None
+    # one model context; ingest and relay queries embed from different threads
+    _lock = threading.Lock()
 
     @staticmethod
     def _init():
@@ -119,6 +126,10 @@ class Embedding:
             Embedding._llm = Llm({
                 "model": Config.LLAMA.EMBEDDING.MODEL,
                 "n_ctx": 0,
+                # llama-cpp clamps batch to the context size (n_ctx 0 = model's n_ctx_train)
+                # so a full context worth of chunks is decoded in a single call
+                "n_batch": Config.LLAMA.EMBEDDING.BATCH_LIMIT,
+                "n_ubatch": Config.LLAMA.EMBEDDING.BATCH_LIMIT,
                 "embedding": True
             })
 
@@ -137,38 +148,198 @@ class Embedding:
         adhoc convert single string to vector
         """
         Embedding._init()
-        return Embedding._llm(input).embed
+        with Embedding._lock:
+            return Embedding._llm(input).embed
+
+    @staticmethod
+    def from_strings(input: list[str]) -> list[list[float]]:
+        """
+        convert list of strings to vectors in one batch call
+        """
+        Embedding._init()
+        with Embedding._lock:
+            return Embedding._llm(input).embed
+
+    @staticmethod
+    def from_many(input: list[str]) -> list[list[float]]:
+        """
+        convert any number of strings to vectors in as few batch calls as the context fits
+        """
+        vectors = []
+        for batch in _token_batches(input):
+            vectors += Embedding.from_strings(batch)
+        return vectors
 
     def __init__(self, input: Iterable[str]):
-        self._iterable = input
-        self._eof = False
+        self._batches = _token_batches(input)
+        self._count = 0
+        self._time = 0.0
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self._eof:
+        chunks = next(self._batches, None)
+        if chunks is None:
+            if Config.BENCHMARK and self._count > 0:
+                PrintColor.OK(f"embedding: {self._count} chunks, {self._time:.1f} sec @ {(self._count / self._time):.1f} chunks/sec")
             raise StopIteration
-        
-        chunks = []
-        vectors = []
 
-        for _ in range(Config.LLAMA.EMBEDDING.BATCH_SIZE):
-            chunk = next(self._iterable, None)
-            if chunk is None:
-                self._eof = True
-                break
+        t = time.time()
+        vectors = Embedding.from_strings(chunks)
+        self._time += time.time() - t
+        self._count += len(chunks)
 
-            chunks.append(chunk)
-            vectors.append(Embedding.from_string(chunk))
+        return {
+            "documents": chunks,
+            "vectors": vectors,
+            "len": len(vectors)
+        }
 
-        # handle case where current "next" just reached the end and had nothing to return
-        if len(vectors) == 0 and self._eof:
-            raise StopIteration
+class EmbeddingPool:
+    """
+    Embedding with batches fanned out to worker processes, each owning its own Llm\n
+    output is the same as Embedding and in the same order as input
+    """
+    def __init__(self, input: Iterable[str], workers: int=None):
+        if workers is None:
+            workers = Config.LLAMA.EMBEDDING.WORKERS
+
+        # spawn; forking a process with a loaded llama context is not safe
+        ctx = multiprocessing.get_context("spawn")
+        # bound batches in flight (queued, embedding or waiting to be reordered)
+        self._limit = workers * 2
+        self._in_queue = ctx.Queue(self._limit)
+        self._out_queue = ctx.Queue()
+
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        self._procs = [ctx.Process(target=_embed_worker,
+            args=(Config.LLAMA.EMBEDDING.MODEL, threads, self._in_queue, self._out_queue),
+            daemon=True
+        ) for _ in range(workers)]
+
+        for p in self._procs:
+            p.start()
+
+        self._batches = _token_batches(input)
+        self._eof = False
+        self._sent = 0 # seq of next batch to send
+        self._recv = 0 # seq of next batch to return
+        self._chunks: dict[int, list[str]] = {}
+        self._vectors: dict[int, list[list[float]]] = {}
+
+        self._count = 0
+        self._time = time.time()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self._recv not in self._vectors:
+            while not self._eof and self._sent - self._recv < self._limit:
+                chunks = next(self._batches, None)
+                if chunks is None:
+                    self._eof = True
+                else:
+                    self._chunks[self._sent] = chunks
+                    self._in_queue.put((self._sent, chunks))
+                    self._sent += 1
+
+            if self._recv == self._sent:
+                if Config.BENCHMARK and len(self._procs) > 0 and self._count > 0:
+                    t = time.time() - self._time
+                    PrintColor.OK(f"embedding ({len(self._procs)} workers): {self._count} chunks, {t:.1f} sec @ {(self._count / t):.1f} chunks/sec")
+                self.close()
+                raise StopIteration
+
+            try:
+                seq, res = self._out_queue.get(timeout=1)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._procs):
+                    self.close()
+                    raise RuntimeError("Embedding worker exited unexpectedly.")
+                continue
+
+            if isinstance(res, Exception):
+                self.close()
+                raise res
+
+            self._vectors[seq] = res
+
+        chunks = self._chunks.pop(self._recv)
+        vectors = self._vectors.pop(self._recv)
+        self._recv += 1
+        self._count += len(chunks)
 
         return {
             "documents": chunks,
             "vectors": vectors,
             "len": len(vectors)
         }
-    
\ No newline at end of file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        stop the worker processes; called on exhaustion too, and safe to call again
+        """
+        if self._eof and self._recv == self._sent:
+            # everything is embedded; workers are idle on the queue so let them exit cleanly
+            for _ in self._procs:
+                self._in_queue.put(None)
+        else:
+            # stopped midway, discard pending batches
+            for p in self._procs:
+                p.terminate()
+
+        for p in self._procs:
+            p.join()
+        self._procs = []
+
+def _embed_worker(model: str, threads: int, in_queue: multiprocessing.Queue, out_queue: multiprocessing.Queue):
+    llm = Llm({
+        "model": model,
+        "n_ctx": 0,
+        "n_batch": Config.LLAMA.EMBEDDING.BATCH_LIMIT,
+        "n_ubatch": Config.LLAMA.EMBEDDING.BATCH_LIMIT,
+        "n_threads": threads,
+        "embedding": True
+    })
+
+    while (job := in_queue.get()) is not None:
+        seq, chunks = job
+        try:
+            out_queue.put((seq, llm(chunks).embed))
+        except Exception as e:
+            out_queue.put((seq, e))
+
+    llm.close()
+
+def _token_batches(input: Iterable[str]) -> Iterator[list[str]]:
+    """
+    group chunks so that total token count of each batch fits the embedding context
+    """
+    Embedding._init()
+    budget = min(Config.LLAMA.EMBEDDING.CONTEXT, Embedding._llm.stats["n_batch"])
+
+    batch = []
+    tokens = 0
+
+    for chunk in input:
+        # chunks longer than the batch are truncated by llama-cpp
+        count = min(Embedding._llm.token_count(chunk), budget)
+
+        if tokens + count > budget and len(batch) > 0:
+            yield batch
+            batch = []
+            tokens = 0
+
+        batch.append(chunk)
+        tokens += count
+
+    if len(batch) > 0:
+        yield batch
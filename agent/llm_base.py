@@ -11,6 +11,9 @@ class Llm:
         def __init__(self, d: dict):
             self.model = ""
             self.n_ctx = 0
+            self.n_batch = 512
+            self.n_ubatch = 512
+            self.n_threads = None
             self.lora_path = None
             self.lora_scale = 1.0
             self.flash_attn = False
@@ -39,6 +42,10 @@ class Llm:
             return Llama(self._config.model,
                 n_gpu_layers=-1,
                 n_ctx=self._config.n_ctx,
+                n_batch=self._config.n_batch,
+                n_ubatch=self._config.n_ubatch,
+                n_threads=self._config.n_threads,
+                n_threads_batch=self._config.n_threads,
                 lora_path=self._config.lora_path,
                 lora_scale=self._config.lora_scale,
                 flash_attn=self._config.flash_attn,
@@ -53,7 +60,7 @@ class Llm:
 
         self._comp_text: str = None
         self._comp_chat: list = None
-        self._emb_text: str = None
+        self._emb_text: str | list[str] = None
 
         self._grammar = None
         self._benchmark = False
@@ -75,8 +82,9 @@ class Llm:
     #     "minItems": 3,
     #     "maxItems": 100
     # }
-    def __call__(self, input: str | dict, grammar: dict=None, benchmark=False) -> Self:
+    def __call__(self, input: str | list[str] | dict, grammar: dict=None, benchmark=False) -> Self:
         """
+        input list type is only for embedding; embedded as a single batch\n
         input dict type format:\n
         {
             system: str,
@@ -89,7 +97,11 @@ class Llm:
         self._grammar = grammar
         self._benchmark = benchmark
 
-        if type(input) is str:
+        if type(input) is list:
+            assert self._config.embedding
+            self._emb_text = input
+
+        elif type(input) is str:
             if self._config.embedding:
                 self._emb_text = input
             else:
@@ -157,7 +169,8 @@ class Llm:
     def stats(self) -> dict:
         return {
             "n_embd": self._llama._model.n_embd(),
-            "n_ctx_train": self._llama._model.n_ctx_train()
+            "n_ctx_train": self._llama._model.n_ctx_train(),
+            "n_batch": self._llama.n_batch
         }
     
     @property
@@ -194,7 +207,16 @@ class Llm:
     def json(self) -> any:
         return json.loads(self.static)
     
+    def token_count(self, input: str) -> int:
+        return len(self._llama.tokenize(input.encode("utf-8")))
+
     @property
-    def embed(self) -> list[float]:
+    def embed(self) -> list[float] | list[list[float]]:
+        """
+        returns: single vector if input is str, list of vectors if input is list[str]
+        """
         res = self._llama.create_embedding(self._emb_text)
-        return res["data"][0]["embedding"]
+        if type(self._emb_text) is list:
+            return [d["embedding"] for d in res["data"]]
+        else:
+            return res["data"][0]["embedding"]
@@ -1,16 +1,20 @@
 from httpx import AsyncClient, ConnectError
-import uuid
 from typing import Iterable
 from enum import Enum
+import os
+import uuid
 import sys
+import atexit
 import asyncio
+import threading
+from concurrent.futures import Future
 import subprocess
 import shlex
 import signal
+import numpy as np
 
 from agent.config import Config
-from common.helper import timestamp
-from common.decorator import benchmark
+from agent.index import Index, IdFilter
 
 _UUID0 = uuid.UUID(int=0).hex
 
@@ -93,7 +97,7 @@ class Db:
             raise DbError(f"Qdrant server returned http error: {res.status_code}")
 
 
-async def init():
+async def init(dim: int):
     for i in range(5): # 5 retries at 1 sec interval
         try:
             res = await Db.http(Db.Meth.GET, "/exists", None)
@@ -108,123 +112,220 @@ async def init():
     if res["exists"] == False:
         await Db.http(Db.Meth.PUT, "", {
             "vectors": {
-                "size": Config.LLAMA.EMBEDDING.SIZE,
+                "size": dim,
                 "distance": "Cosine"
+            },
+            "hnsw_config": {
+                "m": Config.STORAGE.HNSW.M,
+                "ef_construct": Config.STORAGE.HNSW.EF_CONSTRUCTION
             }
         })
 
-        await Db.http(Db.Meth.PUT, "/points?wait=true", {
-            "points": [{
-                "id": _UUID0,
-                "vector": [0.0] * Config.LLAMA.EMBEDDING.SIZE,
-                "payload": {
-                    "sources": []
-                }
-            }]
-        })
 
-@benchmark("db create", Config.BENCHMARK)
-async def create(input: Iterable[dict], src: str) -> bool:
+class QdrantIndex(Index):
     """
-    dict attributes:\n
-    len: int - length of list (documents / vectors)\n
-    documents: list[str] - list of text chunks\n
-    vectors: list[list[float]] - list of vectors (list[float])\n
+    index kept by a qdrant server process; point ids are sql row ids
+
+    qdrant persists and compacts by itself, so checkpoint / compact are no-ops; commit waits for pending upserts
+
+    Db is async; its calls run on a private event loop thread so the Index methods stay blocking
     """
-    count = 0
-
-    while (dv := next(input, None)) is not None:
-        points = []
-        for i in range(dv["len"]):
-            points.append({
-                "id": uuid.uuid4().hex,
-                "vector": dv["vectors"][i],
-                "payload": {
-                    "source": src,
-                    "document": dv["documents"][i]
-                }
-            })
-
-        await Db.http(Db.Meth.PUT, "/points?wait=true", {
-            "points": points
-        })
+    _SCROLL = 10000
 
-        count += len(points)
+    def __init__(self, dim: int):
+        super().__init__(dim)
 
-    return await _update_journal(src, count) # TODO rollback needed if failed?
+        path = os.path.abspath(Config.STORAGE.INDEX + ".qdrant")
+        Config.QDRANT.ENV["QDRANT__STORAGE__STORAGE_PATH"] = path
+        Config.QDRANT.ENV["QDRANT__STORAGE__SNAPSHOTS_PATH"] = os.path.join(path, "snapshots")
 
-async def read(vector: list[float]) -> str:
-    res = await Db.http(Db.Meth.POST, "/points/search", {
-        "vector": vector,
-        "with_payload": True,
-        "limit": Config.QDRANT.READ_LIMIT,
-        "score_threshold": 0.65
-    })
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="qdrant", daemon=True)
+        self._thread.start()
 
-    ret = ""
-    for hit in res:
-        if hit["payload"].get("document") is not None:
-            if ret != "":
-                ret += "\n"
-            ret += hit["payload"]["document"]
+        # qdrant searches with its ef_construct unless tuned
+        self._ef: int | None = None
 
-    return ret.strip() # in case some document are actually ""
+        # upserts are sent without waiting for qdrant to index them, on the one http client's connection pool
+        self._inflight = threading.BoundedSemaphore(Config.QDRANT.UPSERTS)
+        self._pending: list[Future] = []
+        # latest batch of add; sent by commit with wait=true, which returns once it and all before it are applied
+        self._held: tuple[np.ndarray, np.ndarray] | None = None
+        # ids added since the last commit; qdrant has no transactions, rollback deletes them
+        self._added: list[np.ndarray] = []
 
-async def list() -> list[any]:
-    """
-    returns: [{ name, count, timestamp }]
-    """
-    res = await Db.http(Db.Meth.POST, "/points", {
-        "ids": [_UUID0],
-        "with_payload": True
-    })
-
-    return res[0]["payload"]["sources"]
-
-@benchmark("db delete", Config.BENCHMARK)
-async def delete(src: str) -> bool:
-    await Db.http(Db.Meth.POST, "/points/delete?wait=true", {
-        "filter": {
-            "must": [{
-                "key": "source",
-                "match": {
-                    "value": src
-                }
-            }]
-        }
-    })
+        self._db = Db(self._run(QdrantIndex._client()))
+        self._db.start()
+        atexit.register(self.close)
+        self._run(init(dim))
 
-    return await _update_journal(src, -1) # TODO rollback needed if failed?
-    
-async def _update_journal(src: str, count: int) -> bool:
-    """
-    count: > 0, add entry to journal. duplicate src name is allowed\n
-    0 or -int, delete ALL entries with src name
-    """
-    sources = await list()
+    @staticmethod
+    async def _client() -> AsyncClient:
+        # created inside the loop it is used from
+        return AsyncClient()
+
+    def _run(self, coro) -> any:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def close(self):
+        self._db.stop()
+        self._run(self._db._client.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    @property
+    def element_count(self) -> int:
+        """
+        exact count; the collection info's points_count is approximate and includes the source journal point of older collections
+        """
+        return self._run(Db.http(Db.Meth.POST, "/points/count", {
+            "exact": True,
+            "filter": { "must_not": [{ "has_id": [_UUID0] }] }
+        }))["count"]
+
+    def ids(self) -> list[int]:
+        ids = []
+        offset = None
+        while True:
+            res = self._run(Db.http(Db.Meth.POST, "/points/scroll", {
+                "limit": QdrantIndex._SCROLL,
+                "offset": offset,
+                "with_payload": False,
+                "with_vector": False
+            }))
+            # skip the uuid source journal point of older collections
+            ids += [p["id"] for p in res["points"] if isinstance(p["id"], int)]
+            if (offset := res.get("next_page_offset")) is None:
+                return ids
+
+    @property
+    def last_id(self) -> int:
+        """
+        not looked up, it would scroll all points; a failed create deletes the points it sent on rollback
+        """
+        return 0
 
-    if count > 0:
-        sources.append({
-            "name": src,
-            "count": count,
-            "timestamp": timestamp()
+    @staticmethod
+    async def _upsert(ids: np.ndarray, vectors: np.ndarray, wait: bool):
+        await Db.http(Db.Meth.PUT, f"/points?wait={str(wait).lower()}", {
+            "batch": {
+                "ids": ids.tolist(),
+                "vectors": vectors.tolist()
+            }
         })
-    else:
-        ns = []
-        for s in sources:
-            if s["name"] != src: # filter out all (duplicated) entries
-                ns.append(s)
-        sources = ns
-
-    res = await Db.http(Db.Meth.POST, "/points/payload?wait=true", {
-        "payload": {
-            "sources": sources
-        },
-        "points": [_UUID0]
-    })
-
-    return res["status"] == "completed"
-
-async def drop(collection: str):
-    # use full path as collection name is diff!
-    await Db.http(Db.Meth.DEL, f"{Config.QDRANT.HOST}/collections/{collection}", None)
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray, source=""):
+        """
+        upserts UPSERT_BATCH points at a time, up to UPSERTS in flight; not searchable before commit
+        """
+        ids = np.asarray(ids, dtype=np.uint64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self._added.append(ids)
+
+        for i in range(0, len(ids), Config.QDRANT.UPSERT_BATCH):
+            if self._held is not None:
+                self._send(*self._held)
+            self._held = (ids[i:i + Config.QDRANT.UPSERT_BATCH], vectors[i:i + Config.QDRANT.UPSERT_BATCH])
+
+    def _send(self, ids: np.ndarray, vectors: np.ndarray):
+        """
+        upsert without waiting for it; raises the error of an earlier one that failed
+        """
+        pending = []
+        for future in self._pending:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self._pending = pending
+
+        self._inflight.acquire()
+        future = asyncio.run_coroutine_threadsafe(QdrantIndex._upsert(ids, vectors, False), self._loop)
+        future.add_done_callback(lambda _: self._inflight.release())
+        self._pending.append(future)
+
+    def _flush(self):
+        """
+        wait for sent upserts, then send the held batch with wait=true\n
+        qdrant applies updates in order, so once it returns every point added so far is searchable
+        """
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+        if self._held is not None:
+            held, self._held = self._held, None
+            self._run(QdrantIndex._upsert(*held, True))
+
+    def commit(self):
+        self._flush()
+        self._added = []
+
+    def rollback(self):
+        """
+        drop the held batch and delete points added since the last commit, sent or not; deletes are not undone
+        """
+        self._held = None
+        pending, self._pending = self._pending, []
+        added, self._added = self._added, []
+        for future in pending:
+            try:
+                future.result()
+            except Exception:
+                pass # failed upserts are what is being rolled back
+
+        if len(added) > 0:
+            self._run(Db.http(Db.Meth.POST, "/points/delete?wait=true", {
+                "points": np.concatenate(added).tolist()
+            }))
+
+    def delete(self, ids: list[int], source=""):
+        self._flush() # upserts of these ids must not land after
+        self._run(Db.http(Db.Meth.POST, "/points/delete?wait=true", {
+            "points": [int(id) for id in ids]
+        }))
+
+    def _search(self, data: list[float], k: int, filter: IdFilter | None) -> dict:
+        """
+        body of one search request
+        """
+        # source journal point of older collections
+        condition = { "must_not": [{ "has_id": [_UUID0] }] }
+        if filter is not None:
+            condition["must"] = [{ "has_id": filter.ids.tolist() }]
+
+        body = {
+            "vector": np.asarray(data, dtype=np.float32).tolist(),
+            "limit": k,
+            "with_payload": False,
+            "filter": condition
+        }
+        if self._ef is not None:
+            body["params"] = { "hnsw_ef": self._ef }
+        return body
+
+    @staticmethod
+    def _hits(res: list[dict]) -> tuple[np.ndarray, np.ndarray]:
+        ids = np.array([hit["id"] for hit in res], dtype=np.uint64)
+        # cosine score is similarity; index distances are 1 - similarity
+        dists = 1 - np.array([hit["score"] for hit in res], dtype=np.float32)
+        return ids, dists
+
+    def query(self, data: list[float], k=1, filter: IdFilter=None) -> tuple[np.ndarray, np.ndarray]:
+        return QdrantIndex._hits(self._run(Db.http(Db.Meth.POST, "/points/search", self._search(data, k, filter))))
+
+    def query_many(self, data: np.ndarray, k=1, filter: IdFilter=None) -> list[tuple[np.ndarray, np.ndarray]]:
+        # one request for all rows
+        res = self._run(Db.http(Db.Meth.POST, "/points/search/batch", {
+            "searches": [self._search(row, k, filter) for row in data]
+        }))
+        return [QdrantIndex._hits(r) for r in res]
+
+    def tune(self, ef: int):
+        self._ef = ef
+
+    def rebuild(self, batches: Iterable[tuple[np.ndarray, np.ndarray, list[str]]], count: int):
+        self._run(Db.http(Db.Meth.DEL, "", None))
+        self._run(init(self._dim))
+        for vectors, ids, _ in batches:
+            self.add(vectors, ids)
+        self.commit()
@@ -1,4 +1,5 @@
 import asyncio
+from collections import deque
 import certifi
 import ssl
 from websockets.asyncio.client import connect
@@ -30,33 +31,42 @@ async def server():
             # set name for helper.create_task.cancel_handler!
             ws.keepalive_task.set_name("keepalive")
 
+            # received but not yet handled, in order
+            inbox = deque()
+
             try:
                 while True:
-                    msg = await ws.recv()
+                    msg = inbox.popleft() if len(inbox) > 0 else await ws.recv()
                     dt = parse_type(msg, DataType)
 
                     if dt == DataType.NOTIFICATION:
                         print(Notification(json_str=msg).message)
 
                     elif dt == DataType.QUERY:
-                        query = Query(json_str=msg)
-                        vec = Embedding.from_string(query.text)
-                        ctx = Vector.read(vec)
-                        chat = Sessions.get(query.session)
-                        res = Completion.run(query.text, ctx, chat)
-
-                        print(f"{query.text}\n")
-                    
-                        for r, end in EndDefIter(res):
-                            ans = Answer()
-                            ans.id = query.id
-                            ans.word = r
-                            ans.end = end
-
-                            await ws.send(ans.json_string())
-                            PrintColor.BLUE(r, stream=True)
-                            if end:
-                                print("\n")
+                        # queries that arrived while the last answer was streamed are retrieved in one batch
+                        inbox += await _received(ws)
+                        queries = [Query(json_str=msg)] + [Query(json_str=m) for m in inbox if parse_type(m, DataType) == DataType.QUERY]
+                        inbox = deque(m for m in inbox if parse_type(m, DataType) != DataType.QUERY)
+
+                        # off the event loop on pooled sql readers; runs alongside a cli !create
+                        ctxs = await asyncio.to_thread(Vector.search_many, [q.text for q in queries], Embedding.from_many, [q.sources for q in queries])
+
+                        for query, ctx in zip(queries, ctxs):
+                            chat = Sessions.get(query.session)
+                            res = Completion.run(query.text, ctx, chat)
+
+                            print(f"{query.text}\n")
+                        
+                            for r, end in EndDefIter(res):
+                                ans = Answer()
+                                ans.id = query.id
+                                ans.word = r
+                                ans.end = end
+
+                                await ws.send(ans.json_string())
+                                PrintColor.BLUE(r, stream=True)
+                                if end:
+                                    print("\n")
 
                     elif dt == DataType.REQUEST_FILE:
                         rf = Request_File(json_str=msg)
@@ -93,6 +103,19 @@ async def server():
         print(f"Connection refused by relay ({Config.RELAY.HOST})")
 
 
+async def _received(ws) -> list[str]:
+    """
+    messages received on ws until none arrives within Config.RELAY.BATCH_WAIT
+    """
+    msgs = []
+    while True:
+        try:
+            # a timeout of 0 cancels recv before it runs even with a message queued; recv loses nothing when cancelled
+            msgs.append(await asyncio.wait_for(ws.recv(), Config.RELAY.BATCH_WAIT))
+        except TimeoutError:
+            return msgs
+
+
 class Sessions:
     _instance = None
 
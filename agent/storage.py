@@ -1,10 +1,25 @@
 import sqlite3
-from typing import Iterable
+import hashlib
+import re
+import struct
+import zlib
+import pathlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Callable
+import numpy as np
 
-from agent.config import Config
-from agent.c_wrapper import Hnsw
+from agent.config import Config, DocumentScript, Retrieval, Compression
+from agent.index import Index, IdFilter, open_index
+from common.helper import timestamp
 
 class Sql:
+    """
+    one writer connection, used by one thread at a time (cli commands, ingest), and a pool of read-only
+    connections any thread can borrow for queries; WAL lets readers run alongside a write transaction\n
+    readers only see committed rows
+    """
     _instance = None
 
     def __new__(cls):
@@ -16,18 +31,36 @@ class Sql:
     def __init__(self):
         self._conn: sqlite3.Connection = None
         self._cursor: sqlite3.Cursor = None
+        # idle readers; more are opened on demand up to SQL_READERS
+        self._readers: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._opened: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._commits = 0
+        # sqlite leaves the transaction as commit starts, readers only see its rows once it is done
+        self._committing = False
 
     def start(self):
         if Config.DEBUG:
             print("connecting to sql")
         
-        self._conn = sqlite3.Connection(Config.STORAGE.SQL)
+        # not bound to the creating thread; ingest runs off the event loop
+        self._conn = sqlite3.Connection(Config.STORAGE.SQL, check_same_thread=False, cached_statements=Config.STORAGE.SQL_STATEMENTS)
         self._cursor = self._conn.cursor()
 
+        # tuned for bulk loads: WAL + NORMAL sync only fsyncs on checkpoint, still crash-safe
+        self._cursor.execute("PRAGMA journal_mode=WAL")
+        self._cursor.execute("PRAGMA synchronous=NORMAL")
+        self._cursor.execute(f"PRAGMA cache_size=-{Config.STORAGE.SQL_CACHE_KB}")
+
     def stop(self):
         if Config.DEBUG:
             print("disconnecting from sql")
         
+        with self._lock:
+            for conn in self._opened:
+                conn.close()
+            self._opened = []
+            self._readers = queue.LifoQueue()
         self._conn.close()
 
     def __enter__(self):
@@ -36,9 +69,28 @@ class Sql:
     def __exit__(self, type, value, traceback):
         self.stop()
 
+    def _reader(self) -> sqlite3.Connection:
+        """
+        idle reader, a new one if all are busy and fewer than SQL_READERS are open, else waits for one
+        """
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._opened) < Config.STORAGE.SQL_READERS:
+                uri = pathlib.Path(Config.STORAGE.SQL).resolve().as_uri() + "?mode=ro"
+                conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=Config.STORAGE.SQL_STATEMENTS)
+                self._opened.append(conn)
+                return conn
+
+        return self._readers.get()
+
     @staticmethod
     def exec(qs: str, *args: any, lastrowid=False, fetch=False) -> int | list[any]:
         """
+        on the writer; sees its own uncommitted changes\n
         output type:
         lastrowid: return id of the last inserted row
         fetch: return queried rows
@@ -46,130 +98,678 @@ class Sql:
         """
         assert Sql._instance is not None
 
-        param = ()
-        for arg in args:
-            param += (arg,) # trailing comma for () needed to be considered a tuple!
-
         cursor = Sql._instance._cursor
-        cursor.execute(qs, param)
+        cursor.execute(qs, args)
 
         if lastrowid:
             return cursor.lastrowid
         elif fetch:
             return cursor.fetchall()
 
+    @staticmethod
+    def exec_many(qs: str, params: Iterable[tuple]):
+        """
+        run qs once per params entry in a single call
+        """
+        assert Sql._instance is not None
+        Sql._instance._cursor.executemany(qs, params)
+
+    @staticmethod
+    def read(qs: str, *args: any) -> list[any]:
+        """
+        rows queried on a pooled reader; safe to call from any thread, runs in parallel with writes and other reads
+        """
+        assert Sql._instance is not None
+
+        sql = Sql._instance
+        conn = sql._reader()
+        try:
+            return conn.execute(qs, args).fetchall()
+        finally:
+            if conn in sql._opened: # not closed by stop meanwhile
+                sql._readers.put(conn)
+
+    @staticmethod
+    def writes() -> int | None:
+        """
+        commits made on the writer so far, None while a write transaction is open\n
+        unchanged before and after a read means no write happened in between
+        """
+        assert Sql._instance is not None
+        sql = Sql._instance
+        return None if sql._conn.in_transaction or sql._committing else sql._commits
+
+    @staticmethod
+    def rollback():
+        """
+        discard the writer's uncommitted changes
+        """
+        assert Sql._instance is not None
+        Sql._instance._conn.rollback()
+
     @staticmethod
     def commit():
         assert Sql._instance is not None
-        Sql._instance._conn.commit()
+        sql = Sql._instance
+        sql._committing = True
+        try:
+            sql._conn.commit()
+        finally:
+            sql._commits += 1
+            sql._committing = False
         
 
 class Vector:
     _instance = None
+    _has_lexical = False
+    # sorted source names: their ids; dropped when one of the sources is created or deleted
+    _filters: dict[tuple[str, ...], IdFilter] = {}
+    # bumped by _forget; a filter read before it may miss the change so is not cached
+    _generation = 0
+    _lock = threading.Lock()
+    # bound variables per statement; sqlite before 3.32 allows no more than 999, a power of 2 so _padded stays within
+    _SQL_VARS = 512
     
     @staticmethod
-    def _hnsw() -> Hnsw:
+    def _index() -> Index:
         if Vector._instance is None:
-            hnsw = Hnsw("cosine", Config.LLAMA.EMBEDDING.SIZE)
-            try:
-                hnsw.load(Config.STORAGE.INDEX, allow_replace_deleted=True)
-                if Config.DEBUG:
-                    print("loaded hnsw index")
-
-            except RuntimeError:
-                # index file loading failed, initialize first then save file
-                if Config.DEBUG:
-                    print("creating hnsw index")
-                
-                hnsw.init_index(Config.STORAGE.HNSW.RESIZE_STEP,
-                    M=Config.STORAGE.HNSW.M,
-                    ef_construction=Config.STORAGE.HNSW.EF_CONSTRUCTION,
-                    allow_replace_deleted=True
-                )
-                hnsw.ef = Config.STORAGE.HNSW.EF_SEARCH
-                hnsw.save(Config.STORAGE.INDEX)
-
-            Sql.exec("CREATE TABLE IF NOT EXISTS vector(document TEXT, source TEXT)")
-            Vector._instance = hnsw
+            # first use can come from the cli and a relay query's worker thread at once
+            with Vector._lock:
+                if Vector._instance is None:
+                    Vector._open()
 
         return Vector._instance
 
     @staticmethod
-    def _save_index():
-        Vector._hnsw().save(Config.STORAGE.INDEX)
+    def _open():
+        index = open_index(Config.LLAMA.EMBEDDING.SIZE)
+
+        Sql.exec("CREATE TABLE IF NOT EXISTS vector(document TEXT, source TEXT, hash BLOB, embedding BLOB)")
+        # tables created before content hashing; rows without hash never match so get replaced on re-create
+        columns = [c[1] for c in Sql.exec("PRAGMA table_info(vector)", fetch=True)]
+        if "hash" not in columns:
+            Sql.exec("ALTER TABLE vector ADD COLUMN hash BLOB")
+        # same for stored vectors; rows without one are left out of reindex
+        if "embedding" not in columns:
+            Sql.exec("ALTER TABLE vector ADD COLUMN embedding BLOB")
+
+        # last handed out row id; start past any existing row or index label
+        Sql.exec("CREATE TABLE IF NOT EXISTS sequence(name TEXT PRIMARY KEY, value INTEGER)")
+        if len(Sql.exec("SELECT value FROM sequence WHERE name='vector'", fetch=True)) == 0:
+            last = Sql.exec("SELECT IFNULL(MAX(rowid), 0) FROM vector", fetch=True)[0][0]
+            last = max([last] + index.ids())
+            Sql.exec("INSERT INTO sequence(name, value) VALUES ('vector', ?)", last)
+            Sql.commit()
+        # a create whose sql transaction never committed, e.g. a crash after the index commit, rolled the sequence back
+        # over ids the index kept; handing them out again would add duplicates
+        Sql.exec("UPDATE sequence SET value=MAX(value, ?) WHERE name='vector'", index.last_id)
+        Sql.commit()
+
+        # every per source lookup (delete, hashes, filters) would scan the whole table without it
+        Sql.exec("CREATE INDEX IF NOT EXISTS vector_source ON vector(source)")
+
+        # per source totals, updated along with vector in _insert and delete so list does not count all rows
+        exists = len(Sql.exec("SELECT name FROM sqlite_master WHERE name='sources'", fetch=True)) > 0
+        Sql.exec("CREATE TABLE IF NOT EXISTS sources(source TEXT PRIMARY KEY, count INTEGER, bytes INTEGER, created TEXT)")
+        # preset dictionaries of compressed documents, one per source; ids are not reused as decoders cache them
+        Sql.exec("CREATE TABLE IF NOT EXISTS dictionary(id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT, data BLOB)")
+        if not exists:
+            # sources stored before it; when they were created is not known, so it is now
+            Sql.exec("INSERT INTO sources(source, count, bytes, created) SELECT source, COUNT(*), SUM(LENGTH(CAST(document AS BLOB))), ? FROM vector GROUP BY source",
+                timestamp()
+            )
+        Sql.commit()
+
+        # bm25 keyword index over vector.document, updated along with it in _insert and delete
+        # (per row triggers are ~3x slower than executemany into it)
+        # unicode61 splits words on spaces which hanzi has none of; trigram matches any 3 char substring instead
+        tokenize = "trigram" if Config.CHUNK.SCRIPT == DocumentScript.HANZI else "unicode61"
+        exists = len(Sql.exec("SELECT name FROM sqlite_master WHERE name='lexical'", fetch=True)) > 0
+        try:
+            Sql.exec(f"CREATE VIRTUAL TABLE IF NOT EXISTS lexical USING fts5(document, content='vector', tokenize='{tokenize}')")
+            if not exists:
+                # rows stored before keyword search was added
+                if len(Sql.exec("SELECT 1 FROM vector WHERE typeof(document)='blob' LIMIT 1", fetch=True)) == 0:
+                    Sql.exec("INSERT INTO lexical(lexical) VALUES ('rebuild')")
+                else:
+                    # rebuild would index compressed rows as stored
+                    Sql.exec_many("INSERT INTO lexical(rowid, document) VALUES (?,?)",
+                        [(id, Vector._decode(doc, read=False)) for id, doc in Sql.exec("SELECT rowid, document FROM vector", fetch=True)]
+                    )
+            Sql.commit()
+            Vector._has_lexical = True
+        except sqlite3.OperationalError:
+            # sqlite built without fts5 or trigram
+            if Config.DEBUG:
+                print("fts5 not available, only vector retrieval is used")
+
+        Vector._instance = index
+
+        # new or switched backend; fill it from the stored vectors instead of starting empty
+        if index.element_count == 0 and len(Sql.exec("SELECT 1 FROM vector WHERE embedding IS NOT NULL LIMIT 1", fetch=True)) > 0:
+            count, _ = Vector.reindex()
+            if Config.DEBUG:
+                print(f"filled empty index with {count} stored vectors")
+
+    @staticmethod
+    def digest(document: str) -> bytes:
+        """
+        content hash of a chunk
+        """
+        return hashlib.blake2b(document.encode("utf-8"), digest_size=16).digest()
+
+    @staticmethod
+    def hashes(src: str) -> set[bytes]:
+        _ = Vector._index() # ensure table exists
+        return {r[0] for r in Sql.exec("SELECT hash FROM vector WHERE source=?", src, fetch=True)}
     
     @staticmethod
-    def create(input: Iterable[dict], src: str):
-        hnsw = Vector._hnsw()
+    def _reserve(count: int) -> int:
+        """
+        reserve a contiguous range of count row ids\n
+        ids are never handed out twice, even after delete; hnswlib cannot re-add a label still marked deleted\n
+        the reservation is part of the create's transaction: a rollback hands the range out again, so the index must roll
+        back too, and _open moves past any ids it kept\n
+        returns: first id of the range
+        """
+        last = Sql.exec("SELECT value FROM sequence WHERE name='vector'", fetch=True)[0][0]
+        Sql.exec("UPDATE sequence SET value=? WHERE name='vector'", last + count)
+        return last + 1
 
-        while (dv := next(input, None)) is not None:
-            ids = []
-            count = dv["len"]
+    @staticmethod
+    def _insert(documents: list[str], vectors: np.ndarray, src: str) -> list[int]:
+        """
+        bulk insert documents and their float32 vectors under src\n
+        returns: row ids of the inserted documents, in order
+        """
+        first = Vector._reserve(len(documents))
+        ids = list(range(first, first + len(documents)))
 
-            for i in range(count):
-                id = Sql.exec("INSERT INTO vector(document, source) VALUES (?,?)", dv["documents"][i], src,
-                    lastrowid=True
-                )
-                ids.append(id)
-            
-            if count + hnsw.element_count >= hnsw.max_elements:
-                if Config.DEBUG:
-                    print(f"resizing hnsw index to {hnsw.max_elements + Config.STORAGE.HNSW.RESIZE_STEP}")
-                hnsw.resize(hnsw.max_elements + Config.STORAGE.HNSW.RESIZE_STEP)
+        stored = Vector._encode(documents, src)
+        Sql.exec_many("INSERT INTO vector(rowid, document, source, hash, embedding) VALUES (?,?,?,?,?)",
+            [(ids[i], stored[i], src, Vector.digest(doc), vectors[i].tobytes()) for i, doc in enumerate(documents)]
+        )
+        Sql.exec("""INSERT INTO sources(source, count, bytes, created) VALUES (?,?,?,?)
+            ON CONFLICT(source) DO UPDATE SET count=count+excluded.count, bytes=bytes+excluded.bytes""",
+            src, len(documents), sum(len(doc.encode("utf-8")) for doc in documents), timestamp()
+        )
+        if Vector._has_lexical:
+            Sql.exec_many("INSERT INTO lexical(rowid, document) VALUES (?,?)", zip(ids, documents))
+        return ids
+
+    @staticmethod
+    def _encode(documents: list[str], src: str) -> list[str] | list[bytes]:
+        """
+        documents as stored under src per COMPRESSION; the first ones compressed under src also sample its dictionary
+        """
+        if Config.STORAGE.COMPRESSION == Compression.NONE:
+            return documents
+
+        rows = Sql.exec("SELECT id, data FROM dictionary WHERE source=?", src, fetch=True)
+        if len(rows) == 0:
+            data = _Compressed.sample(documents)
+            rows = [(Sql.exec("INSERT INTO dictionary(source, data) VALUES (?,?)", src, data, lastrowid=True), data)]
+
+        return _Compressed.encode(documents, *rows[0])
 
-            hnsw.add(dv["vectors"], ids, replace_deleted=True)
+    @staticmethod
+    def _decode(document: str | bytes, read=True) -> str:
+        """
+        chunk text of a stored document\n
+        read: look up its dictionary on a pooled reader, else on the writer (uncommitted ones included)
+        """
+        def dictionary(id: int) -> bytes:
+            qs = "SELECT data FROM dictionary WHERE id=?"
+            return (Sql.read(qs, id) if read else Sql.exec(qs, id, fetch=True))[0][0]
+
+        return _Compressed.decode(document, dictionary)
+
+    @staticmethod
+    def create(input: Iterable[dict], src: str, estimate=0):
+        """
+        estimate: expected number of chunks, to size the index once up front
+        """
+        index = Vector._index()
+        buffer = _AddBuffer(index, Config.STORAGE.HNSW.ADD_BATCH, src)
+
+        # rows are only committed at the end; the whole create is a single transaction
+        try:
+            index.fit(estimate, src)
+            input = Vector._sampling(input, src)
+            while (dv := next(input, None)) is not None:
+                vectors = np.asarray(dv["vectors"], dtype=np.float32)
+                ids = Vector._insert(dv["documents"], vectors, src)
+                buffer.add(vectors, ids)
+
+            buffer.flush()
+            index.commit()
+        except BaseException:
+            # input, sql INSERT or index add failed, or interrupted: neither keeps any of it
+            Vector.rollback()
+            raise
 
         # rollback-handling:
-        # - sql INSERT fails: sql not committed, hnsw unchanged
-        # - hnsw add fails: sql not committed, TODO rollback already added vectors?
-        Vector._save_index()
+        # - sql COMMIT fails: index has the rows, sql not; TODO delete them from index?
         Sql.commit()
-            
+        Vector._forget(src)
+
     @staticmethod
-    def read(vector: list[float]) -> str:
-        hnsw = Vector._hnsw()
-        ret = ""
-        id = None
-        dist = Config.STORAGE.HNSW.MIN_DISTANCE
+    def _sampling(input: Iterable[dict], src: str) -> Iterable[dict]:
+        """
+        input, with its first batches merged until they hold DICTIONARY_SIZE bytes of text if src's dictionary is
+        yet to be sampled from them; an embedding batch is only a few KB, too little to sample it from
+        """
+        if Config.STORAGE.COMPRESSION == Compression.NONE or \
+            len(Sql.exec("SELECT 1 FROM dictionary WHERE source=? LIMIT 1", src, fetch=True)) > 0:
+            yield from input
+            return
 
-        try:
-            ids, dists = hnsw.query(vector, k=Config.STORAGE.HNSW.K)
-        except RuntimeError:
-            # hnswlib knn_query raises this when query returns nothing
-            return ret
-
-        for i in range(len(ids)):
-            if dists[i][0] < dist:
-                dist = dists[i][0]
-                id = ids[i][0]
-
-        if id is not None:
-            res = Sql.exec("SELECT document FROM vector WHERE rowid=?", id, fetch=True)
-            if len(res) == 1:
-                ret = res[0][0]
-            else:
+        held = []
+        size = 0
+        while size < Config.STORAGE.DICTIONARY_SIZE and (dv := next(input, None)) is not None:
+            held.append(dv)
+            size += sum(len(doc.encode("utf-8")) for doc in dv["documents"])
+
+        if len(held) > 0:
+            documents = [doc for dv in held for doc in dv["documents"]]
+            yield {
+                "documents": documents,
+                "vectors": np.concatenate([np.asarray(dv["vectors"], dtype=np.float32) for dv in held]),
+                "len": len(documents)
+            }
+        yield from input
+
+    @staticmethod
+    def rollback():
+        """
+        discard uncommitted sql changes and index changes since its last commit, e.g. of a failed create
+        """
+        Sql.rollback()
+        if Vector._instance is not None:
+            Vector._instance.rollback()
+
+    @staticmethod
+    def _filter(sources: list[str] | None) -> IdFilter | None:
+        """
+        ids of sources, cached until one of them changes; None searches all
+        """
+        if not sources:
+            return None
+
+        key = tuple(sorted(set(sources)))
+        if (filter := Vector._filters.get(key)) is None:
+            generation = Vector._generation
+            args = Vector._padded(key)
+            rows = Sql.read(f"SELECT rowid FROM vector WHERE source IN ({",".join("?" * len(args))})", *args)
+            filter = IdFilter(np.array([r[0] for r in rows], dtype=np.uint64), key)
+            if generation == Vector._generation:
+                Vector._filters[key] = filter
+
+        return filter
+
+    @staticmethod
+    def _forget(src: str):
+        Vector._generation += 1
+        Vector._filters = {k: v for k, v in Vector._filters.items() if src not in k}
+
+    @staticmethod
+    def _padded(args: Iterable) -> list:
+        """
+        args with the last one repeated up to a power of 2, for IN (?,..) lists; a handful of distinct
+        statements get compiled once and reused instead of one per length
+        """
+        args = list(args)
+        return args + args[-1:] * ((1 << (len(args) - 1).bit_length()) - len(args))
+
+    @staticmethod
+    def _nearest(vector: list[float], k: int, filter: IdFilter=None) -> list[int]:
+        """
+        ids of up to k nearest within MAX_DISTANCE, nearest first\n
+        index only; safe to call from another thread
+        """
+        ids, dists = Vector._index().query(vector, k=k, filter=filter)
+        return ids[dists < Config.STORAGE.MAX_DISTANCE].tolist()
+
+    @staticmethod
+    def _nearest_many(vectors: list[list[float]], k: int, filter: IdFilter=None) -> list[list[int]]:
+        """
+        _nearest of each vector in one index search
+        """
+        results = Vector._index().query_many(np.asarray(vectors, dtype=np.float32), k=k, filter=filter)
+        return [ids[dists < Config.STORAGE.MAX_DISTANCE].tolist() for ids, dists in results]
+
+    @staticmethod
+    def _match(query: str) -> str:
+        """
+        fts5 query matching any word of query; quoted so punctuation is not parsed as fts5 syntax
+        """
+        terms = re.findall(r"\w+", query)
+        if Config.CHUNK.SCRIPT == DocumentScript.HANZI:
+            # trigram tokenizer needs 3+ chars per term; split each run into overlapping trigrams
+            terms = [t[i:i + 3] for t in terms for i in range(max(1, len(t) - 2))]
+
+        return " OR ".join(f'"{t}"' for t in terms)
+
+    @staticmethod
+    def _lexical(query: str, k: int, sources: list[str]=None) -> tuple[list[int], list[float]]:
+        """
+        ids and bm25 scores of up to k best keyword matches, best first; higher score is better
+        """
+        match = Vector._match(query)
+        if match == "":
+            return [], []
+
+        if not sources:
+            rows = Sql.read("SELECT rowid, -bm25(lexical) FROM lexical WHERE lexical MATCH ? ORDER BY rank LIMIT ?", match, k)
+        else:
+            args = Vector._padded(sources)
+            rows = Sql.read(f"""SELECT rowid, -bm25(lexical) FROM lexical WHERE lexical MATCH ?
+                AND rowid IN (SELECT rowid FROM vector WHERE source IN ({",".join("?" * len(args))}))
+                ORDER BY rank LIMIT ?""", match, *args, k
+            )
+        return [r[0] for r in rows], [r[1] for r in rows]
+
+    @staticmethod
+    def _decisive(scores: list[float]) -> bool:
+        """
+        best bm25 score is MARGIN times the runner-up; a lone hit has nothing to beat, e.g. one common word matched, so is not
+        """
+        return len(scores) > 1 and scores[0] > Config.STORAGE.LEXICAL.MARGIN * scores[1]
+
+    @staticmethod
+    def _fuse(*rankings: list[int]) -> list[int]:
+        """
+        reciprocal rank fusion of id rankings, best first
+        """
+        scores = {}
+        for ranking in rankings:
+            for rank, id in enumerate(ranking):
+                scores[id] = scores.get(id, 0) + 1 / (Config.STORAGE.LEXICAL.RRF_K + rank + 1)
+
+        return sorted(scores, key=scores.get, reverse=True)
+
+    @staticmethod
+    def _documents(ids: list[int]) -> str:
+        """
+        documents of ids joined in the given order
+        """
+        return Vector._documents_many([ids])[0]
+
+    @staticmethod
+    def _documents_many(rankings: list[list[int]]) -> list[str]:
+        """
+        _documents of each list of ids, fetched together
+        """
+        ids = list({id for ranking in rankings for id in ranking})
+
+        writes = Sql.writes()
+        rows = {}
+        for i in range(0, len(ids), Vector._SQL_VARS):
+            batch = Vector._padded(ids[i:i + Vector._SQL_VARS])
+            rows.update(Sql.read(f"SELECT rowid, document FROM vector WHERE rowid IN ({",".join("?" * len(batch))})", *batch))
+        for id in ids:
+            if id not in rows and writes is not None and writes == Sql.writes():
                 # corresponding id is in index but not in sql!
-                raise SystemError(f"Data and index entry mismatch, row id: {id}")
+                raise SystemError(f"Data and index entry mismatch, row id: {id}. Run {Config.CLI_CMD_PREFIX}reindex to fix")
+        rows = {id: Vector._decode(doc) for id, doc in rows.items()}
+
+        # otherwise added to index by a create not committed yet, or deleted meanwhile
+        return ["\n\n".join(rows[id] for id in ranking if id in rows) for ranking in rankings]
+
+    @staticmethod
+    def read(vector: list[float], sources: list[str]=None) -> str:
+        """
+        sources: only search these; None or empty searches all\n
+        returns: documents of the best TOP_K matches within MAX_DISTANCE, nearest first
+        """
+        return Vector.read_many([vector], sources)[0]
+
+    @staticmethod
+    def read_many(vectors: list[list[float]], sources: list[str]=None) -> list[str]:
+        """
+        read of each vector with one index search and one sql fetch for all\n
+        sources: only search these; None or empty searches all
+        """
+        _ = Vector._index() # ensure tables exist
+        return Vector._documents_many(Vector._nearest_many(vectors, Config.STORAGE.TOP_K, Vector._filter(sources)))
+
+    @staticmethod
+    def search(query: str, embed: Callable[[str], list[float]], sources: list[str]=None) -> str:
+        """
+        documents of the best TOP_K matches for query, retrieved as per RETRIEVAL\n
+        embed: turns query into a vector; not called when a keyword match alone is decisive\n
+        sources: only search these; None or empty searches all
+        """
+        _ = Vector._index() # ensure tables exist
+        if Config.STORAGE.RETRIEVAL == Retrieval.VECTOR or not Vector._has_lexical:
+            return Vector.read(embed(query), sources)
+
+        k = Config.STORAGE.LEXICAL.CANDIDATES
+        filter = Vector._filter(sources)
+        if Config.STORAGE.LEXICAL.FIRST:
+            # bm25 costs a fraction of embedding; check it first
+            lexical, scores = Vector._lexical(query, k, sources)
+            if Vector._decisive(scores):
+                return Vector._documents(lexical[:Config.STORAGE.TOP_K])
+
+            nearest = Vector._nearest(embed(query), k, filter)
+        else:
+            # embed + index search in another thread while bm25 runs here
+            with ThreadPoolExecutor(1) as pool:
+                future = pool.submit(lambda: Vector._nearest(embed(query), k, filter))
+                lexical, _ = Vector._lexical(query, k, sources)
+                nearest = future.result()
+
+        return Vector._documents(Vector._fuse(nearest, lexical)[:Config.STORAGE.TOP_K])
 
-        return ret
+    @staticmethod
+    def search_many(queries: list[str], embed: Callable[[list[str]], list[list[float]]], sources: list[list[str] | None]=None) -> list[str]:
+        """
+        search of each query, embedding them in one call and searching the index once per distinct sources\n
+        embed: turns queries into vectors; only gets those a keyword match alone does not decide\n
+        sources: sources of each query; None searches all for every query
+        """
+        _ = Vector._index() # ensure tables exist
+        if sources is None:
+            sources = [None] * len(queries)
+
+        hybrid = Config.STORAGE.RETRIEVAL == Retrieval.HYBRID and Vector._has_lexical
+        k = Config.STORAGE.LEXICAL.CANDIDATES if hybrid else Config.STORAGE.TOP_K
+        rankings: list[list[int] | None] = [None] * len(queries)
+        lexical: list[list[int]] = [[] for _ in queries]
+
+        if hybrid:
+            for i, (query, src) in enumerate(zip(queries, sources)):
+                lexical[i], scores = Vector._lexical(query, k, src)
+                if Config.STORAGE.LEXICAL.FIRST and Vector._decisive(scores):
+                    rankings[i] = lexical[i][:Config.STORAGE.TOP_K]
+
+        todo = [i for i in range(len(queries)) if rankings[i] is None]
+        if len(todo) > 0:
+            groups: dict[tuple[str, ...], list[tuple[int, list[float]]]] = {}
+            for i, vector in zip(todo, embed([queries[i] for i in todo])):
+                groups.setdefault(tuple(sorted(set(sources[i] or []))), []).append((i, vector))
+
+            for key, members in groups.items():
+                nearest = Vector._nearest_many([vector for _, vector in members], k, Vector._filter(list(key)))
+                for (i, _), ids in zip(members, nearest):
+                    rankings[i] = Vector._fuse(ids, lexical[i])[:Config.STORAGE.TOP_K] if hybrid else ids
+
+        return Vector._documents_many(rankings)
 
     @staticmethod
-    def delete(src: str):
-        hnsw = Vector._hnsw()
+    def delete(src: str, keep: set[bytes]=None) -> int:
+        """
+        keep: hashes of chunks to leave untouched; None deletes the whole source\n
+        returns: number of deleted chunks
+        """
+        index = Vector._index()
 
-        for id in Sql.exec("SELECT rowid FROM vector WHERE source=?", src, fetch=True): # [(1,) ..]
-            hnsw.delete(id[0])
+        if keep is None:
+            ids = [r[0] for r in Sql.exec("SELECT rowid FROM vector WHERE source=?", src, fetch=True)]
+            index.drop(src, ids)
+        else:
+            ids = [id for id, hash in Sql.exec("SELECT rowid, hash FROM vector WHERE source=?", src, fetch=True) if hash not in keep]
+            index.delete(ids, src)
 
-        Sql.exec("DELETE FROM vector WHERE source=?", src)
+        # external content fts5 needs the deleted text to remove its terms
+        if keep is None:
+            if Vector._has_lexical:
+                Sql.exec("INSERT INTO lexical(lexical, rowid, document) SELECT 'delete', rowid, document FROM vector WHERE source=? AND typeof(document)='text'", src)
+                Sql.exec_many("INSERT INTO lexical(lexical, rowid, document) VALUES ('delete',?,?)",
+                    [(id, Vector._decode(doc, read=False)) for id, doc in Sql.exec("SELECT rowid, document FROM vector WHERE source=? AND typeof(document)='blob'", src, fetch=True)]
+                )
+            Sql.exec("DELETE FROM vector WHERE source=?", src)
+            Sql.exec("DELETE FROM sources WHERE source=?", src)
+            Sql.exec("DELETE FROM dictionary WHERE source=?", src)
+        else:
+            size = 0
+            for i in range(0, len(ids), Vector._SQL_VARS):
+                batch = ids[i:i + Vector._SQL_VARS]
+                rows = [(id, Vector._decode(doc, read=False)) for id, doc in
+                    Sql.exec(f"SELECT rowid, document FROM vector WHERE rowid IN ({",".join("?" * len(batch))})", *batch, fetch=True)
+                ]
+                size += sum(len(doc.encode("utf-8")) for _, doc in rows)
+                if Vector._has_lexical:
+                    Sql.exec_many("INSERT INTO lexical(lexical, rowid, document) VALUES ('delete',?,?)", rows)
+            Sql.exec_many("DELETE FROM vector WHERE rowid=?", [(id,) for id in ids])
+            Sql.exec("UPDATE sources SET count=count-?, bytes=bytes-? WHERE source=?", len(ids), size, src)
+            Sql.exec("DELETE FROM sources WHERE source=? AND count=0", src)
 
         # rollback-handling:
         # - hnsw delete fails: TODO unmark already deleted vectors? sql unchanged
         # - sql DELETE fails: TODO unmark all deleted vectors, sql not committed
-        Vector._save_index()
+        index.commit()
         Sql.commit()
+        Vector._forget(src)
+
+        live = Sql.exec("SELECT IFNULL(SUM(count), 0) FROM sources", fetch=True)[0][0]
+        if index.element_count - live >= index.element_count * Config.STORAGE.HNSW.COMPACT_RATIO:
+            Vector.compact()
+
+        return len(ids)
+
+    @staticmethod
+    def compact() -> bool:
+        """
+        drop deleted entries from index in background; sql rows are the live set\n
+        returns: False if index is busy or its backend has nothing to compact
+        """
+        index = Vector._index()
+        live = [r[0] for r in Sql.exec("SELECT rowid FROM vector ORDER BY rowid", fetch=True)]
+        return index.compact(live)
+
+    @staticmethod
+    def tune(ef: int):
+        """
+        set search breadth of approximate queries while running; not written to config
+        """
+        Config.STORAGE.HNSW.EF_SEARCH = ef
+        Vector._index().tune(ef)
+
+    @staticmethod
+    def reindex() -> tuple[int, int]:
+        """
+        rebuild index from the vectors stored in sql, replacing the current one\n
+        returns: (number of indexed chunks, number of chunks without a stored vector)
+        """
+        index = Vector._index()
+        count = Sql.exec("SELECT COUNT(*) FROM vector WHERE embedding IS NOT NULL", fetch=True)[0][0]
+        missing = Sql.exec("SELECT COUNT(*) FROM vector WHERE embedding IS NULL", fetch=True)[0][0]
+
+        def batches():
+            # paged by rowid so only one batch of vectors is in memory at a time
+            last = 0
+            while len(rows := Sql.exec("SELECT rowid, embedding, source FROM vector WHERE rowid>? AND embedding IS NOT NULL ORDER BY rowid LIMIT ?",
+                last, Config.STORAGE.HNSW.ADD_BATCH, fetch=True
+            )) > 0:
+                last = rows[-1][0]
+                vectors = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32).reshape(len(rows), index.dim)
+                yield vectors, np.array([r[0] for r in rows], dtype=np.uint64), [r[2] for r in rows]
+
+        index.rebuild(batches(), count)
+        return count, missing
+
+    @staticmethod
+    def list() -> list[tuple[str, int, int, str]]:
+        _ = Vector._index() # ensure index is init'ed before any ops are done
+        # [(src, count, bytes of text, created) ..]
+        return Sql.read("SELECT source, count, bytes, created FROM sources ORDER BY count")
+
+
+class _AddBuffer:
+    """
+    accumulates vectors so each index add has enough work to use all threads
+    """
+    def __init__(self, index: Index, size: int, src: str):
+        self._index = index
+        self._src = src
+        self._vectors = np.empty((size, index.dim), dtype=np.float32)
+        self._ids = np.empty(size, dtype=np.uint64)
+        self._len = 0
+
+    def add(self, vectors: list[list[float]], ids: list[int]):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        idx = 0
+
+        while idx < len(ids):
+            count = min(len(ids) - idx, len(self._ids) - self._len)
+            self._vectors[self._len:self._len + count] = vectors[idx:idx + count]
+            self._ids[self._len:self._len + count] = ids[idx:idx + count]
+            self._len += count
+            idx += count
+
+            if self._len == len(self._ids):
+                self.flush()
+
+    def flush(self):
+        if self._len == 0:
+            return
+
+        self._index.add(self._vectors[:self._len], self._ids[:self._len], self._src)
+        self._len = 0
+
+
+class _Compressed:
+    """
+    stored form of chunk text\n
+    ZLIB: raw deflate after the id of a preset dictionary sampled from the source's first chunks;
+    a chunk alone is too short for deflate to find much to refer back to, the dictionary gives it the source's common text\n
+    str documents are plain text (NONE, or stored before compression)
+    """
+    _ID = struct.Struct("<I")
+    # id: dictionary; ids are never reused so they stay valid
+    _dictionaries: dict[int, bytes] = {}
+
+    @staticmethod
+    def sample(documents: list[str]) -> bytes:
+        """
+        whole documents spread across the list, up to DICTIONARY_SIZE bytes
+        """
+        data = [doc.encode("utf-8") for doc in documents]
+        step = max(1, sum(len(d) for d in data) // Config.STORAGE.DICTIONARY_SIZE)
+        return b"".join(data[::step])[-Config.STORAGE.DICTIONARY_SIZE:]
 
     @staticmethod
-    def list() -> list[tuple[str, int]]:
-        _ = Vector._hnsw() # ensure hnsw is init'ed before any ops are done
-        # [(src, count) ..]
-        return Sql.exec("SELECT source, COUNT(*) AS count FROM vector GROUP BY source ORDER BY count", fetch=True)
+    def encode(documents: list[str], id: int, dictionary: bytes) -> list[bytes]:
+        prefix = _Compressed._ID.pack(id)
+        out = []
+        for doc in documents:
+            c = zlib.compressobj(Config.STORAGE.COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+            out.append(prefix + c.compress(doc.encode("utf-8")) + c.flush())
+        return out
+
+    @staticmethod
+    def decode(document: str | bytes, dictionary: Callable[[int], bytes]) -> str:
+        """
+        dictionary: looks up a dictionary by id when it is not cached yet
+        """
+        if isinstance(document, str):
+            return document
+
+        id, = _Compressed._ID.unpack_from(document)
+        if (data := _Compressed._dictionaries.get(id)) is None:
+            data = _Compressed._dictionaries[id] = dictionary(id)
+
+        d = zlib.decompressobj(-zlib.MAX_WBITS, zdict=data)
+        return (d.decompress(memoryview(document)[_Compressed._ID.size:]) + d.flush()).decode("utf-8")
@@ -0,0 +1,53 @@
+# run from project root: python -m bench.chunker
+import os
+import glob
+import time
+
+from agent.config import Config, DocumentScript
+from agent.chunker import Chunker, FileStream, _sliding_window
+from common.helper import PrintColor
+
+SCALE = 1000
+
+def _scaled_text() -> str:
+    text = ""
+    for path in sorted(glob.glob("./test/t*.txt")):
+        with open(path) as f:
+            text += f.read() + "\n\n"
+    return text * SCALE
+
+def _throughput(name: str, size: int, fn):
+    t = time.time()
+    count = fn()
+    t = time.time() - t
+    PrintColor.OK(f"{name}: {count} items, {t:.2f} sec @ {(size / 1048576 / t):.1f} MB/s, {(count / t):.0f} items/sec")
+
+def file_stream(path: str):
+    size = os.path.getsize(path)
+    _throughput("file stream (scan)", size, lambda: sum(1 for _ in FileStream(path, block=False)))
+    _throughput("file stream (block)", size, lambda: sum(1 for _ in FileStream(path)))
+
+def sliding_window(text: str):
+    # whole scaled text as a single section; cost should grow linearly with SCALE
+    _throughput("sliding window", len(text), lambda: len(_sliding_window(text)))
+
+def chunker(path: str):
+    _throughput("chunker", os.path.getsize(path), lambda: sum(1 for _ in Chunker(path)))
+
+if __name__ == "__main__":
+    Config.CHUNK.SEPARATOR = "\n\n"
+    Config.CHUNK.SCRIPT = DocumentScript.LATIN
+    Config.CHUNK.SIZE = 256
+    Config.CHUNK.OVERLAP = 0.25
+
+    text = _scaled_text()
+    path = "./bench/_scaled.txt"
+    with open(path, "w") as f:
+        f.write(text)
+
+    try:
+        file_stream(path)
+        sliding_window(text)
+        chunker(path)
+    finally:
+        os.remove(path)
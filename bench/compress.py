@@ -0,0 +1,89 @@
+# run from project root: python -m bench.compress [FILE ..]
+# size of data and document read latency with chunk text stored plain vs compressed ([storage] compression)
+# chunks FILEs, else python's own documentation (pydoc_data) as a stand-in for prose, with a sliding window
+import os
+import sys
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from agent.config import Config, Compression, DocumentScript
+from agent.chunker import _sliding_window
+from agent.storage import Sql, Vector
+from common.helper import PrintColor
+from bench import shared
+
+CHUNK_SIZE = 128 # words
+OVERLAP = 0.25
+DIM = 384 # stored along with each chunk, so part of the file size
+QUERIES = 2000
+K = 5
+
+def _texts(paths: list[str]) -> list[str]:
+    if len(paths) > 0:
+        texts = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                texts.append(f.read())
+        return texts
+
+    from pydoc_data.topics import topics
+    return [topics[k] for k in sorted(topics)]
+
+def run(tmp: str, compression: Compression, chunks: list[str], rankings: list[list[int]]):
+    Config.STORAGE.COMPRESSION = compression
+    Config.STORAGE.SQL = os.path.join(tmp, f"data {compression.name}")
+    Config.STORAGE.INDEX = os.path.join(tmp, f"index {compression.name}")
+    Vector._instance = None
+
+    with Sql():
+        t = time.time()
+        Vector.create(shared.FakeEmbedding(chunks, DIM), "bench")
+        stored = time.time() - t
+
+        Sql.exec("PRAGMA wal_checkpoint(TRUNCATE)")
+        text = Sql.exec("SELECT SUM(LENGTH(CAST(document AS BLOB))) FROM vector", fetch=True)[0][0]
+        dictionary = Sql.exec("SELECT IFNULL(SUM(LENGTH(data)), 0) FROM dictionary", fetch=True)[0][0]
+        size = os.path.getsize(Config.STORAGE.SQL)
+
+        # ids are handed out from 1 in order
+        first = Sql.exec("SELECT MIN(rowid) FROM vector", fetch=True)[0][0]
+        rankings = [[first + id for id in ranking] for ranking in rankings]
+        Vector._documents_many(rankings[:10]) # open a reader, cache the dictionary
+        latency = np.empty(len(rankings))
+        for i, ranking in enumerate(rankings):
+            t = time.perf_counter()
+            Vector._documents(ranking)
+            latency[i] = (time.perf_counter() - t) * 1000
+
+        t = time.time()
+        Vector._documents_many(rankings)
+        batched = (time.time() - t) / len(rankings) * 1000
+
+    PrintColor.OK(f"{compression.name:>4}: text {text / 2**20:.2f} MB (+{dictionary / 1024:.0f} KB dictionary), file {size / 2**20:.2f} MB, "
+        f"stored in {stored:.2f} sec; read {K} chunks p50 {np.percentile(latency, 50):.3f} ms, p99 {np.percentile(latency, 99):.3f} ms, "
+        f"batched {batched:.3f} ms per query"
+    )
+
+if __name__ == "__main__":
+    tmp = tempfile.mkdtemp()
+    shared.config()
+    Config.CHUNK.SCRIPT = DocumentScript.LATIN
+    Config.CHUNK.SIZE = CHUNK_SIZE
+    Config.CHUNK.OVERLAP = OVERLAP
+    Config.LLAMA.EMBEDDING.SIZE = DIM
+
+    chunks = [chunk for text in _texts(sys.argv[1:]) for chunk in _sliding_window(text)]
+    raw = sum(len(c.encode("utf-8")) for c in chunks)
+    PrintColor.OK(f"{len(chunks)} chunks of {CHUNK_SIZE} words, {OVERLAP:.0%} overlap: {raw / 2**20:.2f} MB of text")
+
+    rng = random.Random(0)
+    rankings = [rng.sample(range(len(chunks)), min(K, len(chunks))) for _ in range(QUERIES)]
+    for compression in Compression:
+        run(tmp, compression, chunks, rankings)
+
+    for f in os.listdir(tmp):
+        os.remove(os.path.join(tmp, f))
+    os.rmdir(tmp)
@@ -0,0 +1,45 @@
+# run from project root: python -m bench.embedding
+# requires the toml config (embedding model) used by the tests
+import glob
+import os
+import time
+
+from agent.config import Config
+from agent.chunker import _sliding_window
+from agent.llm import Embedding, EmbeddingPool
+from common.helper import PrintColor
+
+SCALE = 20
+
+def post_config_load():
+    n_embd, n_ctx = Embedding.stats()
+    Config.LLAMA.EMBEDDING.SIZE = n_embd
+    Config.LLAMA.EMBEDDING.CONTEXT = n_ctx
+
+def _chunks() -> list[str]:
+    ret = []
+    for path in sorted(glob.glob("./test/t*.txt")):
+        with open(path) as f:
+            ret.extend(_sliding_window(f.read()))
+    return ret * SCALE
+
+def _throughput(name: str, chunks: list[str], embed):
+    t = time.time()
+    count = sum(dv["len"] for dv in embed)
+    t = time.time() - t
+    PrintColor.OK(f"{name}: {count} chunks, {t:.1f} sec @ {(count / t):.1f} chunks/sec")
+
+def scaling(chunks: list[str]):
+    _throughput("in-process", chunks, Embedding(iter(chunks)))
+
+    workers = 1
+    while workers <= Config.LLAMA.EMBEDDING.WORKERS_LIMIT.MAX:
+        _throughput(f"{workers} workers", chunks, EmbeddingPool(iter(chunks), workers))
+        workers *= 2
+
+if __name__ == "__main__":
+    Config.load_from_toml(post_config_load)
+    Config.BENCHMARK = False # only print the summary lines above
+
+    PrintColor.BLUE(f"cpu count {os.cpu_count()}")
+    scaling(_chunks())
@@ -0,0 +1,67 @@
+# run from project root: python -m bench.filter [dim]
+# query latency of source filtered search vs corpus size and share of corpus allowed by the filter
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from agent.config import Config
+from agent.index import Index, HnswIndex, FlatIndex, IdFilter
+from common.helper import PrintColor
+from bench import shared
+
+SIZES = [10000, 50000, 200000]
+SELECTIVITY = [0.001, 0.01, 0.1, 0.5]
+DIM = 128
+QUERIES = 200
+K = 5
+
+def _latency(index: Index, queries: np.ndarray, filter: IdFilter | None) -> float:
+    t = time.time()
+    for query in queries:
+        index.query(query, k=K, filter=filter)
+    return (time.time() - t) / len(queries) * 1000
+
+if __name__ == "__main__":
+    dim = int(sys.argv[1]) if len(sys.argv) > 1 else DIM
+
+    tmp = tempfile.mkdtemp()
+    shared.config()
+    rng = np.random.default_rng(0)
+    exact = Config.STORAGE.HNSW.FILTER_EXACT
+
+    for size in SIZES:
+        vectors = rng.random((size, dim), dtype=np.float32) - 0.5
+        queries = rng.random((QUERIES, dim), dtype=np.float32) - 0.5
+        ids = np.arange(1, size + 1)
+
+        hnsw = HnswIndex(os.path.join(tmp, f"hnsw{size}"), dim)
+        hnsw.add(vectors, ids)
+        flat = FlatIndex(os.path.join(tmp, f"flat{size}"), dim)
+        flat.add(vectors, ids)
+
+        PrintColor.OK(f"{size} rows, unfiltered: hnsw {_latency(hnsw, queries, None):.3f} ms, flat {_latency(flat, queries, None):.3f} ms")
+
+        for share in SELECTIVITY:
+            t = time.time()
+            filter = IdFilter(rng.choice(ids, max(1, int(size * share)), replace=False))
+            build = (time.time() - t) * 1000
+
+            # graph walk with the filter callback, whatever the filter size
+            Config.STORAGE.HNSW.FILTER_EXACT = 0
+            graph = _latency(hnsw, queries, filter)
+            # exact search over the allowed ids only
+            Config.STORAGE.HNSW.FILTER_EXACT = size * size
+            scan = _latency(hnsw, queries, filter)
+            Config.STORAGE.HNSW.FILTER_EXACT = exact
+
+            PrintColor.OK(f"  {share:>5.1%} allowed ({len(filter)} ids, filter built in {build:.2f} ms): "
+                f"hnsw graph {graph:.3f} ms, exact over allowed {scan:.3f} ms, as configured {_latency(hnsw, queries, filter):.3f} ms, "
+                f"flat {_latency(flat, queries, filter):.3f} ms"
+            )
+
+    for f in os.listdir(tmp):
+        os.remove(os.path.join(tmp, f))
+    os.rmdir(tmp)
@@ -0,0 +1,77 @@
+# run from project root: python -m bench.index [dim]
+# build time, query latency and recall@k of each local index backend against brute force,
+# and time from opening a saved index to its first answer
+import os
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import numpy as np
+
+from agent.index import Index, HnswIndex, FlatIndex
+from common.helper import PrintColor
+from bench import shared
+
+SIZES = [1000, 10000, 50000]
+DIM = 384 # common small embedding model size
+# uniform random vectors have no cluster structure, a worst case for hnsw recall; real embeddings do far better
+QUERIES = 200
+K = 5
+
+def _exact(vectors: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.argsort(-(queries @ normed.T), axis=1)[:, :K] + 1
+
+def run(name: str, index: Index, vectors: np.ndarray, queries: np.ndarray, expected: np.ndarray) -> Index:
+    t = time.time()
+    index.fit(len(vectors))
+    index.add(vectors, np.arange(1, len(vectors) + 1))
+    index.commit()
+    build = time.time() - t
+
+    hits = 0
+    t = time.time()
+    for query, exp in zip(queries, expected):
+        ids, _ = index.query(query, k=K)
+        hits += len(set(ids.tolist()) & set(exp.tolist()))
+    latency = (time.time() - t) / len(queries) * 1000
+
+    # all queries in one call, as Vector.read_many does
+    t = time.time()
+    index.query_many(queries, k=K)
+    batched = (time.time() - t) / len(queries) * 1000
+
+    PrintColor.OK(f"{name} {len(vectors)}: build {build:.2f} sec, query {latency:.3f} ms, batched {batched:.3f} ms per query, "
+        f"recall@{K} {hits / (len(queries) * K):.3f}"
+    )
+    return index
+
+def startup(name: str, open: Callable[[], Index], query: np.ndarray):
+    t = time.time()
+    index = open()
+    index.query(query, k=K)
+    first = time.time() - t
+    index.wait()
+    PrintColor.OK(f"  {name} startup: first query after {first:.3f} sec, fully loaded after {time.time() - t:.3f} sec")
+
+if __name__ == "__main__":
+    dim = int(sys.argv[1]) if len(sys.argv) > 1 else DIM
+
+    tmp = tempfile.mkdtemp()
+    shared.config()
+    rng = np.random.default_rng(0)
+
+    for size in SIZES:
+        vectors = rng.random((size, dim), dtype=np.float32) - 0.5
+        queries = rng.random((QUERIES, dim), dtype=np.float32) - 0.5
+        expected = _exact(vectors, queries)
+
+        for name, cls in [("hnsw", HnswIndex), ("flat", FlatIndex)]:
+            path = os.path.join(tmp, f"{name}{size}")
+            run(name, cls(path, dim), vectors, queries, expected).checkpoint()
+            startup(name, lambda: cls(path, dim), queries[0])
+
+    for f in os.listdir(tmp):
+        os.remove(os.path.join(tmp, f))
+    os.rmdir(tmp)
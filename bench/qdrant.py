@@ -0,0 +1,69 @@
+# run from project root: python -m bench.qdrant [points]
+# points/sec of QdrantIndex.add + commit, waiting for each upsert in turn vs several in flight
+# needs the qdrant binary in [qdrant] path, as for the QDRANT backend
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from agent.config import Config
+from agent.qdrant import QdrantIndex, Db, init
+from bench import shared
+
+POINTS = 100000
+DIM = 384
+ADD_BATCH = 4096 # points per add, as Vector.create hands them over
+UPSERTS = [1, 4, 8]
+UPSERT_BATCH = [128, 512, 2048]
+
+def _reset(index: QdrantIndex):
+    index._run(Db.http(Db.Meth.DEL, "", None))
+    index._run(init(DIM))
+
+def sequential(index: QdrantIndex, vectors: np.ndarray):
+    # previous add; one upsert at a time, each waiting until qdrant has indexed it
+    _reset(index)
+    t = time.time()
+    for i in range(0, len(vectors), Config.QDRANT.UPSERT_BATCH):
+        ids = np.arange(i + 1, min(i + Config.QDRANT.UPSERT_BATCH, len(vectors)) + 1, dtype=np.uint64)
+        index._run(QdrantIndex._upsert(ids, vectors[i:i + Config.QDRANT.UPSERT_BATCH], True))
+    _rate(f"sequential, {Config.QDRANT.UPSERT_BATCH} per upsert", len(vectors), t, index)
+
+def pipelined(index: QdrantIndex, vectors: np.ndarray):
+    _reset(index)
+    t = time.time()
+    for i in range(0, len(vectors), ADD_BATCH):
+        index.add(vectors[i:i + ADD_BATCH], np.arange(i + 1, min(i + ADD_BATCH, len(vectors)) + 1))
+    index.commit()
+    _rate(f"pipelined, {Config.QDRANT.UPSERT_BATCH} per upsert, {Config.QDRANT.UPSERTS} in flight", len(vectors), t, index)
+
+def _rate(name: str, count: int, t: float, index: QdrantIndex):
+    shared.rate(name, count, t, "points")
+    # everything is searchable once add / commit returned
+    assert index.element_count == count
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else POINTS
+
+    tmp = tempfile.mkdtemp()
+    shared.config()
+    Config.STORAGE.INDEX = os.path.join(tmp, "index")
+    Config.QDRANT.PATH = os.path.abspath(Config.QDRANT.PATH)
+
+    vectors = np.random.default_rng(0).random((count, DIM), dtype=np.float32) - 0.5
+    index = QdrantIndex(DIM)
+
+    for batch in UPSERT_BATCH:
+        Config.QDRANT.UPSERT_BATCH = batch
+        sequential(index, vectors)
+        for upserts in UPSERTS:
+            Config.QDRANT.UPSERTS = upserts
+            index._inflight = threading.BoundedSemaphore(upserts) # taken from config when opened
+            pipelined(index, vectors)
+
+    index.close()
+    shutil.rmtree(tmp)
@@ -0,0 +1,89 @@
+# run from project root: python -m bench.quantize [rows] [dim]
+# memory, recall@k and latency of exact search over float32, float16 and int8 vectors, with and without rerank
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from agent.config import Config, Quantization
+from agent.index import FlatIndex
+from common.helper import PrintColor
+from bench import shared
+
+ROWS = 200000
+DIM = 384 # common small embedding model size
+CLUSTERS = 1000 # embeddings of related chunks are close together; uniform random vectors are not
+QUERIES = 200
+K = 5
+
+MODES = [
+    (Quantization.NONE, 0),
+    (Quantization.FLOAT16, 0),
+    (Quantization.FLOAT16, 4),
+    (Quantization.INT8, 0),
+    (Quantization.INT8, 4)
+]
+
+def _recall(results: list[tuple[np.ndarray, np.ndarray]], expected: list[tuple[np.ndarray, np.ndarray]]) -> float:
+    return sum(len(set(r[0].tolist()) & set(e[0].tolist())) for r, e in zip(results, expected)) / (len(expected) * K)
+
+def run(path: str, dim: int, quantization: Quantization, rerank: int, queries: np.ndarray,
+    expected: list[tuple[np.ndarray, np.ndarray]] | None
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    Config.STORAGE.QUANTIZATION = quantization
+    Config.STORAGE.RERANK = rerank
+    # quantized vectors are written along with the full precision ones; reopen to search the mapped file
+    index = FlatIndex(path, dim)
+    rows = index._store._rows
+    scanned = rows.base_vectors.nbytes if rows.base_codes is None else \
+        rows.base_codes.nbytes + (0 if rows.base_scales is None else rows.base_scales.nbytes)
+
+    index.query(queries[0], k=K) # page in
+    latency = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        t = time.perf_counter()
+        index.query(query, k=K)
+        latency[i] = (time.perf_counter() - t) * 1000
+
+    t = time.time()
+    results = index.query_many(queries, k=K)
+    batched = (time.time() - t) / len(queries) * 1000
+
+    recall = 1.0 if expected is None else _recall(results, expected)
+    PrintColor.OK(f"{quantization.name:>7} rerank {rerank}: scanned {scanned / 2**20:.0f} MB, file {os.path.getsize(path) / 2**20:.0f} MB, "
+        f"recall@{K} {recall:.3f}, p50 {np.percentile(latency, 50):.2f} ms, p99 {np.percentile(latency, 99):.2f} ms, batched {batched:.3f} ms per query"
+    )
+    index.close()
+    return results
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else DIM
+
+    tmp = tempfile.mkdtemp()
+    shared.config()
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(CLUSTERS, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, CLUSTERS, rows)] + 0.5 * rng.normal(size=(rows, dim)).astype(np.float32)
+    queries = centers[rng.integers(0, CLUSTERS, QUERIES)] + 0.5 * rng.normal(size=(QUERIES, dim)).astype(np.float32)
+
+    expected = None
+    for quantization, rerank in MODES:
+        path = os.path.join(tmp, quantization.name)
+        if not os.path.isfile(path):
+            Config.STORAGE.QUANTIZATION = quantization
+            index = FlatIndex(path, dim)
+            index.add(vectors, np.arange(1, rows + 1))
+            index.commit()
+            index.checkpoint()
+            index.close()
+
+        results = run(path, dim, quantization, rerank, queries, expected)
+        if expected is None:
+            expected = results
+
+    for f in os.listdir(tmp):
+        os.remove(os.path.join(tmp, f))
+    os.rmdir(tmp)
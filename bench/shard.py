@@ -0,0 +1,75 @@
+# run from project root: python -m bench.shard [sources]
+# one hnsw index for all sources vs a shard per source: query fan-out, scoped query, deleting a source
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from agent.index import Index, HnswIndex, ShardedIndex, IdFilter
+from common.helper import PrintColor
+from bench import shared
+
+SOURCES = 20
+ROWS = 2500 # per source
+DIM = 128
+QUERIES = 200
+K = 5
+
+def _latency(index: Index, queries: np.ndarray, filter: IdFilter | None) -> float:
+    t = time.time()
+    for query in queries:
+        index.query(query, k=K, filter=filter)
+    return (time.time() - t) / len(queries) * 1000
+
+if __name__ == "__main__":
+    sources = int(sys.argv[1]) if len(sys.argv) > 1 else SOURCES
+
+    tmp = tempfile.mkdtemp()
+    shared.config()
+    rng = np.random.default_rng(0)
+    vectors = rng.random((sources * ROWS, DIM), dtype=np.float32) - 0.5
+    queries = rng.random((QUERIES, DIM), dtype=np.float32) - 0.5
+
+    single = HnswIndex(os.path.join(tmp, "single"), DIM)
+    sharded = ShardedIndex(os.path.join(tmp, "shards"), DIM)
+
+    for name, index in [("single", single), ("sharded", sharded)]:
+        t = time.time()
+        for i in range(sources):
+            ids = np.arange(i * ROWS, (i + 1) * ROWS) + 1
+            index.add(vectors[ids - 1], ids, f"source {i}")
+        index.commit()
+        index.checkpoint()
+        PrintColor.OK(f"{name}: {sources} sources x {ROWS} rows built in {time.time() - t:.1f} sec")
+
+    scope = IdFilter(np.arange(1, ROWS + 1), ["source 0"])
+    for name, index in [("single", single), ("sharded", sharded)]:
+        PrintColor.OK(f"  {name} query: all sources {_latency(index, queries, None):.3f} ms, one source {_latency(index, queries, scope):.3f} ms")
+
+    # deleting a source: tombstones plus a rewrite of the whole graph vs removing a shard's files
+    ids = list(range(1, ROWS + 1))
+    t = time.time()
+    single.delete(ids, "source 0")
+    single.commit()
+    single.compact()
+    single.wait()
+    PrintColor.OK(f"  single delete source incl. compaction: {time.time() - t:.3f} sec")
+
+    t = time.time()
+    sharded.drop("source 0", ids)
+    PrintColor.OK(f"  sharded drop source: {time.time() - t:.3f} sec")
+
+    # working set: a cold start scoped to one source only loads that shard
+    sharded.close()
+    t = time.time()
+    reopened = ShardedIndex(os.path.join(tmp, "shards"), DIM)
+    reopened.query(queries[0], k=K, filter=IdFilter(np.arange(ROWS + 1, 2 * ROWS + 1), ["source 1"]))
+    reopened.wait()
+    PrintColor.OK(f"  sharded cold query on one source: {time.time() - t:.3f} sec, {len(reopened._open)} of {sources - 1} shards loaded")
+
+    single.close()
+    reopened.close()
+    shutil.rmtree(tmp)
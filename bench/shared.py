@@ -0,0 +1,65 @@
+# helpers shared by the benches; not a bench itself
+import time
+from typing import Iterator
+
+import numpy as np
+
+from agent.config import Config
+from common.helper import PrintColor
+from common.toml import Toml
+
+# Vector.create batches are cut by token count like _token_batches; embedding models commonly have a 512 token context
+CONTEXT = 512
+TOKEN_BYTES = 4 # rough bytes per token of english text
+
+def config():
+    """
+    Config as loaded from an empty config file; benches then set what they measure
+    """
+    Toml.defaults(Config)
+    Config.DEBUG = False
+
+def rate(name: str, count: int, t: float, unit="rows"):
+    """
+    print throughput of count units since t
+    """
+    t = time.time() - t
+    PrintColor.OK(f"{name}: {count} {unit}, {t:.1f} sec @ {(count / t):.0f} {unit}/sec")
+
+def token_batches(chunks: list[str]) -> Iterator[list[str]]:
+    """
+    chunks grouped to fit CONTEXT tokens, by estimated token count
+    """
+    batch = []
+    tokens = 0
+    for chunk in chunks:
+        count = min(len(chunk.encode("utf-8")) // TOKEN_BYTES + 1, CONTEXT)
+        if tokens + count > CONTEXT and len(batch) > 0:
+            yield batch
+            batch = []
+            tokens = 0
+        batch.append(chunk)
+        tokens += count
+
+    if len(batch) > 0:
+        yield batch
+
+class FakeEmbedding:
+    """
+    same output as Embedding, in batches of the same size, without running a model
+    """
+    def __init__(self, chunks: list[str], dim: int):
+        self._batches = token_batches(chunks)
+        self._dim = dim
+        self._rng = np.random.default_rng(0)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunks = next(self._batches)
+        return {
+            "documents": chunks,
+            "vectors": self._rng.random((len(chunks), self._dim), dtype=np.float32),
+            "len": len(chunks)
+        }
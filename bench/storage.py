@@ -0,0 +1,105 @@
+# run from project root: python -m bench.storage [chunks]
+import os
+import sys
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from agent.config import Config
+from agent.storage import Sql, Vector
+from agent.c_wrapper import Hnsw
+from common.helper import PrintColor
+from bench import shared
+
+CHUNKS = 1000000
+DIM = 8 # keeps hnsw cost low; sql cost does not depend on it
+
+def _documents(count: int) -> list[str]:
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    rng = random.Random(0)
+    return [" ".join(rng.choices(words, k=40)) + f" {i}." for i in range(count)]
+
+def sql_per_row(documents: list[str]):
+    # previous insert path; one execute per row. own table as it bypasses the row id sequence
+    Sql.exec("CREATE TABLE per_row(document TEXT, source TEXT, hash BLOB)")
+
+    t = time.time()
+    for doc in documents:
+        Sql.exec("INSERT INTO per_row(document, source, hash) VALUES (?,?,?)", doc, "per row", Vector.digest(doc),
+            lastrowid=True
+        )
+    Sql.commit()
+    shared.rate("sql per row", len(documents), t)
+
+def sql_bulk(documents: list[str]):
+    # a chunk is at least a token, so no batch has more
+    vectors = np.random.default_rng(0).random((shared.CONTEXT, DIM), dtype=np.float32)
+    t = time.time()
+    for batch in shared.token_batches(documents):
+        Vector._insert(batch, vectors[:len(batch)], "bulk")
+    Sql.commit()
+    shared.rate("sql bulk", len(documents), t)
+
+def create(documents: list[str]):
+    t = time.time()
+    Vector.create(shared.FakeEmbedding(documents, DIM), "create")
+    shared.rate("Vector.create (fake embedding)", len(documents), t)
+
+def reindex():
+    t = time.time()
+    count, _ = Vector.reindex()
+    shared.rate("Vector.reindex", count, t)
+
+def delete_small(documents: list[str]):
+    # deleting a small source appends to the delta log instead of rewriting the whole index
+    Vector.create(shared.FakeEmbedding(documents, DIM), "small")
+    log = os.path.getsize(Config.STORAGE.INDEX + ".log")
+
+    t = time.time()
+    Vector.delete("small")
+    shared.rate("Vector.delete (small source)", len(documents), t)
+    PrintColor.OK(f"  log +{os.path.getsize(Config.STORAGE.INDEX + '.log') - log} bytes")
+
+    index = Vector._index()
+    t = time.time()
+    index.checkpoint()
+    PrintColor.OK(f"  full snapshot: {os.path.getsize(Config.STORAGE.INDEX)} bytes, {time.time() - t:.2f} sec")
+
+def hnsw_only(count: int):
+    # lower bound for create; single add_items into a pre-sized index
+    rng = np.random.default_rng(0)
+    hnsw = Hnsw("cosine", DIM)
+    hnsw.init_index(count, M=Config.STORAGE.HNSW.M, ef_construction=Config.STORAGE.HNSW.EF_CONSTRUCTION)
+
+    vectors = rng.random((count, DIM), dtype=np.float32)
+    t = time.time()
+    hnsw.add(vectors, np.arange(count))
+    shared.rate("hnswlib only", count, t)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else CHUNKS
+
+    tmp = tempfile.mkdtemp()
+    shared.config()
+    Config.STORAGE.SQL = os.path.join(tmp, "data")
+    Config.STORAGE.INDEX = os.path.join(tmp, "index")
+    Config.LLAMA.EMBEDDING.SIZE = DIM
+
+    documents = _documents(count)
+
+    with Sql():
+        _ = Vector.list() # create tables
+        sql_per_row(documents)
+        sql_bulk(documents)
+        # hnsw build dominates here; keep it smaller
+        create(documents[:count // 10])
+        # every row inserted so far has a stored vector, incl. bulk ones never added to hnsw
+        reindex()
+        delete_small(documents[:100])
+        hnsw_only(count // 10)
+
+    for f in os.listdir(tmp):
+        os.remove(os.path.join(tmp, f))
+    os.rmdir(tmp)
@@ -0,0 +1,154 @@
+# run from project root: python -m bench.tune DATA [--write CONFIG]
+# recall@k and query latency of hnsw settings on the vectors stored in DATA (the [storage] sql file),
+# against exact search; picks the fastest that reaches the target recall and optionally writes it to CONFIG
+import re
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from agent.config import Config
+from agent.storage import Sql
+from agent.c_wrapper import Hnsw
+from common.helper import PrintColor
+from bench import shared
+
+M = [8, 16, 32]
+EF_CONSTRUCTION = [100]
+EF_SEARCH = [1, 2, 3, 4, 8, 16, 32, 64, 128]
+QUERIES = 200 # stored vectors held out of the index and used as queries
+RECALL = 0.95
+
+class _Result:
+    def __init__(self, m: int, ef_construction: int, ef: int, recall: float, p50: float, p99: float):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.recall = recall
+        self.p50 = p50
+        self.p99 = p99
+
+def _load(path: str) -> np.ndarray:
+    Config.STORAGE.SQL = path
+    with Sql():
+        rows = Sql.exec("SELECT embedding FROM vector WHERE embedding IS NOT NULL ORDER BY rowid", fetch=True)
+
+    if len(rows) == 0:
+        raise ValueError(f"no stored vectors in {path}")
+
+    dim = len(rows[0][0]) // 4 # float32
+    return np.frombuffer(b"".join(r[0] for r in rows), dtype=np.float32).reshape(len(rows), dim)
+
+def _exact(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.argsort(-(queries @ normed.T), axis=1)[:, :k]
+
+def sweep(vectors: np.ndarray, queries: np.ndarray, expected: np.ndarray, k: int,
+    ms: list[int], ef_constructions: list[int], efs: list[int]
+) -> list[_Result]:
+    results = []
+    for m in ms:
+        for ef_construction in ef_constructions:
+            hnsw = Hnsw("cosine", vectors.shape[1])
+            hnsw.init_index(len(vectors), M=m, ef_construction=ef_construction)
+            t = time.time()
+            hnsw.add(vectors, np.arange(len(vectors)))
+            PrintColor.OK(f"m {m}, ef_construction {ef_construction}: built in {time.time() - t:.2f} sec")
+
+            for ef in efs:
+                hnsw.ef = ef
+                hnsw.query(queries[0], k=k) # warm up
+
+                hits = 0
+                latency = np.empty(len(queries))
+                for i, (query, exp) in enumerate(zip(queries, expected)):
+                    t = time.perf_counter()
+                    ids, _ = hnsw.query(query, k=k)
+                    latency[i] = (time.perf_counter() - t) * 1000
+                    hits += len(set(ids[0].tolist()) & set(exp.tolist()))
+
+                res = _Result(m, ef_construction, ef, hits / (len(queries) * k), *np.percentile(latency, [50, 99]))
+                results.append(res)
+                PrintColor.OK(f"  ef {ef:>4}: recall@{k} {res.recall:.3f}, p50 {res.p50:.3f} ms, p99 {res.p99:.3f} ms")
+
+    return results
+
+def choose(results: list[_Result], recall: float) -> _Result:
+    """
+    fastest p50 that reaches recall, else the most accurate
+    """
+    passed = [r for r in results if r.recall >= recall]
+    if len(passed) > 0:
+        return min(passed, key=lambda r: (r.p50, r.m))
+    return max(results, key=lambda r: (r.recall, -r.p50))
+
+def write(path: str, best: _Result):
+    """
+    set m, ef_construction and ef_search of [storage.hnsw] in the toml file at path, keeping everything else as is
+    """
+    values = {"m": best.m, "ef_construction": best.ef_construction, "ef_search": best.ef}
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.read().split("\n")
+
+    tables = [i for i, line in enumerate(lines) if re.match(r"\s*\[", line)]
+    header = next((i for i in tables if lines[i].strip() == "[storage.hnsw]"), None)
+
+    if header is not None:
+        end = next((i for i in tables if i > header), len(lines))
+        for key, val in values.items():
+            # the shipped config has them commented out with their defaults
+            line = next((i for i in range(header + 1, end) if re.match(rf"\s*#?\s*{key}\s*=", lines[i])), None)
+            if line is not None:
+                lines[line] = f"{key} = {val}"
+            else:
+                lines.insert(header + 1, f"{key} = {val}")
+    else:
+        storage = next((i for i in tables if lines[i].strip() == "[storage]"), None)
+        if storage is None:
+            raise ValueError(f"no [storage] table in {path}")
+
+        # sub table goes right after its parent's keys
+        end = next((i for i in tables if i > storage), len(lines))
+        lines[end:end] = ["[storage.hnsw]"] + [f"{key} = {val}" for key, val in values.items()] + [""]
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+if __name__ == "__main__":
+    shared.config()
+
+    parser = ArgumentParser(prog="python -m bench.tune")
+    parser.add_argument("data", help="sql file of [storage] sql")
+    parser.add_argument("-k", type=int, default=Config.STORAGE.TOP_K)
+    parser.add_argument("--recall", type=float, default=RECALL, help="target recall@k")
+    parser.add_argument("--queries", type=int, default=QUERIES)
+    parser.add_argument("--m", type=int, nargs="+", default=M)
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=EF_CONSTRUCTION)
+    parser.add_argument("--ef", type=int, nargs="+", default=EF_SEARCH)
+    parser.add_argument("--write", metavar="CONFIG", help="toml file to write the chosen settings to")
+    arg = parser.parse_args()
+
+    vectors = _load(arg.data)
+    if len(vectors) <= arg.queries + arg.k:
+        raise ValueError(f"{len(vectors)} stored vectors is too few to hold out {arg.queries} queries")
+
+    # queries come from the corpus itself so they look like real questions' embeddings; held out so none finds itself
+    held = np.zeros(len(vectors), dtype=bool)
+    held[np.random.default_rng(0).choice(len(vectors), arg.queries, replace=False)] = True
+    queries, vectors = vectors[held], vectors[~held]
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+    t = time.time()
+    expected = _exact(vectors, queries, arg.k)
+    PrintColor.OK(f"{len(vectors)} vectors of dim {vectors.shape[1]}, {len(queries)} queries, exact search in {time.time() - t:.2f} sec")
+
+    results = sweep(vectors, queries, expected, arg.k, arg.m, arg.ef_construction, arg.ef)
+    best = choose(results, arg.recall)
+    if best.recall < arg.recall:
+        PrintColor.WARN(f"no setting reaches recall@{arg.k} {arg.recall}; add larger --m / --ef values")
+    PrintColor.OK(f"chosen: m {best.m}, ef_construction {best.ef_construction}, ef_search {best.ef} "
+        f"(recall@{arg.k} {best.recall:.3f}, p50 {best.p50:.3f} ms, p99 {best.p99:.3f} ms)")
+
+    if arg.write is not None:
+        write(arg.write, best)
+        PrintColor.OK(f"written to [storage.hnsw] of {arg.write}; run !reindex if m or ef_construction changed")
@@ -15,10 +15,13 @@ class Notification(Serde):
         super().__init__(DataType.NOTIFICATION, json_str)
 
 class Query(Serde):
+    _OPTIONAL = {"sources"}
+
     def __init__(self, json_str=""):
         self.id = ""
         self.session = ""
         self.text = ""
+        self.sources = [] # only answer from these; empty for all
         super().__init__(DataType.QUERY, json_str)
 
 class Answer(Serde):
@@ -0,0 +1,140 @@
+import threading
+import queue
+import time
+from typing import Iterable, Iterator, Callable
+
+from common.helper import PrintColor
+
+class Pipeline:
+    """
+    chain of iterators, each stage iterated in its own thread\n
+    stages are linked by bounded queues; a stage that gets ahead blocks until the next one catches up\n
+    stages are added in order, each one's input wrapping the iterator returned by the previous
+    """
+    class _Stats:
+        def __init__(self, name: str):
+            self.name = name
+            self.count = 0
+            self.busy = 0.0
+            self.starved = 0.0 # waiting on input
+            self.blocked = 0.0 # waiting on output queue space
+
+    class _End:
+        def __init__(self, error: Exception=None):
+            self.error = error
+
+    class _Reader:
+        def __init__(self, pipeline: "Pipeline", q: queue.Queue):
+            self._pipeline = pipeline
+            self._queue = q
+            self.wait = 0.0
+            self._end = False
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            if self._end:
+                raise StopIteration
+
+            t = time.time()
+            while True:
+                try:
+                    item = self._queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if self._pipeline._stop.is_set():
+                        self._end = True
+                        raise StopIteration
+            self.wait += time.time() - t
+
+            if isinstance(item, Pipeline._End):
+                self._end = True
+                if item.error is not None:
+                    raise item.error
+                raise StopIteration
+
+            return item
+
+    def __init__(self, maxsize=64):
+        self._maxsize = maxsize
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._stats: list[Pipeline._Stats] = []
+        self._reader: Pipeline._Reader = None # output of the last added stage
+
+    def stage(self, name: str, input: Iterable) -> Iterator:
+        """
+        iterate input on a new thread\n
+        returns: iterator over input's items, to be used as input of the next stage
+        """
+        stats = Pipeline._Stats(name)
+        self._stats.append(stats)
+
+        q = queue.Queue(self._maxsize)
+        thread = threading.Thread(target=self._run, args=(input, self._reader, q, stats), name=f"pipeline {name}", daemon=True)
+        self._threads.append(thread)
+        self._reader = Pipeline._Reader(self, q)
+        thread.start()
+
+        return self._reader
+
+    def run(self, name: str, input: Iterator, fn: Callable[[Iterator], any]) -> any:
+        """
+        consume the last stage on the calling thread i.e. for resources bound to it (sqlite)
+        """
+        stats = Pipeline._Stats(name)
+        self._stats.append(stats)
+
+        t = time.time()
+        try:
+            return fn(input)
+        finally:
+            # stop upstream stages in case fn did not consume everything
+            self._stop.set()
+            for thread in self._threads:
+                thread.join()
+
+            stats.starved = self._reader.wait if self._reader is not None else 0.0
+            stats.busy = time.time() - t - stats.starved
+
+    def print_stats(self):
+        for s in self._stats:
+            count = f"{s.count} items, " if s.count > 0 else ""
+            PrintColor.OK(f"{s.name}: {count}busy {s.busy:.1f} sec, waiting input {s.starved:.1f} sec, waiting output {s.blocked:.1f} sec")
+
+    def _run(self, input: Iterable, upstream: _Reader | None, q: queue.Queue, stats: _Stats):
+        end = Pipeline._End()
+        t = time.time()
+
+        try:
+            for item in input:
+                stats.count += 1
+
+                put = time.time()
+                while not self._put(q, item):
+                    if self._stop.is_set():
+                        # let input release what it holds, e.g. generators' finally blocks
+                        close = getattr(input, "close", None)
+                        if close is not None:
+                            close()
+                        return
+                stats.blocked += time.time() - put
+
+        except Exception as e:
+            end.error = e
+
+        finally:
+            stats.starved = upstream.wait if upstream is not None else 0.0
+            stats.busy = time.time() - t - stats.starved - stats.blocked
+
+        while not self._put(q, end):
+            if self._stop.is_set():
+                return
+
+    def _put(self, q: queue.Queue, item: any) -> bool:
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            return False
@@ -6,6 +6,10 @@ class SerdeParseError(Exception):
     ...
 
 class Serde:
+    # attributes added after the first release; left out of json when empty and keep their default
+    # when missing, so relays and agents of different versions still parse each other's messages
+    _OPTIONAL: set[str] = set()
+
     # only call super.__init__() after initializing child class attributes!
     def __init__(self, type: Enum, json_str: str):
         self.type = type
@@ -20,7 +24,8 @@ class Serde:
             for k in obj.keys():
                 keys.add(k)
 
-            if not (keys == self._attributes()): # set == compares similarity of ALL elements
+            attributes = self._attributes()
+            if not (keys <= attributes and attributes - keys <= self._OPTIONAL):
                 raise SerdeParseError(f"Json schema mismatch: {json_str}")
 
             for k in keys:
@@ -44,6 +49,8 @@ class Serde:
         ret = {}
         for k in self._attributes():
             v = getattr(self, k)
+            if k in self._OPTIONAL and not v:
+                continue
             if k == "type":
                 v = v.name
             ret[k] = v
@@ -26,6 +26,22 @@ class Toml:
     def __exit__(self, type, value, traceback):
         self._file.close()
 
+    @staticmethod
+    def defaults(obj: any):
+        """
+        set each Spec of obj that has a default to it, without a toml file e.g. for benchmarks\n
+        required ones are left as is
+        """
+        for attr in dir(obj):
+            if attr.startswith("_"):
+                continue
+
+            sub = getattr(obj, attr)
+            if inspect.isclass(sub):
+                Toml.defaults(sub)
+            elif type(sub) is Toml.Spec and sub.default is not None:
+                setattr(obj, attr, sub.default if sub.callback is None else sub.callback(sub.default))
+
     def load_to(self, obj: any):
         subs = list()
 
@@ -15,6 +15,10 @@ def _has_agent(req: Request, agent: str) -> Response | None:
 @route("POST", "/a/{agent:str}/query", middlewares=[_has_agent])
 async def query(req: Request, agent: str):
     form = await req.json()
+    sources = form.get("sources", [])
+    if not isinstance(sources, list) or not all(isinstance(s, str) for s in sources):
+        return Response("sources must be a list of source names", status_code=400)
+
     session = req.cookies.get("session", None)
     if session is None:
         session = uuid.uuid4().hex
@@ -23,6 +27,7 @@ async def query(req: Request, agent: str):
     query.id = uuid.uuid4().hex
     query.session = session
     query.text = form["query"]
+    query.sources = sources
     
     ws = Agents.websocket(agent)
     stg = Agents.stream(agent, query.id).new()
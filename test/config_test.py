@@ -2,3 +2,7 @@
 SKIP_CHUNKER = False
 SKIP_INT_CRUD = False
 SKIP_CONFIG = False
+SKIP_STORAGE = False
+SKIP_INDEX = False
+SKIP_DATA = False
+SKIP_SERVER = False
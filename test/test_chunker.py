@@ -1,6 +1,9 @@
 from unittest import TestCase, skipIf
+import os
+import shutil
+import tempfile
 
-from agent.chunker import Chunker, FileStream, _sliding_window
+from agent.chunker import Chunker, ChunkerPool, FileStream, _sliding_window
 import config_test
 import agent.llm as llm
 from agent.config import Config
@@ -39,6 +42,11 @@ just attack. After that there will be a boss."""
         ret = _sliding_window(s1)
         self.assertEqual(ret[-1], s2)
 
+        # sentence larger than chunk size on its own must not stall the window
+        s3 = " ".join(["word"] * 120) + "."
+        ret = _sliding_window(f"{s3} Short one.")
+        self.assertEqual(ret, [s3, "Short one."])
+
 # -----------------------------------------------------------------------------
     @skipIf(config_test.SKIP_CHUNKER, "")
     def test_file_stream(self):
@@ -70,6 +78,31 @@ which binds method and variable names during program execution."""
         self.assertEqual(c[5], "")
         self.assertEqual(c[6], "stu\n< b r >")
 
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_CHUNKER, "")
+    def test_file_stream_block(self):
+        # block reads must split exactly like the char-by-char scan,
+        # including separators straddling block boundaries
+        separator = Config.CHUNK.SEPARATOR
+        read_size = Config.CHUNK.READ_SIZE
+        Config.CHUNK.READ_SIZE = 3
+
+        for sep, file in [("\n\n", "./test/t1.txt"), ("\n\n", "./test/t3.txt"), ("<br>", "./test/t2.txt")]:
+            Config.CHUNK.SEPARATOR = sep
+            self.assertEqual(list(FileStream(file)), list(FileStream(file, block=False)))
+
+        Config.CHUNK.SEPARATOR = separator
+        Config.CHUNK.READ_SIZE = read_size
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_CHUNKER, "")
+    def test_file_stream_progress(self):
+        read = []
+        chunks = list(FileStream("./test/t3.txt", progress=read.append))
+        self.assertEqual(chunks, list(FileStream("./test/t3.txt")))
+        self.assertGreater(len(read), 1)
+        self.assertEqual(sum(read), os.path.getsize("./test/t3.txt"))
+
 # -----------------------------------------------------------------------------
     @skipIf(config_test.SKIP_CHUNKER, "")
     def test_chunker(self):
@@ -97,3 +130,19 @@ version is incremented to the next minor version, which becomes the “a0” ver
 Python’s backward compatibility policy. See also the documentation for sys.version, sys.hexversion, and sys.version_info."""
 
         self.assertEqual(c[7], s2)
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_CHUNKER, "")
+    def test_chunker_pool_skip(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            binary = os.path.join(tmp, "image.png")
+            with open(binary, "wb") as f:
+                f.write(b"\x89PNG\r\n\x1a\n\xff\xfe\x00\x81" * 64)
+
+            # not text; skipped, the other files are still chunked
+            with ChunkerPool(["./test/t3.txt", binary, "./test/t1.txt"], workers=2) as pool:
+                self.assertEqual(list(pool), list(Chunker("./test/t3.txt")) + list(Chunker("./test/t1.txt")))
+                self.assertEqual(pool.skipped, [binary])
+        finally:
+            shutil.rmtree(tmp)
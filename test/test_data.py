@@ -0,0 +1,27 @@
+from unittest import TestCase, skipIf
+import json
+
+from common.data import Query
+from common.serde import SerdeParseError
+import config_test
+
+class TestData(TestCase):
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_DATA, "")
+    def test_query_sources(self):
+        query = Query()
+        query.id = "1"
+        query.text = "zanarkand"
+        query.sources = ["a.txt", "b.txt"]
+        self.assertEqual(Query(query.json_string()).sources, ["a.txt", "b.txt"])
+
+        # relay from before sources; no key, searches all
+        old = json.dumps({"type": "QUERY", "id": "1", "session": "", "text": "zanarkand"})
+        self.assertEqual(Query(old).sources, [])
+        # and an agent from before them gets none when unscoped
+        query.sources = []
+        self.assertNotIn("sources", query.json())
+
+        # required keys are still required, unknown ones still rejected
+        self.assertRaises(SerdeParseError, Query, json.dumps({"type": "QUERY", "id": "1", "session": ""}))
+        self.assertRaises(SerdeParseError, Query, json.dumps({"type": "QUERY", "id": "1", "session": "", "text": "", "x": 1}))
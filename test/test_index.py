@@ -0,0 +1,374 @@
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+import os
+import shutil
+import threading
+import tempfile
+
+import numpy as np
+
+from agent.index import HnswIndex, FlatIndex, ShardedIndex, IdFilter
+from agent.c_wrapper import Hnsw
+from agent.config import Config, Quantization
+import config_test
+from common.toml import Toml
+
+DIM = 8
+
+class TestIndex(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # no config file; hnsw settings are toml values
+        Toml.defaults(Config)
+        Config.DEBUG = False
+
+    def setUp(self):
+        Config.STORAGE.QUANTIZATION = Quantization.NONE
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, "index")
+        self._rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def _vectors(self, count: int, dim=DIM) -> np.ndarray:
+        return self._rng.random((count, dim), dtype=np.float32) - 0.5
+
+    @staticmethod
+    def _exact(vectors: np.ndarray, ids: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+        """
+        ids of the k nearest by cosine distance of each query, nearest first
+        """
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        return ids[np.argsort(1 - queries @ vectors.T, axis=1, kind="stable")[:, :k]]
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_load_error(self):
+        # graph fails to load in background, e.g. out of memory
+        with patch.object(Hnsw, "load", side_effect=MemoryError), patch("threading.excepthook"):
+            index = HnswIndex(self._path, DIM)
+            self.assertRaises(MemoryError, index.wait)
+
+        self.assertFalse(index.loaded)
+        self.assertRaises(MemoryError, index.ids)
+        self.assertRaises(MemoryError, index.add, self._vectors(1), np.array([1]))
+        self.assertRaises(MemoryError, index.delete, [1])
+        self.assertRaises(MemoryError, index.commit)
+        # vectors are there without the graph
+        self.assertEqual(len(index.query(self._vectors(1)[0], 3)[0]), 0)
+        index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_replay_truncated(self):
+        vectors = self._vectors(20)
+        index = FlatIndex(self._path, DIM)
+        index.add(vectors[:10], np.arange(1, 11))
+        index.delete([3])
+        index.add(vectors[10:], np.arange(11, 21))
+        index.commit()
+        index.close()
+        committed = os.path.getsize(self._path + ".log")
+
+        # crash halfway through appending the next add
+        with open(self._path + ".log", "ab") as f:
+            f.write(FlatIndex._HEADER.pack(FlatIndex._ADD, 5))
+            f.write(np.arange(21, 26, dtype=np.uint64).tobytes())
+            f.write(self._vectors(2).tobytes())
+
+        index = FlatIndex(self._path, DIM)
+        self.assertEqual(sorted(index.ids()), [id for id in range(1, 21) if id != 3])
+        # torn record is cut off so the next one appends after the last good one
+        self.assertEqual(os.path.getsize(self._path + ".log"), committed)
+        ids, dists = index.query(vectors[14], 1)
+        self.assertEqual(ids.tolist(), [15])
+        self.assertAlmostEqual(float(dists[0]), 0, places=5)
+        index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_checkpoint(self):
+        vectors = self._vectors(50)
+        index = HnswIndex(self._path, DIM)
+        index.add(vectors, np.arange(1, 51))
+        index.delete([7, 8])
+        index.commit()
+        index.checkpoint()
+        self.assertEqual(index.log_size, 0)
+        index.close()
+
+        # snapshot alone has the entries; nothing left to replay
+        index = HnswIndex(self._path, DIM)
+        index.wait()
+        self.assertTrue(index.loaded)
+        self.assertEqual(sorted(index._store.ids()), [id for id in range(1, 51) if id not in (7, 8)])
+        self.assertEqual(index.query(vectors[20], 1)[0].tolist(), [21])
+        self.assertNotIn(7, index.query(vectors[6], 5)[0].tolist())
+        index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_quantization(self):
+        dim = 64
+        vectors = self._vectors(2000, dim)
+        ids = np.arange(1, 2001, dtype=np.uint64)
+        queries = self._vectors(20, dim)
+        expected = self._exact(vectors, ids, queries, 10)
+
+        for quantization in [Quantization.FLOAT16, Quantization.INT8]:
+            Config.STORAGE.QUANTIZATION = quantization
+            path = os.path.join(self._tmp, quantization.name)
+            index = FlatIndex(path, dim)
+            index.add(vectors, ids)
+            index.commit()
+            index.checkpoint() # file gets the codes searched instead of the vectors
+            index.close()
+
+            index = FlatIndex(path, dim)
+            self.assertIsNotNone(index._store._rows.base_codes)
+            results = index.query_many(queries, 10)
+            # reranked at full precision, so the same top-k in the same order
+            self.assertEqual([r[0].tolist() for r in results], expected.tolist(), quantization.name)
+            index.close()
+
+            # flat only; the graph holds float32 anyway
+            index = HnswIndex(path + ".hnsw", dim)
+            index.add(vectors, ids)
+            index.commit()
+            index.checkpoint()
+            index.close()
+            index = HnswIndex(path + ".hnsw", dim)
+            self.assertIsNone(index._store._rows.base_codes)
+            index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_sharded_drop(self):
+        vectors = self._vectors(40)
+        index = ShardedIndex(self._path, DIM)
+        index.add(vectors[:20], np.arange(1, 21), "a")
+        index.add(vectors[20:], np.arange(21, 41), "b")
+        index.commit()
+        index.checkpoint()
+
+        name = ShardedIndex._name("a")
+        self.assertTrue(any(f.startswith(name) for f in os.listdir(self._path)))
+        index.drop("a", list(range(1, 21)))
+        # no files, no tombstones; b's shard is untouched
+        self.assertFalse(any(f.startswith(name) for f in os.listdir(self._path)))
+        self.assertTrue(any(f.startswith(ShardedIndex._name("b")) for f in os.listdir(self._path)))
+        self.assertEqual(index.element_count, 20)
+
+        ids, _ = index.query(vectors[5], 5)
+        self.assertTrue(all(id > 20 for id in ids.tolist()))
+        ids, _ = index.query(vectors[25], 1, IdFilter([26], ["b"]))
+        self.assertEqual(ids.tolist(), [26])
+        index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_sharded_eviction(self):
+        Config.STORAGE.HNSW.SHARDS_OPEN = 2
+        vectors = self._vectors(60)
+        index = ShardedIndex(self._path, DIM)
+        try:
+            index.add(vectors[:10], np.arange(1, 11), "a")
+            index.commit()
+            a = ShardedIndex._name("a")
+            shard, = index._pin([a])
+
+            # least recently used, but in use; the others make way instead
+            for i, source in enumerate(["b", "c", "d"], 1):
+                index.add(vectors[i * 10:(i + 1) * 10], np.arange(i * 10 + 1, (i + 1) * 10 + 1), source)
+                # uncommitted changes keep a shard open too
+                self.assertIn(ShardedIndex._name(source), index._open)
+                index.commit()
+            self.assertIn(a, index._open)
+            self.assertEqual(len(index._open), 2)
+            self.assertEqual(shard.query(vectors[3], 1)[0].tolist(), [4])
+
+            # no longer in use; goes first once another shard opens
+            index._unpin([a])
+            b = ShardedIndex._name("b")
+            index._pin([b])
+            index._unpin([b])
+            self.assertEqual(list(index._open), [ShardedIndex._name("d"), b])
+
+            # adds and queries from several threads while shards keep being evicted and reopened
+            Config.STORAGE.HNSW.SHARDS_OPEN = 1
+            errors = []
+            def run(fn):
+                try:
+                    for _ in range(20):
+                        fn()
+                except Exception as e:
+                    errors.append(e)
+            sources = ["a", "b", "c", "d"]
+            threads = [threading.Thread(target=run, args=(lambda s=s: index.query(vectors[0], 3, IdFilter([], [s])),)) for s in sources]
+            for thread in threads:
+                thread.start()
+            for i in range(40, 60):
+                index.add(vectors[i:i + 1], np.array([i + 1]), sources[i % 4])
+                index.commit()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(index.element_count, 60)
+            self.assertEqual(len(index._open), 1)
+
+            # a query over all shards keeps them all open; the next one would reopen them otherwise
+            self.assertEqual(index.query(vectors[45], 1)[0].tolist(), [46])
+            index.query(vectors[0], 3, IdFilter([], ["a"]))
+            self.assertEqual(len(index._open), 4)
+        finally:
+            Config.STORAGE.HNSW.SHARDS_OPEN = 16
+            index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_last_id(self):
+        vectors = self._vectors(30)
+        index = ShardedIndex(self._path, DIM)
+        index.add(vectors[:10], np.arange(1, 11), "a")
+        index.commit()
+        self.assertEqual(index.last_id, 10)
+        index.close() # checkpointed; found in the vectors file
+
+        # not checkpointed; only in its log
+        shard = HnswIndex(os.path.join(self._path, ShardedIndex._name("b")), DIM)
+        shard.add(vectors[10:20], np.arange(11, 21))
+        shard.commit()
+        shard.close()
+
+        index = ShardedIndex(self._path, DIM)
+        try:
+            self.assertEqual(index.last_id, 20)
+        finally:
+            index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_concurrent(self):
+        vectors = self._vectors(6000)
+        queries = self._vectors(8)
+
+        for cls in [HnswIndex, FlatIndex]:
+            index = cls(os.path.join(self._tmp, cls._NAME), DIM)
+            index.wait()
+            index.add(vectors[:100], np.arange(1, 101))
+            done = threading.Event()
+            errors = []
+
+            def query():
+                try:
+                    while not done.is_set():
+                        for ids, dists in index.query_many(queries, 5):
+                            self.assertEqual(len(ids), len(dists))
+                        index.query(queries[0], 5, IdFilter(np.arange(1, 6000, 7)))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=query) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            try:
+                # the graph resizes a few times meanwhile, and deletes close gaps in the new rows
+                for i in range(100, 6000, 100):
+                    index.add(vectors[i:i + 100], np.arange(i + 1, i + 101))
+                    index.delete(list(range(i - 99, i + 1, 3)))
+            finally:
+                done.set()
+                for thread in threads:
+                    thread.join()
+
+            self.assertEqual(errors, [], cls.__name__)
+            ids, dists = index.query(vectors[5999], 1)
+            self.assertEqual(ids.tolist(), [6000], cls.__name__)
+            index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_rollback(self):
+        vectors = self._vectors(30)
+        for cls in [HnswIndex, FlatIndex]:
+            path = os.path.join(self._tmp, cls._NAME)
+            index = cls(path, DIM)
+            index.add(vectors[:10], np.arange(1, 11))
+            index.commit()
+
+            index.add(vectors[10:20], np.arange(11, 21))
+            index.delete([1, 2])
+            self.assertTrue(index.dirty)
+            index.rollback()
+            index.wait()
+            self.assertFalse(index.dirty)
+            self.assertEqual(sorted(index._store.ids()), list(range(1, 11)), cls.__name__)
+
+            # ids of the rolled back add are handed out again
+            index.add(vectors[20:30], np.arange(11, 21))
+            index.commit()
+            self.assertEqual(index.query(vectors[25], 1)[0].tolist(), [16], cls.__name__)
+
+            # uncommitted records close writes out are not replayed
+            index.add(vectors[:5], np.arange(21, 26))
+            index.close()
+            index = cls(path, DIM)
+            index.wait()
+            self.assertEqual(sorted(index._store.ids()), list(range(1, 21)), cls.__name__)
+            self.assertEqual(index.query(vectors[25], 1)[0].tolist(), [16], cls.__name__)
+            index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_rebuild(self):
+        vectors = self._vectors(40)
+        for cls in [HnswIndex, FlatIndex, ShardedIndex]:
+            index = cls(os.path.join(self._tmp, cls.__name__), DIM)
+            index.add(vectors[:20], np.arange(1, 21), "a")
+            index.commit()
+
+            seen = []
+            def batches():
+                for i in range(20, 40, 5):
+                    # queries meanwhile get the old entries, all of them
+                    seen.append(index.query(vectors[3], 1)[0].tolist())
+                    yield vectors[i:i + 5], np.arange(i + 1, i + 6), ["a"] * 5
+            index.rebuild(batches(), 20)
+            index.wait()
+
+            self.assertEqual(seen, [[4]] * 4, cls.__name__)
+            self.assertEqual(index.query(vectors[33], 1)[0].tolist(), [34], cls.__name__)
+            self.assertEqual(index.element_count, 20, cls.__name__)
+            index.close()
+
+            # and after a restart
+            index = cls(os.path.join(self._tmp, cls.__name__), DIM)
+            index.wait()
+            self.assertEqual(index.query(vectors[33], 1)[0].tolist(), [34], cls.__name__)
+            self.assertEqual(index.element_count, 20, cls.__name__)
+            index.close()
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_INDEX, "")
+    def test_legacy_log(self):
+        # log written before commit markers; all of it was committed
+        vectors = self._vectors(10)
+        with open(self._path + ".log", "wb") as f:
+            f.write(FlatIndex._HEADER.pack(FlatIndex._ADD, 10))
+            f.write(np.arange(1, 11, dtype=np.uint64).tobytes())
+            f.write(vectors.tobytes())
+            f.write(FlatIndex._HEADER.pack(FlatIndex._DELETE, 1))
+            f.write(np.array([4], dtype=np.uint64).tobytes())
+
+        index = FlatIndex(self._path, DIM)
+        self.assertEqual(sorted(index.ids()), [1, 2, 3, 5, 6, 7, 8, 9, 10])
+        index.add(vectors[:1], np.array([11]))
+        index.close()
+
+        # marked on open, so the uncommitted add is left out this time
+        index = FlatIndex(self._path, DIM)
+        self.assertEqual(sorted(index.ids()), [1, 2, 3, 5, 6, 7, 8, 9, 10])
+        index.close()
@@ -12,11 +12,14 @@ from common.helper import PrintColor
 sql: Sql = None
 
 def cleanup():
-    if os.path.isfile(Config.STORAGE.INDEX):
-        os.remove(Config.STORAGE.INDEX)
-
-    if os.path.isfile(Config.STORAGE.SQL):
-        os.remove(Config.STORAGE.SQL)
+    for index in [Config.STORAGE.INDEX, Config.STORAGE.INDEX + ".log", Config.STORAGE.INDEX + ".vectors"]:
+        if os.path.isfile(index):
+            os.remove(index)
+
+    # WAL mode leaves the write-ahead log and its index next to the database
+    for data in [Config.STORAGE.SQL, Config.STORAGE.SQL + "-wal", Config.STORAGE.SQL + "-shm"]:
+        if os.path.isfile(data):
+            os.remove(data)
 
 class TestIntegration(IsolatedAsyncioTestCase):
     @classmethod
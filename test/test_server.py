@@ -0,0 +1,60 @@
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+import asyncio
+
+from websockets.asyncio.server import serve
+
+from agent.config import Config
+from agent.server import server
+from common.data import Query, Answer
+from common.toml import Toml
+import config_test
+
+class TestServer(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # no config file; relay settings are toml values
+        Toml.defaults(Config)
+        Config.DEBUG = False
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_SERVER, "")
+    def test_query_batch(self):
+        batches = []
+        def search_many(texts, embed, sources):
+            batches.append(texts)
+            return ["" for _ in texts]
+
+        async def relay(ws):
+            # back-to-back, as when several users ask at once
+            for i in range(2):
+                query = Query()
+                query.id = str(i)
+                query.session = ""
+                query.text = f"query {i}"
+                await ws.send(query.json_string())
+
+            ended = set()
+            while len(ended) < 2:
+                answer = Answer(json_str=await ws.recv())
+                if answer.end:
+                    ended.add(answer.id)
+
+        async def run():
+            async with serve(relay, "localhost", 0) as relay_server:
+                port = relay_server.sockets[0].getsockname()[1]
+                with patch.object(Config.RELAY, "HOST", f"localhost:{port}"), \
+                    patch.object(Config.RELAY, "ENABLE_TLS", False), \
+                    patch("agent.server.Vector.search_many", search_many), \
+                    patch("agent.server.Completion.run", lambda text, ctx, chat: iter(["answer"])):
+                    agent = asyncio.create_task(server())
+                    while len(batches) == 0 or sum(len(b) for b in batches) < 2:
+                        await asyncio.sleep(0.01)
+                    agent.cancel()
+                    try:
+                        await agent
+                    except asyncio.CancelledError:
+                        pass
+
+        asyncio.run(asyncio.wait_for(run(), 10))
+        self.assertEqual(batches, [["query 0", "query 1"]])
@@ -0,0 +1,237 @@
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from agent.storage import Sql, Vector, _Compressed
+from agent.config import Config, Retrieval, Compression
+import config_test
+from common.toml import Toml
+
+DIM = 8
+
+def _batch(documents: list[str], rng: np.random.Generator) -> dict:
+    return {
+        "documents": documents,
+        "vectors": rng.random((len(documents), DIM), dtype=np.float32),
+        "len": len(documents)
+    }
+
+class TestStorage(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # no config file; storage settings are toml values
+        Toml.defaults(Config)
+        Config.LLAMA.EMBEDDING.SIZE = DIM
+        Config.DEBUG = False
+
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        Config.STORAGE.SQL = os.path.join(self._tmp, "data")
+        Config.STORAGE.INDEX = os.path.join(self._tmp, "index")
+        Config.STORAGE.RETRIEVAL = Retrieval.VECTOR
+        Config.STORAGE.COMPRESSION = Compression.NONE
+        Vector._instance = None
+        Vector._filters = {}
+        # dictionary ids start over in each new database
+        _Compressed._dictionaries = {}
+
+        self._rng = np.random.default_rng(0)
+        self._sql = Sql()
+        self._sql.start()
+
+    def tearDown(self):
+        if Vector._instance is not None:
+            Vector._instance.close()
+            Vector._instance = None
+        self._sql.stop()
+        shutil.rmtree(self._tmp)
+
+    def _create(self, documents: list[str], src: str):
+        Vector.create(iter([_batch(documents, self._rng)]), src)
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_STORAGE, "")
+    def test_lexical_single_hit(self):
+        Config.STORAGE.RETRIEVAL = Retrieval.HYBRID
+        Config.STORAGE.LEXICAL.FIRST = True
+        self._create([f"common words in chunk {i}" for i in range(20)] + ["only here: zanarkand"], "src")
+        if not Vector._has_lexical:
+            self.skipTest("sqlite without fts5")
+
+        embedded = []
+        def embed(query: str) -> list[float]:
+            embedded.append(query)
+            return self._rng.random(DIM, dtype=np.float32)
+
+        # one hit has no runner-up to be decisive against; vectors are still searched
+        Vector.search("zanarkand", embed)
+        self.assertEqual(embedded, ["zanarkand"])
+
+        embedded.clear()
+        Vector.search_many(["zanarkand"], lambda queries: [embed(q) for q in queries])
+        self.assertEqual(embedded, ["zanarkand"])
+
+        self.assertFalse(Vector._decisive([]))
+        self.assertFalse(Vector._decisive([5.0]))
+        self.assertTrue(Vector._decisive([5.0, 1.0]))
+        self.assertFalse(Vector._decisive([5.0, 4.0]))
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_STORAGE, "")
+    def test_compressed(self):
+        documents = ["Zanarkand stadium, blitzball game, Sin attacks.", "", "ünïcödé 中文 " * 50,
+            "After the FMV you'll be controlling Tidus. " * 20]
+        dictionary = _Compressed.sample(documents)
+        self.assertLessEqual(len(dictionary), Config.STORAGE.DICTIONARY_SIZE)
+
+        encoded = _Compressed.encode(documents, 7, dictionary)
+        self.assertTrue(all(isinstance(e, bytes) for e in encoded))
+        looked_up = []
+        def lookup(id: int) -> bytes:
+            looked_up.append(id)
+            return dictionary
+        self.assertEqual([_Compressed.decode(e, lookup) for e in encoded], documents)
+        # cached after the first lookup
+        self.assertEqual(looked_up, [7])
+        # plain text rows, stored before compression, read back as is
+        self.assertEqual(_Compressed.decode("plain", lookup), "plain")
+
+        # stored and read back through sql
+        Config.STORAGE.COMPRESSION = Compression.ZLIB
+        self._create(documents, "src")
+        rows = Sql.exec("SELECT rowid, document FROM vector ORDER BY rowid", fetch=True)
+        self.assertTrue(all(isinstance(doc, bytes) for _, doc in rows))
+        ids = [id for id, _ in rows]
+        self.assertEqual(Vector._documents_many([[id] for id in ids]), [Vector._documents([id]) for id in ids])
+        self.assertEqual(Vector._documents([ids[0]]), documents[0])
+
+        # small embedding batches; the dictionary is still sampled from DICTIONARY_SIZE bytes of them
+        chunks = [f"chunk {i} of the second source, with some words. " * 4 for i in range(400)]
+        Vector.create(iter([_batch(chunks[i:i + 3], self._rng) for i in range(0, len(chunks), 3)]), "small")
+        dictionary, = Sql.exec("SELECT data FROM dictionary WHERE source='small'", fetch=True)[0]
+        self.assertEqual(len(dictionary), Config.STORAGE.DICTIONARY_SIZE)
+        ids = [r[0] for r in Sql.exec("SELECT rowid FROM vector WHERE source='small' ORDER BY rowid", fetch=True)]
+        self.assertEqual(Vector._documents_many([[id] for id in ids]), chunks)
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_STORAGE, "")
+    def test_delete_keep(self):
+        documents = [f"chunk {i} of zanarkand" for i in range(6)]
+        self._create(documents, "src")
+        self._create(["other source"], "other")
+
+        keep = {Vector.digest(doc) for doc in documents[:2]}
+        self.assertEqual(Vector.delete("src", keep), 4)
+        rows = Sql.exec("SELECT document FROM vector WHERE source='src' ORDER BY rowid", fetch=True)
+        self.assertEqual([r[0] for r in rows], documents[:2])
+        self.assertEqual(Vector.hashes("src"), keep)
+
+        # index and keyword search dropped them too
+        ids = {r[0] for r in Sql.exec("SELECT rowid FROM vector", fetch=True)}
+        self.assertEqual(set(Vector._index()._store.ids()), ids)
+        if Vector._has_lexical:
+            self.assertEqual(len(Vector._lexical("zanarkand", 10)[0]), 2)
+
+        # whole source
+        self.assertEqual(Vector.delete("src"), 2)
+        self.assertEqual(Vector.hashes("src"), set())
+        self.assertEqual(len(Vector._index()._store.ids()), 1)
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_STORAGE, "")
+    def test_sources(self):
+        self._create(["aa", "bbb", "ü"], "src")
+        self._create(["c"], "other")
+        self._create(["dd"], "src")
+        # count and bytes of text, least chunks first
+        self.assertEqual([r[:3] for r in Vector.list()], [("other", 1, 1), ("src", 4, 9)])
+
+        Vector.delete("src", {Vector.digest("aa")})
+        self.assertEqual(sorted(r[:3] for r in Vector.list()), [("other", 1, 1), ("src", 1, 2)])
+        Vector.delete("src", {Vector.digest("nothing")})
+        self.assertEqual([r[:3] for r in Vector.list()], [("other", 1, 1)])
+
+        # table built from the stored rows when opening a database from before it
+        Sql.exec("DROP TABLE sources")
+        Sql.commit()
+        Vector._instance.close()
+        Vector._instance = None
+        self.assertEqual([r[:3] for r in Vector.list()], [("other", 1, 1)])
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_STORAGE, "")
+    def test_filter_cache(self):
+        self._create(["a1", "a2"], "a")
+        self._create(["b1"], "b")
+        filter = Vector._filter(["a", "b", "a"])
+        self.assertEqual(len(filter), 3)
+        self.assertEqual(filter.sources, ["a", "b"])
+        self.assertIs(Vector._filter(["b", "a"]), filter)
+        self.assertIsNone(Vector._filter([]))
+
+        # creating under one of its sources drops it
+        self._create(["b2"], "b")
+        self.assertEqual(len(Vector._filter(["a", "b"])), 4)
+
+        # a source changing while the filter is read: returned, not cached
+        read = Sql.read
+        def changed(qs: str, *args):
+            rows = read(qs, *args)
+            Vector._forget("a")
+            return rows
+        Vector._filters = {}
+        with patch.object(Sql, "read", staticmethod(changed)):
+            filter = Vector._filter(["a"])
+        self.assertEqual(len(filter), 2)
+        self.assertNotIn(("a",), Vector._filters)
+        self.assertIsNot(Vector._filter(["a"]), filter)
+        self.assertIn(("a",), Vector._filters)
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_STORAGE, "")
+    def test_create_rollback(self):
+        self._create(["kept"], "other")
+
+        def failing():
+            for i in range(3):
+                yield _batch([f"chunk {i} {j}" for j in range(4)], self._rng)
+            raise OSError("disk gone")
+
+        add_batch = Config.STORAGE.HNSW.ADD_BATCH
+        Config.STORAGE.HNSW.ADD_BATCH = 4 # some reach the index before it fails
+        try:
+            self.assertRaises(OSError, Vector.create, failing(), "src")
+        finally:
+            Config.STORAGE.HNSW.ADD_BATCH = add_batch
+
+        self.assertEqual(Vector.hashes("src"), set())
+        self.assertEqual(Vector._index()._store.ids(), [r[0] for r in Sql.exec("SELECT rowid FROM vector", fetch=True)])
+
+        # same ids handed out again; after a restart index and sql still agree
+        self._create([f"chunk {i}" for i in range(8)], "src")
+        Vector._instance.close()
+        Vector._instance = None
+        ids = sorted(Vector._index()._store.ids())
+        self.assertEqual(ids, sorted(r[0] for r in Sql.exec("SELECT rowid FROM vector", fetch=True)))
+        self.assertEqual(len(set(ids)), 9)
+        self.assertEqual(Vector._documents(ids[-1:]), "chunk 7")
+
+# -----------------------------------------------------------------------------
+    @skipIf(config_test.SKIP_STORAGE, "")
+    def test_sequence_past_index(self):
+        self._create(["kept"], "other")
+
+        # crash between index and sql commit: the index keeps ids the sequence hands out again
+        index = Vector._index()
+        index.add(self._rng.random((3, DIM), dtype=np.float32), np.array([2, 3, 4], dtype=np.uint64), "src")
+        index.commit()
+        index.close()
+        Vector._instance = None
+
+        self._create(["new"], "src")
+        self.assertEqual(Vector._index().last_id, 5)
+        self.assertEqual(Sql.exec("SELECT rowid FROM vector WHERE source='src'", fetch=True), [(5,)])